@@ -0,0 +1,125 @@
+"""
+Compare index size and query latency of the string and hash token modes,
+and query latency of whoosh and a frozen snapshot of the same index.
+
+Usage: python3 benchmark.py [directory of python files]
+
+Without arguments, the snippets in test/data.json are used as the corpus.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+INDEX_DIR = os.path.join(os.path.abspath("."), "src", "backend")
+sys.path.append(INDEX_DIR)
+import indexer
+import settings
+
+
+def load_corpus(path=None):
+    """
+    Return a list of document dicts with title, url and content keys.
+    """
+    documents = []
+    if path is None:
+        with open(os.path.join("test", "data.json")) as f:
+            for data in json.load(f):
+                for i, code in enumerate(data['code_snippets']):
+                    documents.append({"title": data['title'],
+                                      "url": "{}#{}".format(data['url'], i),
+                                      "content": code})
+        return documents
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            if not filename.endswith(".py"):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            try:
+                with open(filepath) as f:
+                    content = f.read()
+            except (UnicodeDecodeError, OSError):
+                continue
+            documents.append({"title": "benchmark {}".format(filename),
+                              "url": filepath,
+                              "content": content})
+    return documents
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(path)
+               for filename in filenames)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def benchmark_tokenizer_options(documents, queries, tokenizer_options):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_path = os.path.join(tmpdir, "index")
+        indexer.create_new_index(index_path, "benchmark", tokenizer_options)
+        index = indexer.Index(index_path, "benchmark", tokenizer_options)
+        start = time.perf_counter()
+        index.add_many(documents)
+        ingest_time = time.perf_counter() - start
+        with index.index.reader() as reader:
+            term_count = sum(1 for _ in reader.lexicon("content"))
+        result = {"index_bytes": directory_size(index_path),
+                  "terms": term_count,
+                  "ingest_seconds": ingest_time}
+        result.update(query_latencies(index, queries))
+        return result
+
+
+def query_latencies(index, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        for _ in index.get_documents(query):
+            pass
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {"query_ms_mean": 1e3 * sum(latencies) / len(latencies),
+            "query_ms_p50": 1e3 * percentile(latencies, 0.5),
+            "query_ms_p95": 1e3 * percentile(latencies, 0.95)}
+
+
+def benchmark_frozen_index(documents, queries, tokenizer_options):
+    """
+    Return the query latencies of whoosh and a frozen snapshot of the same index.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_path = os.path.join(tmpdir, "index")
+        frozen_path = os.path.join(tmpdir, "frozen")
+        indexer.create_new_index(index_path, "benchmark", tokenizer_options)
+        index = indexer.Index(index_path, "benchmark", tokenizer_options)
+        index.add_many(documents)
+        index.index.optimize()
+        start = time.perf_counter()
+        index.freeze(frozen_path)
+        freeze_time = time.perf_counter() - start
+        frozen = indexer.Index(index_path, "benchmark", tokenizer_options, frozen_path=frozen_path)
+        return {"whoosh": query_latencies(index, queries),
+                "frozen": dict(query_latencies(frozen, queries),
+                               snapshot_bytes=directory_size(frozen_path),
+                               freeze_seconds=freeze_time)}
+
+
+def format_result(result):
+    return ", ".join("{}={:.2f}".format(k, v) if isinstance(v, float) else "{}={}".format(k, v)
+                     for k, v in result.items())
+
+
+if __name__ == "__main__":
+    documents = load_corpus(sys.argv[1] if len(sys.argv) > 1 else None)
+    queries = [d['content'] for d in documents if indexer.content_is_valid_code(d['content'])][:200]
+    print("{} documents, {} queries".format(len(documents), len(queries)))
+    for mode, hash_tokens in (("string", False), ("hash", True)):
+        tokenizer_options = dict(settings.TOKENIZER_OPTIONS, hash_tokens=hash_tokens)
+        result = benchmark_tokenizer_options(documents, queries, tokenizer_options)
+        print("{:>8}: {}".format(mode, format_result(result)))
+    for engine, result in benchmark_frozen_index(documents, queries, settings.TOKENIZER_OPTIONS).items():
+        print("{:>8}: {}".format(engine, format_result(result)))
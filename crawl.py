@@ -1,67 +1,33 @@
+"""
+Crawl the Python docs with the tutorial and library spiders concurrently in one process,
+writing the scraped code snippets directly into the index with pydocs_scraper.pipelines.IndexWriterPipeline.
+"""
 import os
-import subprocess
-import json
 import sys
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
 
 
 start_path = os.path.abspath(".")
 
 spiders = ("tutorial", "library")
 data_dir = os.path.join(start_path, "src", "backend")
-data_path = os.path.join(data_dir, "data.json")
 scrapy_path = os.path.join(start_path, "src", "scraper")
 
 sys.path.append(data_dir)
-import indexer
+sys.path.append(scrapy_path)
 import settings
 
+# Find the project settings without changing into the directory of scrapy.cfg
+os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "pydocs_scraper.settings")
+crawl_settings = get_project_settings()
+crawl_settings.set("LOG_FILE", os.path.join(scrapy_path, "scrapy.log"))
+crawl_settings.set("INDEX_PATH", os.path.join(data_dir, settings.INDEX_DIRNAME))
 
-def spider_output_path(spider):
-    return os.path.join(data_dir, "{}_out.json".format(spider))
-
-if os.path.exists(data_path):
-    print("Previous crawl output exists, removing {}".format(data_path))
-    os.remove(data_path)
-
-os.chdir(scrapy_path)
+process = CrawlerProcess(crawl_settings)
 for spider_name in spiders:
-    command = (
-        "scrapy", "crawl", spider_name, "-o", spider_output_path(spider_name),
-        "--logfile", "scrapy.log"
-    )
     print("Crawl with spider '{}'".format(spider_name))
-    subprocess.run(command, check=True)
-os.chdir(start_path)
-
-print("Crawling complete, joining crawl output")
-scraped_data = []
-for output in map(spider_output_path, spiders):
-    with open(output) as f:
-        scraped_data.extend(json.load(f))
-    os.remove(output)
-
-index_path = os.path.join(start_path, data_dir, settings.INDEX_DIRNAME)
-print("Building index")
-if not os.path.exists(index_path):
-    print("Previous index does not exist at '{}', creating".format(index_path))
-    indexer.create_new_index(
-        index_path,
-        settings.INDEX_NAME,
-        settings.TOKENIZER_OPTIONS
-    )
-else:
-    print("Previous index exists at '{}', not creating a new one".format(index_path))
-
-index = indexer.Index(
-    index_path,
-    settings.INDEX_NAME,
-    settings.TOKENIZER_OPTIONS
-)
-
-print("Add crawled output to index")
-for data in scraped_data:
-    index.add_documents(data)
+    process.crawl(spider_name)
+process.start()
 
 print("All done")
-
-
@@ -1,64 +1,16 @@
 import os
-import subprocess
+import sys
+import time
 import github3
 import json
 
+sys.path.append(os.path.join(os.path.abspath("."), "src", "backend"))
+import repo_cloner
+
 SEARCH_QUERY = "language:python stars:>1 size:>10000"
 SEARCH_PARAMETERS = { "sort": "stars", "number": 10 }
 
 
-def hard_prune_repo(repo_path):
-    """
-    1. Delete all files, except git metadata and files with names that match *.py.
-    2. Delete all empty folders.
-    3. Delete all symbolic links.
-    4. Set permission for all files to 440.
-    """
-    assert os.path.exists(repo_path)
-    prune_commands = (
-        "find {} -type f ! -name '*.py' -not -iwholename '*.git*' -delete",
-        "find {} -type d -empty -delete",
-        "find {} -type l -delete",
-        "find {} -type f -exec chmod 440 {{}} \;")
-    for command in prune_commands:
-        command = command.format(repo_path)
-        print(command)
-        subprocess.run(command, shell=True, check=True)
-
-
-def count_all_python_lines(root):
-    """
-    Run CLOC at root and return the amount of lines of Python code in every file.
-    """
-    assert os.path.exists(root)
-    command = "cloc --quiet --csv {}".format(root)
-    print(command)
-    result = subprocess.run(command, shell=True, check=True, stdout=subprocess.PIPE)
-    stdout = str(result.stdout, "utf-8")
-    assert "Python" in stdout
-    return int(stdout.split("Python")[-1].splitlines()[0].split(",")[-1])
-
-
-def count_all_repositories(root):
-    assert os.path.exists(root)
-    command = "find {} -type d -name '.git' | wc -l".format(root)
-    print(command)
-    result = subprocess.run(command, shell=True, check=True, stdout=subprocess.PIPE)
-    return int(result.stdout.strip())
-
-
-def save_metadata(cloned_destination, metadata_destination):
-    assert os.path.exists(cloned_destination)
-    assert os.path.exists(os.path.dirname(metadata_destination))
-    python_line_count = count_all_python_lines(cloned_destination)
-    repository_count = count_all_repositories(cloned_destination)
-    data = {"python_line_count": python_line_count,
-            "repo_count": repository_count}
-    with open(metadata_destination, "w") as f:
-        json.dump(data, f)
-    return python_line_count, repository_count
-
-
 if __name__ == "__main__":
     repo_data_file = os.path.join(".", "repo_data.json")
 
@@ -84,24 +36,12 @@ if __name__ == "__main__":
         print("not creating existing '{}'".format(cloned_destination))
 
     print("cloning {} repos".format(len(repos)))
-    for repo in repos:
-        repo_path = os.path.join(cloned_destination, repo["name"])
-        if not os.path.exists(repo_path):
-            command = ["git", "clone", "--depth=1", repo["clone_url"], repo_path]
-            print(" ".join(command))
-            subprocess.run(command, check=True)
-            print()
-            print("pruning repo from all non python files")
-            hard_prune_repo(repo_path)
-            print()
-        else:
-            print("not cloning into existing '{}'".format(repo_path))
-
+    start_time = time.perf_counter()
+    results = repo_cloner.clone_repos(repos, cloned_destination)
+    failed = [result["name"] for result in results if not result["ok"]]
+    print("cloned {} repos in {:.1f} seconds".format(len(results) - len(failed), time.perf_counter() - start_time))
+    if failed:
+        print("failed to clone {} repos: {}".format(len(failed), ", ".join(failed)), file=sys.stderr)
     print()
     print("all repos cloned")
-    metadata_destination = os.path.join("src", "backend", "cloned_meta.json")
-    print("saving meta data into '{}'".format(metadata_destination))
-    python_line_count, repository_count = save_metadata(cloned_destination, metadata_destination)
-    print("{} repositories at '{}'".format(repository_count, cloned_destination))
-    print("containing {} lines of Python code".format(python_line_count))
-
+    print("index the cloned repos with repo_indexer.py, which saves the statistics shown on the about page with the index")
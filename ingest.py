@@ -0,0 +1,54 @@
+"""
+Clone, index and delete the repos in repo_data.json in one pipelined run.
+Repos are cloned concurrently while the cloned ones are indexed, and every checkout is deleted as soon as it is indexed,
+so the disk holds at most about INGEST_DISK_BUDGET_MB of checkouts instead of the whole corpus.
+
+Usage: python3 ingest.py [--repo-data repo_data.json] [--disk-budget-mb MB] [--concurrency N]
+"""
+import argparse
+import json
+import os
+import sys
+# Adds src/backend to the module search path
+import repo_indexer
+import ingest_pipeline
+import settings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clone, index and delete repos in one pipeline")
+    parser.add_argument("--repo-data", default=repo_indexer.REPOS_DATA_JSON)
+    parser.add_argument("--disk-budget-mb", type=float, default=settings.INGEST_DISK_BUDGET_MB,
+                        help="do not start new clones while the checkouts waiting to be indexed take up more than this")
+    parser.add_argument("--concurrency", type=int, default=settings.CLONE_CONCURRENCY, help="amount of repos cloned at the same time")
+    args = parser.parse_args()
+
+    with open(args.repo_data) as f:
+        repos_data = json.load(f)
+    os.makedirs(repo_indexer.REPOS_PATH, exist_ok=True)
+    repo_index = repo_indexer.RepoIndexer(os.path.join(repo_indexer.INDEX_DIR, settings.INDEX_DIRNAME))
+
+    def index_repo(repo, repo_path):
+        if repo_index.is_full():
+            raise ingest_pipeline.StopPipeline("the index is full")
+        print("parse repo with name '{}'".format(repo['name']))
+        repo_index.index_repo(repo, repo_path)
+        print(repo_index.bulk_writer.report())
+        print()
+
+    try:
+        statistics = ingest_pipeline.run_pipeline(
+            repos_data,
+            repo_indexer.REPOS_PATH,
+            index_repo,
+            max_bytes=int(args.disk_budget_mb * 2 ** 20),
+            concurrency=args.concurrency)
+    finally:
+        # Commit what has been indexed and stop the tokenizer processes, also if the pipeline is interrupted
+        repo_index.close()
+    print(json.dumps(statistics))
+    print("{} repos indexed, {} failed to clone and {} failed to index in {:.1f} seconds, {:.1f} seconds spent cloning and {:.1f} seconds indexing".format(
+        statistics["indexed"], statistics["failed"], statistics["index_failed"],
+        statistics["seconds"], statistics["clone_seconds"], statistics["index_seconds"]))
+    if statistics["stopped"]:
+        sys.exit(1)
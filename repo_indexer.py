@@ -3,26 +3,26 @@ import sys
 import json
 import subprocess
 import shutil
+import itertools
 
 REPOS_PATH = "cloned"
 REPOS_DATA_JSON = "repo_data.json"
 
 INDEX_DIR = os.path.join(os.path.abspath("."), "src", "backend")
 sys.path.append(INDEX_DIR)
+import corpus_statistics
+import housekeeping
 import indexer
+import near_duplicates
+import parallel_tokenizer
+import profile_index
+import repo_walker
 import settings
 
 
 def run_command_and_get_stdout(command, start_path=None):
-    if start_path:
-        previous_dir = os.path.abspath(os.curdir)
-        try:
-            os.chdir(start_path)
-            stdout = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
-        finally:
-            os.chdir(previous_dir)
-    else:
-        stdout = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    # Run in start_path without changing the working directory of this process, which other threads may depend on
+    stdout = subprocess.run(command, stdout=subprocess.PIPE, check=True, cwd=start_path).stdout
     return str(stdout.strip(), 'utf-8')
 
 
@@ -30,40 +30,207 @@ def get_git_head_hash(path):
     return run_command_and_get_stdout(("git", "rev-parse", "HEAD"), path)
 
 
-def get_git_root_path(repo_path):
-    return run_command_and_get_stdout(("git", "rev-parse", "--show-toplevel"), repo_path)
+def diff_file_blobs(indexed_files, blobs):
+    """
+    Compare the files of a previously indexed repo state to the current blob hashes.
+    Return the paths of new or changed files and the paths of deleted files.
+    """
+    changed = [path for path, blob in blobs.items()
+               if path not in indexed_files or indexed_files[path]["blob"] != blob]
+    deleted = [path for path in indexed_files if path not in blobs]
+    return changed, deleted
 
 
-def get_git_remote_url(blob_url, dirpath, filename):
-    filepath = os.path.abspath(os.path.join(dirpath, filename))
-    git_root = os.path.abspath(get_git_root_path(dirpath))
-    print(filepath, git_root)
-    return blob_url + "/" + os.path.relpath(filepath, git_root)
+def document_tokens(document_data):
+    """
+    Return the subtree tokens of a document dict from parallel_tokenizer.TokenizerPool, using the first profile of documents tokenized for several token profiles.
+    """
+    if "profiles" in document_data:
+        document_data = next(iter(document_data["profiles"].values()))
+    return document_data.get("tokens")
 
 
-def get_current_index_size(index_path):
-    command = "du -s {}".format(index_path)
-    stdout = subprocess.run(command, shell=True, stdout=subprocess.PIPE, check=True).stdout
-    return int(str(stdout, 'utf-8').split("\t")[0])
+def iter_file_jobs(repo_name, files, paths):
+    """
+    Yield parallel_tokenizer jobs for the file dicts from repo_walker.iter_repo_files with relative paths in paths.
+    """
+    for path in paths:
+        yield dict(files[path], title="{} {}".format(repo_name, os.path.basename(path)))
+
+
+class RepoIndexer:
+    """
+    Add the Python files of cloned repos to the index at index_path, creating the index if it does not exist.
+    Only files that changed since the indexed state of a repo are tokenized, and near-duplicates of indexed files are skipped.
+    Call close when done to commit the remaining documents.
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        if not os.path.exists(index_path):
+            print("No index found at '{}', creating a new one".format(index_path))
+            profile_index.create_index(index_path)
+        else:
+            print("Found an index at '{}', appending to to the existing index".format(index_path))
+
+        self.index = profile_index.open_index(index_path)
+        # Segments are merged separately in the index of every profile
+        self.merged_indexes = [(index.index_path, index) for index in profile_index.profile_indexes(self.index).values()]
+        if isinstance(self.index, profile_index.ProfileIndex):
+            # Every profile is tokenized by the same worker process from one read of the file
+            self.tokenizer_pool = parallel_tokenizer.TokenizerPool(
+                self.index.tokenizer_options,
+                settings.INGEST_PROCESSES,
+                settings.INGEST_MAX_PENDING,
+                tokenize=profile_index.tokenize_profiles)
+            tokenizer_options = next(iter(self.index.tokenizer_options.values()))
+        else:
+            self.tokenizer_pool = parallel_tokenizer.TokenizerPool(
+                self.index.tokenizer_options,
+                settings.INGEST_PROCESSES,
+                settings.INGEST_MAX_PENDING)
+            tokenizer_options = self.index.tokenizer_options
+
+        self.near_duplicate_index = None
+        if settings.NEAR_DUPLICATE_THRESHOLD:
+            self.near_duplicate_index = near_duplicates.NearDuplicateIndex(
+                near_duplicates.database_path(index_path),
+                hash_tokens=bool(tokenizer_options.get("hash_tokens")))
+
+        self.repo_states = indexer.load_repo_states(index_path)
+        self.merge_policy = housekeeping.MergePolicy()
+        self.bulk_writer = self.index.bulk_writer(update=True)
+
+    def is_full(self):
+        """
+        Return True if the index has grown larger than INDEX_MAX_SIZE.
+        """
+        index_current_size = housekeeping.directory_size(self.index_path)
+        if index_current_size > settings.INDEX_MAX_SIZE:
+            print("The current size of the index is {}".format(index_current_size), file=sys.stderr)
+            print("This exceeds the maximum size of {} by {}".format(settings.INDEX_MAX_SIZE, abs(index_current_size-settings.INDEX_MAX_SIZE)), file=sys.stderr)
+            return True
+        return False
+
+    def index_repo(self, repo, repo_path):
+        """
+        Index the new and changed Python files of the repo dict with name and html_url keys, cloned at repo_path, and delete its removed files from the index.
+        """
+        repo_name = repo['name']
+        git_root = repo_walker.git_root_path(repo_path)
+        if git_root is not None:
+            git_head = get_git_head_hash(git_root)
+            blob_url = "/".join((repo["html_url"], "blob", git_head))
+        else:
+            print("'{}' is not a git work tree, listing all python files".format(repo_path))
+            git_head = None
+            blob_url = "/".join((repo["html_url"], "blob", "HEAD"))
+        # Resolve the git root once for all files instead of once per file
+        files = {f["relpath"]: f for f in repo_walker.iter_repo_files(repo_path, blob_url, git_root)}
+        if git_head is None:
+            git_head = repo_walker.files_hash(files.values())
+
+        print("git head is at '{}'".format(git_head))
+        print("blob url '{}'".format(blob_url))
+
+        repo_state = self.repo_states.get(repo_name, {"head": None, "files": {}})
+        if repo_state["head"] == git_head:
+            print("repo '{}' is already indexed at '{}'".format(repo_name, git_head))
+            return
+        blobs = {path: f["blob"] for path, f in files.items()}
+        changed_paths, deleted_paths = diff_file_blobs(repo_state["files"], blobs)
+        print("{} new or changed and {} deleted python files since '{}'".format(len(changed_paths), len(deleted_paths), repo_state["head"]))
+        for path in itertools.chain(changed_paths, deleted_paths):
+            indexed_file = repo_state["files"].pop(path, None)
+            if indexed_file and indexed_file["url"]:
+                self.bulk_writer.delete_document(indexed_file["url"])
+            if indexed_file and self.near_duplicate_index is not None:
+                self.near_duplicate_index.delete(indexed_file.get("alias_url") or indexed_file["url"])
+                if indexed_file["url"]:
+                    self.forget_aliases(indexed_file["url"])
+        # Files skipped as near-duplicates of a changed or deleted file of this repo are indexed again now
+        aliased_paths = [path for path in blobs if path not in repo_state["files"] and path not in changed_paths]
+        if aliased_paths:
+            print("{} near-duplicates of changed or deleted files are indexed again".format(len(aliased_paths)))
+            changed_paths.extend(aliased_paths)
+
+        print("parse all new and changed python files in repo '{}' at '{}'".format(repo_name, repo_path))
+        valid_count = 0
+        skipped_count = 0
+        duplicate_count = 0
+        progress = repo_walker.Progress()
+        jobs = iter_file_jobs(repo_name, files, changed_paths)
+        for document_data in self.tokenizer_pool.tokenize(jobs):
+            relpath = document_data["relpath"]
+            tokens = document_tokens(document_data)
+            signature = None
+            if self.near_duplicate_index is not None and tokens is not None:
+                signature = self.near_duplicate_index.signature(tokens)
+            canonical_url = None
+            if signature is not None:
+                canonical_url, similarity = self.near_duplicate_index.find(document_data["url"], signature)
+            if canonical_url is not None:
+                self.near_duplicate_index.add_alias(document_data["url"], canonical_url, similarity)
+                duplicate_count += 1
+                repo_state["files"][relpath] = {"blob": blobs[relpath], "url": None, "alias_url": document_data["url"]}
+            elif not self.bulk_writer.add_tokenized(document_data):
+                skipped_count += 1
+                repo_state["files"][relpath] = {"blob": blobs[relpath], "url": None}
+            else:
+                valid_count += 1
+                if signature is not None:
+                    self.near_duplicate_index.add(document_data["url"], signature)
+                repo_state["files"][relpath] = dict(
+                    corpus_statistics.file_statistics(document_data["content"], tokens),
+                    blob=blobs[relpath],
+                    url=document_data["url"])
+            progress.update("{} files added to the index, {} files skipped, {} near-duplicates skipped", valid_count, skipped_count, duplicate_count)
+
+        progress.done("{} files added to the index, {} files skipped, {} near-duplicates skipped", valid_count, skipped_count, duplicate_count)
+        print("parsed and added to the index {} python files with valid syntax".format(valid_count))
+        if duplicate_count:
+            print("skipped {} near-duplicates of indexed files".format(duplicate_count))
+        # Save the repo state only after the index contains its files
+        self.commit()
+        repo_state["head"] = git_head
+        repo_state["statistics"] = corpus_statistics.repo_statistics(repo_state)
+        self.repo_states[repo_name] = repo_state
+        indexer.save_repo_states(self.index_path, self.repo_states)
+        for merged_path, merged_index in self.merged_indexes:
+            if self.merge_policy.apply(merged_index, merged_path):
+                print("merged all index segments at '{}'".format(merged_path))
+
+    def forget_aliases(self, canonical_url):
+        """
+        Forget the indexed state of the files skipped as near-duplicates of the document with canonical_url, which is being deleted,
+        so that they are indexed in their own right the next time their repo is indexed, even if the repo has not changed.
+        """
+        alias_urls = set(self.near_duplicate_index.aliases(canonical_url))
+        if not alias_urls:
+            return
+        for repo_state in self.repo_states.values():
+            for path, indexed_file in list(repo_state["files"].items()):
+                if indexed_file.get("alias_url") in alias_urls:
+                    del repo_state["files"][path]
+                    repo_state["head"] = None
+        for url in alias_urls:
+            self.near_duplicate_index.delete(url)
+
+    def commit(self):
+        self.bulk_writer.commit()
+        if self.near_duplicate_index is not None:
+            self.near_duplicate_index.commit()
+
+    def close(self):
+        self.commit()
+        self.tokenizer_pool.close()
+        print(self.bulk_writer.report())
+        if self.near_duplicate_index is not None:
+            print("near-duplicates: {}".format(json.dumps(self.near_duplicate_index.statistics())))
+            self.near_duplicate_index.close()
 
 
 if __name__ == "__main__":
-    index_path = os.path.join(INDEX_DIR, settings.INDEX_DIRNAME)
-    if not os.path.exists(index_path):
-        print("No index found at '{}', creating a new one".format(index_path))
-        indexer.create_new_index(
-            index_path,
-            settings.INDEX_NAME,
-            settings.TOKENIZER_OPTIONS
-        )
-    else:
-        print("Found an index at '{}', appending to to the existing index".format(index_path))
-
-    index = indexer.Index(
-        index_path,
-        settings.INDEX_NAME,
-        settings.TOKENIZER_OPTIONS
-    )
+    repo_indexer = RepoIndexer(os.path.join(INDEX_DIR, settings.INDEX_DIRNAME))
 
     assert os.path.exists(REPOS_PATH)
     with open(REPOS_DATA_JSON) as f:
@@ -73,59 +240,22 @@ if __name__ == "__main__":
         repo_name = repo['name']
         print("parse repo {} with name '{}'".format(repo_number, repo_name))
 
-        index_current_size = get_current_index_size(index_path)
-        if index_current_size > settings.INDEX_MAX_SIZE:
-            print("The current size of the index is {}".format(index_current_size), file=sys.stderr)
-            print("This exceeds the maximum size of {} by {}".format(settings.INDEX_MAX_SIZE, abs(index_current_size-settings.INDEX_MAX_SIZE)), file=sys.stderr)
+        if repo_indexer.is_full():
             print("Exiting", file=sys.stderr)
+            repo_indexer.close()
             sys.exit(1)
 
         repo_path = os.path.join(REPOS_PATH, repo_name)
         if not os.path.exists(repo_path):
             print("non-existing repo at '{}', skipping".format(repo_path))
             continue
-        git_head = get_git_head_hash(repo_path)
-        blob_url = "/".join((repo["html_url"], "blob", git_head))
+        repo_indexer.index_repo(repo, repo_path)
 
-        print("git head is at '{}'".format(git_head))
-        print("blob url '{}'".format(blob_url))
-
-        print("parse all python files in repo '{}' at '{}'".format(repo_name, repo_path))
-        valid_count = 0
-        skipped_count = 0
-        for dirpath, dirname, filenames in os.walk(repo_path):
-            if "/.git/" in dirpath:
-                continue
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                if ".git" in filepath:
-                    continue
-                if not os.path.exists(filepath):
-                    skipped_count += 1
-                    continue
-                with open(filepath) as f:
-                    try:
-                        file_contents = f.read()
-                    except Exception as e:
-                        skipped_count += 1
-                        continue
-                git_url = get_git_remote_url(blob_url, dirpath, filename)
-                file_title = "{} {}".format(repo_name, filename)
-                document_data = {
-                    "title": file_title,
-                    "url": git_url,
-                    "content": file_contents}
-                if not index.add_document(document_data):
-                    skipped_count += 1
-                else:
-                    valid_count += 1
-                print("{} files added to the index, {} files skipped".format(valid_count, skipped_count), end='\r')
-
-        print()
-        print("parsed and added to the index {} python files with valid syntax".format(valid_count))
         print("removing cloned repo at '{}'".format(repo_path))
         shutil.rmtree(repo_path)
         print("repo {} named '{}' done".format(repo_number, repo_name))
+        print(repo_indexer.bulk_writer.report())
         print()
 
+    repo_indexer.close()
     print("all repos added to the index, exiting")
@@ -1,5 +1,6 @@
 import ast
-import itertools
+import hashlib
+import re
 from whoosh.analysis import Tokenizer
 from whoosh.analysis.acore import Token
 
@@ -18,11 +19,6 @@ def name_dump(root):
     return ' '.join(node.__class__.__name__ for node, _ in preorder(root))
 
 
-# TODO:
-# - which nodes can be seen as stopwords?
-# - create two indexes:
-#   1. with variable names and with stopwords, for matching scattered lines, shallow trees allowed
-#   2. without variable names and without stopwords, for matching larger constructs, tall trees only
 class ASTTokenizer(Tokenizer):
     def __init__(self, string_dump_options):
         self.string_dump_options = string_dump_options
@@ -31,9 +27,10 @@ class ASTTokenizer(Tokenizer):
                  keeporiginal=False, start_pos=0, removestops=False,
                  start_char=0, tokenize=True, mode='', **kwargs):
         t = Token(positions, chars, removestops=removestops, mode=mode)
-        all_subtrees = dump(ast.parse(source_string), **self.string_dump_options)
-        full_tree = next(all_subtrees)
-        for pos, subtree in enumerate(itertools.chain((full_tree, ), all_subtrees)):
+        if chars:
+            offsets = SourceOffsets(source_string)
+        all_subtrees = dump_with_nodes(ast.parse(source_string), **self.string_dump_options)
+        for pos, (node, subtree) in enumerate(all_subtrees):
             t.text = subtree
             t.boost = 1.0
             if keeporiginal:
@@ -42,16 +39,129 @@ class ASTTokenizer(Tokenizer):
             if positions:
                 t.pos = start_pos + pos
             if chars:
-                t.startchar = start_char + full_tree.index(subtree)
-                t.endchar = start_char + t.startchar + len(subtree)
+                startchar, endchar = offsets.node_span(node)
+                t.startchar = start_char + startchar
+                t.endchar = start_char + endchar
             yield t
 
 
-def dump(node, annotate_fields=True, include_attributes=False,
-         drop_field_names=None, drop_field_values=None,
-         drop_node_names=None, min_depth=None, max_depth=None):
+class SourceOffsets:
+    """
+    Map the line numbers and UTF-8 byte column offsets of AST nodes to character offsets in the source string.
+    """
+    NEWLINE = re.compile(r"\r\n|\r|\n")
+
+    def __init__(self, source):
+        self.source = source
+        self.line_starts = [0] + [m.end() for m in self.NEWLINE.finditer(source)]
+
+    def char_offset(self, lineno, col_offset):
+        """
+        Return the character offset in the source of the byte col_offset on line lineno, both as given by the ast module.
+        """
+        line_start = self.line_starts[lineno - 1]
+        if lineno < len(self.line_starts):
+            line = self.source[line_start:self.line_starts[lineno]]
+        else:
+            line = self.source[line_start:]
+        if not line.isascii():
+            col_offset = len(line.encode()[:col_offset].decode(errors="ignore"))
+        return line_start + col_offset
+
+    def node_span(self, node):
+        """
+        Return the start and end character offsets of node in the source.
+        Nodes without positions, such as Module or arguments, span all their children.
+        """
+        if getattr(node, "lineno", None) is not None:
+            start = self.char_offset(node.lineno, node.col_offset)
+            if getattr(node, "end_lineno", None) is not None:
+                return start, self.char_offset(node.end_lineno, node.end_col_offset)
+            return start, start
+        spans = [self.node_span(child) for child in ast.iter_child_nodes(node)]
+        if not spans:
+            return 0, 0
+        return min(start for start, _ in spans), max(end for _, end in spans)
+
+
+def weak_hash(*parts):
+    """
+    Return a 64-bit digest of the given strings and bytes as a fixed-width hex string.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(part)
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+def node_line_range(node):
+    """
+    Return the first and last line numbers of node in the source.
+    Nodes without positions, such as Module or arguments, span all their children.
+    """
+    if getattr(node, "lineno", None) is not None:
+        return node.lineno, getattr(node, "end_lineno", None) or node.lineno
+    ranges = [node_line_range(child) for child in ast.iter_child_nodes(node)]
+    ranges = [r for r in ranges if r is not None]
+    if not ranges:
+        return None
+    return min(first for first, _ in ranges), max(last for _, last in ranges)
+
+
+def subtree_heights(root):
+    """
+    Return a dict of id(node) to the height of the subtree rooted at node, for every node under root.
+    """
+    heights = {}
+    def _visit(node):
+        height = 0
+        for child in ast.iter_child_nodes(node):
+            height = max(height, _visit(child) + 1)
+        heights[id(node)] = height
+        return height
+    _visit(root)
+    return heights
+
+
+def tokenize_source(source, **options):
+    """
+    Parse source and return a list of its subtree tokens, as yielded by dump, and a dict of the line ranges of every token.
+    The line ranges of a token are a list of [first, last] line number pairs of all subtrees with that token.
+    Raises the exceptions of ast.parse if source is not valid Python.
+    """
+    tokens = []
+    line_ranges = {}
+    for node, token in dump_with_nodes(ast.parse(source), **options):
+        tokens.append(token)
+        line_range = node_line_range(node)
+        if line_range is not None:
+            line_ranges.setdefault(token, []).append(list(line_range))
+    return tokens, line_ranges
+
+
+def dump(node, **options):
     """
     Adapted from ast.dump, original: https://github.com/python/cpython/blob/master/Lib/ast.py#L88
+    Yield the string representation of every subtree of node in preorder, skipping subtrees that are not at least min_depth tall or have a root named in drop_node_names.
+    See dump_with_nodes for the options.
+    """
+    for _, token in dump_with_nodes(node, **options):
+        yield token
+
+
+def dump_with_nodes(node, annotate_fields=True, include_attributes=False,
+                    drop_field_names=None, drop_field_values=None,
+                    drop_node_names=None, min_depth=None, max_depth=None,
+                    hash_tokens=False, drop_tokens=None):
+    """
+    Yield pairs of the root node of every subtree of node and its dump, in the same order as dump.
+    All subtrees are serialized in a single post-order pass, where every node is formatted once by reusing the results of its children.
+    If hash_tokens is True, yield for every subtree a 64-bit Merkle hash computed from the hashes of its children instead of its string representation.
+    In that case, drop_field_values is compared against the repr of leaf values.
+    Subtrees with a token in drop_tokens, such as the stopwords found by stopwords.py, are skipped.
     """
     if min_depth and max_depth:
         assert min_depth < max_depth
@@ -61,8 +171,22 @@ def dump(node, annotate_fields=True, include_attributes=False,
         drop_field_values = set()
     if drop_node_names is None:
         drop_node_names = set()
+    if drop_tokens is None:
+        drop_tokens = set()
     def name(node):
         return node.__class__.__name__
+    # Serialized subtrees by node, or by node and depth if the depth is limited
+    memo = {}
+    def memoized(serialize):
+        def _serialize(node, depth):
+            if not isinstance(node, ast.AST):
+                return serialize(node, depth)
+            key = id(node) if max_depth is None else (id(node), depth)
+            if key not in memo:
+                memo[key] = serialize(node, depth)
+            return memo[key]
+        return _serialize
+    @memoized
     def _format(node, depth):
         if max_depth is not None and depth > max_depth:
             return name(node)
@@ -86,13 +210,49 @@ def dump(node, annotate_fields=True, include_attributes=False,
                 return '[]'
             return '[%s]' % ', '.join(_format(n, depth+1) for n in node)
         return repr(node)
+    @memoized
+    def _hash(node, depth):
+        if max_depth is not None and depth > max_depth:
+            return weak_hash(name(node))
+        elif isinstance(node, ast.AST):
+            fields = [(a, _hash(b, depth+1), b)
+                      for a, b in ast.iter_fields(node)]
+            parts = [name(node)]
+            for a, h, b in fields:
+                if a in drop_field_names:
+                    continue
+                if not isinstance(b, (ast.AST, list)) and repr(b) in drop_field_values:
+                    continue
+                if annotate_fields:
+                    parts.append(a)
+                parts.append(h)
+            if include_attributes and node._attributes:
+                for a in node._attributes:
+                    parts.extend((a, _hash(getattr(node, a), depth+1)))
+            return weak_hash(*parts)
+        elif isinstance(node, list):
+            return weak_hash('[', *(_hash(n, depth+1) for n in node))
+        return weak_hash(repr(node))
+    serialize = _hash if hash_tokens else _format
+    # Pairs of nodes and tokens in preorder, None for subtrees that are skipped
+    tokens = []
+    def _visit(node):
+        """
+        Visit all children of node before serializing node and return the height of node.
+        """
+        preorder_index = len(tokens)
+        tokens.append(None)
+        height = 0
+        for child in ast.iter_child_nodes(node):
+            height = max(height, _visit(child) + 1)
+        if (min_depth is None or height >= min_depth) and name(node) not in drop_node_names:
+            token = serialize(node, 0)
+            if token not in drop_tokens:
+                tokens[preorder_index] = node, token
+        return height
     if not isinstance(node, ast.AST):
         raise TypeError('expected AST, got %r' % name(node))
-    for subtree, _ in preorder(node):
-        if min_depth is not None and not has_depth_at_least(subtree, min_depth):
-            continue
-        if name(subtree) in drop_node_names:
-            continue
-        yield _format(subtree, 0)
-
-
+    _visit(node)
+    for node_and_token in tokens:
+        if node_and_token is not None:
+            yield node_and_token
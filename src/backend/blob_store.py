@@ -0,0 +1,124 @@
+"""
+Content-addressed storage for the source code of indexed documents.
+"""
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import time
+import zlib
+
+
+# File name suffix of the line ranges stored next to a blob
+LINE_RANGES_SUFFIX = ".lines"
+# File name suffix of the multi-line strings stored next to a blob
+STRING_SPANS_SUFFIX = ".strings"
+
+
+def content_hash(content):
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class BlobStore:
+    """
+    Directory of zlib compressed files, each named by the SHA-1 hash of its uncompressed contents.
+    Identical contents are stored only once.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def blob_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def __contains__(self, key):
+        return os.path.exists(self.blob_path(key))
+
+    def put(self, content):
+        """
+        Store the string content if it does not exist yet and return its key.
+        """
+        key = content_hash(content)
+        path = self.blob_path(key)
+        if os.path.exists(path):
+            # Mark the blob as recently used for BlobStore.age
+            os.utime(path)
+            return key
+        self._write(path, content.encode())
+        return key
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that readers never see partially written blobs
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(zlib.compress(data))
+        os.replace(tmp_path, path)
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+                return zlib.decompress(blob)
+
+    def get(self, key):
+        """
+        Return the string stored with key.
+        """
+        return self._read(self.blob_path(key)).decode()
+
+    def _put_json(self, key, suffix, value):
+        path = self.blob_path(key) + suffix
+        if not os.path.exists(path):
+            self._write(path, json.dumps(value, separators=(",", ":")).encode())
+
+    def _get_json(self, key, suffix):
+        try:
+            return json.loads(self._read(self.blob_path(key) + suffix).decode())
+        except FileNotFoundError:
+            return None
+
+    def put_line_ranges(self, key, line_ranges):
+        """
+        Store a dict of subtree tokens to line ranges, as returned by ast_parser.tokenize_source, for the contents stored with key.
+        """
+        self._put_json(key, LINE_RANGES_SUFFIX, line_ranges)
+
+    def get_line_ranges(self, key):
+        """
+        Return the dict of subtree tokens to line ranges of the contents stored with key, or None if there is no such dict.
+        """
+        return self._get_json(key, LINE_RANGES_SUFFIX)
+
+    def put_string_spans(self, key, string_spans):
+        """
+        Store a list of multi-line strings, as returned by result_formatter.multiline_string_spans, for the contents stored with key.
+        """
+        self._put_json(key, STRING_SPANS_SUFFIX, string_spans)
+
+    def get_string_spans(self, key):
+        """
+        Return the list of multi-line strings of the contents stored with key, or None if there is no such list.
+        """
+        return self._get_json(key, STRING_SPANS_SUFFIX)
+
+    def age(self, key):
+        """
+        Return the amount of seconds since the blob with key was last stored.
+        """
+        return time.time() - os.path.getmtime(self.blob_path(key))
+
+    def delete(self, key):
+        for path in (self.blob_path(key), self.blob_path(key) + LINE_RANGES_SUFFIX, self.blob_path(key) + STRING_SPANS_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def keys(self):
+        for prefix in os.scandir(self.path):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if not entry.name.startswith("tmp") and "." not in entry.name:
+                    yield prefix.name + entry.name
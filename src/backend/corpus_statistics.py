@@ -0,0 +1,81 @@
+"""
+Statistics of the indexed repos, accumulated while indexing and saved in the index directory for the about page.
+"""
+import json
+import os
+import settings
+
+
+STATISTIC_NAMES = ("line_count", "byte_count", "token_count")
+
+
+def code_line_count(content):
+    """
+    Return the amount of lines in content that are neither empty, whitespace only nor comments only.
+    """
+    count = 0
+    for line in content.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            count += 1
+    return count
+
+
+def file_statistics(content, tokens):
+    """
+    Return a dict of the lines of code, UTF-8 bytes and subtree tokens of an indexed file.
+    """
+    return {"line_count": code_line_count(content),
+            "byte_count": len(content.encode("utf-8", "surrogateescape")),
+            "token_count": len(tokens)}
+
+
+def repo_statistics(repo_state):
+    """
+    Return a dict of the amount of indexed files of a repo state, see indexer.load_repo_states, and the totals of their file_statistics.
+    Near-duplicates that were not indexed are not included.
+    """
+    statistics = dict.fromkeys(STATISTIC_NAMES, 0)
+    statistics["file_count"] = 0
+    for indexed_file in repo_state["files"].values():
+        if not indexed_file["url"]:
+            continue
+        statistics["file_count"] += 1
+        for name in STATISTIC_NAMES:
+            statistics[name] += indexed_file.get(name, 0)
+    return statistics
+
+
+def corpus_statistics(repo_states):
+    """
+    Return a dict of the amount of indexed repos and the totals of their repo_statistics.
+    """
+    statistics = dict.fromkeys(STATISTIC_NAMES, 0)
+    statistics["file_count"] = 0
+    statistics["repo_count"] = 0
+    for repo_state in repo_states.values():
+        if repo_state["head"] is None:
+            continue
+        statistics["repo_count"] += 1
+        for name, value in (repo_state.get("statistics") or repo_statistics(repo_state)).items():
+            statistics[name] += value
+    return statistics
+
+
+def save(index_path, statistics):
+    path = os.path.join(index_path, settings.CORPUS_STATISTICS_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(statistics, f)
+    os.replace(tmp_path, path)
+
+
+def load(index_path):
+    """
+    Return the statistics saved for the index at index_path, or None if there are none.
+    """
+    path = os.path.join(index_path, settings.CORPUS_STATISTICS_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
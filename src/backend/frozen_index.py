@@ -0,0 +1,251 @@
+"""
+Read-only snapshot of an index with the postings of all subtree tokens in memory-mapped NumPy arrays.
+Answers the same queries as a whoosh searcher, with the same BM25F scores and ranking, without the per-posting Python overhead of whoosh.
+Snapshots are written with python3 src/backend/housekeeping.py --freeze.
+"""
+import json
+import math
+import os
+import shutil
+import tempfile
+import numpy
+import ast_parser
+import search_results
+
+
+META_FILENAME = "meta.json"
+# Stored fields of every document as one JSON object per document, concatenated into one UTF-8 array
+DOCUMENTS_FILENAME = "documents.npy"
+# The stored fields of document i are at documents[document_offsets[i]:document_offsets[i+1]]
+DOCUMENT_OFFSETS_FILENAME = "document_offsets.npy"
+# Sorted 64-bit term ids
+TERMS_FILENAME = "terms.npy"
+# Document frequency and inverse document frequency of every term, as whoosh computes them
+FREQUENCIES_FILENAME = "frequencies.npy"
+# Postings of term i are at postings[offsets[i]:offsets[i+1]]
+OFFSETS_FILENAME = "offsets.npy"
+# Document number and BM25F score of every posting, sorted by term id and document number
+POSTINGS_FILENAME = "postings.npy"
+
+POSTING_DTYPE = numpy.dtype([("document", "<u4"), ("score", "<f8")])
+
+
+def term_id(token, hash_tokens):
+    """
+    Return the 64-bit integer id of a subtree token.
+    Hashed tokens are already 64-bit hashes, string tokens are hashed.
+    """
+    if hash_tokens:
+        return int(token, 16)
+    return int(ast_parser.weak_hash(token), 16)
+
+
+def bm25(idf, tf, fl, avgfl, B, K1):
+    """
+    whoosh.scoring.bm25 for arrays, with the operations in the same order to get exactly the same scores.
+    """
+    return idf * ((tf * (K1 + 1)) / (tf + K1 * ((1 - B) + B * fl / avgfl)))
+
+
+def save_array(directory, filename, array):
+    with open(os.path.join(directory, filename), "wb") as f:
+        numpy.save(f, array)
+
+
+def encode_documents(stored_fields):
+    """
+    Return an array of the UTF-8 encoded JSON objects of the stored fields dicts, one after the other, and the array of their offsets.
+    """
+    encoded = [json.dumps(fields, separators=(",", ":")).encode() for fields in stored_fields]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(data) for data in encoded])
+    return numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8), offsets
+
+
+def freeze(index, path):
+    """
+    Write a snapshot of the current generation of an indexer.Index to the directory path, replacing any previous snapshot at path.
+    Processes that have the previous snapshot open keep reading it until they open the new one.
+    """
+    if index.backend != "whoosh":
+        raise ValueError("only indexes with the whoosh backend can be frozen")
+    hash_tokens = bool(index.tokenizer_options.get("hash_tokens"))
+    with index.index.searcher() as searcher:
+        weighting = searcher.weighting
+        reader = searcher.reader()
+        live_docnums = list(reader.all_doc_ids())
+        # whoosh document numbers to snapshot document numbers, which are in the same order
+        documents = numpy.full(reader.doc_count_all(), -1, dtype=numpy.int64)
+        documents[live_docnums] = numpy.arange(len(live_docnums))
+        lengths = numpy.array([searcher.doc_field_length(docnum, "content", 1) for docnum in live_docnums], dtype=numpy.float64)
+        avgfl = searcher.avg_field_length("content") or 1
+        terms = []
+        for text in reader.lexicon("content"):
+            token = text.decode()
+            matcher = reader.postings("content", text)
+            docnums, weights = [], []
+            while matcher.is_active():
+                docnums.append(matcher.id())
+                weights.append(matcher.weight())
+                matcher.next()
+            if not docnums:
+                # All documents with this token have been deleted
+                continue
+            terms.append((term_id(token, hash_tokens),
+                          searcher.doc_frequency("content", text),
+                          searcher.idf("content", text),
+                          documents[docnums],
+                          numpy.array(weights, dtype=numpy.float64)))
+        terms.sort(key=lambda term: term[0])
+        term_ids = numpy.array([term[0] for term in terms], dtype=numpy.uint64)
+        if len(term_ids) > 1 and not numpy.all(term_ids[1:] != term_ids[:-1]):
+            raise ValueError("two subtree tokens have the same 64-bit term id, the index cannot be frozen")
+        frequencies = numpy.array([(term[1], term[2]) for term in terms], dtype=numpy.float64).reshape(-1, 2)
+        offsets = numpy.zeros(len(terms) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(term[3]) for term in terms])
+        postings = numpy.empty(offsets[-1], dtype=POSTING_DTYPE)
+        for i, (_, _, idf, docs, weights) in enumerate(terms):
+            posting_slice = slice(offsets[i], offsets[i + 1])
+            postings["document"][posting_slice] = docs
+            postings["score"][posting_slice] = bm25(idf, weights, lengths[docs], avgfl, weighting.B, weighting.K1)
+        stored_fields = [reader.stored_fields(docnum) for docnum in live_docnums]
+        meta = {"generation": index.index.latest_generation(),
+                "doc_count_all": searcher.doc_count_all(),
+                "hash_tokens": hash_tokens}
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    save_array(tmp_path, TERMS_FILENAME, term_ids)
+    save_array(tmp_path, FREQUENCIES_FILENAME, frequencies)
+    save_array(tmp_path, OFFSETS_FILENAME, offsets)
+    save_array(tmp_path, POSTINGS_FILENAME, postings)
+    documents, document_offsets = encode_documents(stored_fields)
+    save_array(tmp_path, DOCUMENTS_FILENAME, documents)
+    save_array(tmp_path, DOCUMENT_OFFSETS_FILENAME, document_offsets)
+    with open(os.path.join(tmp_path, META_FILENAME), "w") as f:
+        json.dump(meta, f)
+    # Swap the directories so that a snapshot at path is always complete
+    old_path = None
+    if os.path.exists(path):
+        old_path = tempfile.mkdtemp(dir=parent)
+        os.replace(path, os.path.join(old_path, "snapshot"))
+    os.replace(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path)
+    return meta
+
+
+class FrozenIndex:
+    """
+    Snapshot written by freeze, opened read-only.
+    All arrays, including the stored fields of the documents, are memory-mapped, so all processes serving the same snapshot share one copy of it in the page cache.
+    Only the stored fields of the documents on a result page are decoded.
+    Implements the part of the whoosh searcher interface that indexer.Index and query_planner.QueryPlanner use,
+    so an instance can be used in place of a searcher, and by any amount of threads at the same time.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILENAME)) as f:
+            meta = json.load(f)
+        self.generation = meta["generation"]
+        self.hash_tokens = meta["hash_tokens"]
+        self._doc_count_all = meta["doc_count_all"]
+        self.documents = self.load_array(DOCUMENTS_FILENAME)
+        self.document_offsets = self.load_array(DOCUMENT_OFFSETS_FILENAME)
+        self.terms = self.load_array(TERMS_FILENAME)
+        self.frequencies = self.load_array(FREQUENCIES_FILENAME)
+        self.offsets = self.load_array(OFFSETS_FILENAME)
+        self.postings = self.load_array(POSTINGS_FILENAME)
+
+    def load_array(self, filename):
+        return numpy.load(os.path.join(self.path, filename), mmap_mode="r")
+
+    def searcher(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def close(self):
+        pass
+
+    def doc_count(self):
+        return len(self.document_offsets) - 1
+
+    def stored_fields(self, document):
+        """
+        Return the stored fields dict of a document number.
+        """
+        return json.loads(self.documents[self.document_offsets[document]:self.document_offsets[document + 1]].tobytes())
+
+    def doc_count_all(self):
+        return self._doc_count_all
+
+    def term_index(self, token):
+        """
+        Return the index of token in the sorted term ids, or None if token is not in the snapshot.
+        """
+        key = numpy.uint64(term_id(token, self.hash_tokens))
+        i = int(numpy.searchsorted(self.terms, key))
+        if i < len(self.terms) and self.terms[i] == key:
+            return i
+        return None
+
+    def doc_frequency(self, fieldname, token):
+        i = self.term_index(token)
+        if i is None:
+            return 0
+        return int(self.frequencies[i, 0])
+
+    def term_postings(self, tokens):
+        """
+        Return a list of (token, postings) pairs for all tokens in the snapshot.
+        """
+        postings = []
+        for token in tokens:
+            i = self.term_index(token)
+            if i is not None:
+                postings.append((token, self.postings[self.offsets[i]:self.offsets[i + 1]]))
+        return postings
+
+    def search_tokens(self, tokens, limit):
+        """
+        Return the total amount of documents containing any of tokens and a list of (document number, score, matched tokens) of the limit best matching documents.
+        Documents are ordered by the sum of the scores of their tokens, and by document number if the scores are equal, like whoosh orders them.
+        """
+        postings = self.term_postings(tokens)
+        if not postings:
+            return 0, []
+        documents = numpy.concatenate([p["document"] for _, p in postings])
+        scores = numpy.concatenate([p["score"] for _, p in postings])
+        matched, inverse = numpy.unique(documents, return_inverse=True)
+        totals = numpy.bincount(inverse.ravel(), weights=scores)
+        if len(totals) > limit:
+            # Keep only the documents scoring at least as high as the limit'th best, including ties
+            threshold = numpy.partition(totals, len(totals) - limit)[len(totals) - limit]
+            candidates = numpy.flatnonzero(totals >= threshold)
+        else:
+            candidates = numpy.arange(len(totals))
+        order = candidates[numpy.lexsort((matched[candidates], -totals[candidates]))][:limit]
+        top_documents = matched[order]
+        top_tokens = [[] for _ in order]
+        for token, p in postings:
+            for j in numpy.flatnonzero(numpy.isin(top_documents, p["document"])):
+                top_tokens[j].append(token)
+        return len(matched), [(int(d), float(s), t) for d, s, t in zip(top_documents, totals[order], top_tokens)]
+
+    def search_page(self, query, pagenum, pagelen=10, terms=False):
+        """
+        Search with a whoosh.query.Or of Terms in the content field, like whoosh.searching.Searcher.search_page.
+        Pages past the last page return the last page, like in whoosh.
+        """
+        tokens = [subquery.text for subquery in query.subqueries]
+        total, top = self.search_tokens(tokens, pagenum * pagelen)
+        pagenum = min(pagenum, max(1, int(math.ceil(total / pagelen))))
+        hits = [search_results.Hit(self.stored_fields(document), score, matched_tokens)
+                for document, score, matched_tokens in top[(pagenum - 1) * pagelen:]]
+        return search_results.ResultsPage(hits, total, pagenum)
+
@@ -0,0 +1,215 @@
+"""
+Housekeeping of an index: size and segment statistics, merging segments, purging stale documents and unreferenced blobs,
+and writing read-only snapshots of the index for frozen_index.FrozenIndex.
+
+Usage: python3 src/backend/housekeeping.py [--optimize | --merge] [--purge [--repo-data repo_data.json]] [--vacuum] [--freeze [PATH]] [--interval SECONDS]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from whoosh.index import LockError
+import indexer
+import near_duplicates
+import profile_index
+import settings
+
+
+def directory_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += directory_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            size += entry.stat().st_size
+    return size
+
+
+def index_statistics(index, index_path):
+    """
+    Return a dict of the size, segments and document counts of an indexer.Index at index_path.
+    """
+    total_bytes = directory_size(index_path)
+    blob_bytes = directory_size(index.blob_store.path)
+    statistics = index.index.statistics()
+    return {"total_bytes": total_bytes,
+            "segment_bytes": total_bytes - blob_bytes,
+            "blob_bytes": blob_bytes,
+            "segment_count": statistics["segment_count"],
+            "document_count": statistics["document_count"],
+            "deleted_count": statistics["deleted_count"],
+            "generation": index.index.latest_generation()}
+
+
+def merge_segments(index):
+    """
+    Merge all segments of an indexer.Index into one and return True,
+    or return False if another writer, e.g. an ongoing ingest, holds the write lock of the index.
+    """
+    try:
+        index.index.optimize()
+    except LockError:
+        print("the index is locked by another writer, not merging segments", file=sys.stderr)
+        return False
+    return True
+
+
+class MergePolicy:
+    """
+    Decide when all segments of an index should be merged into one.
+    A merge is due when there are more than max_segments segments or when more than max_deleted_ratio of all documents in the segments are deleted.
+    """
+    def __init__(self,
+                 max_segments=settings.HOUSEKEEPING_MAX_SEGMENTS,
+                 max_deleted_ratio=settings.HOUSEKEEPING_MAX_DELETED_RATIO):
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+
+    def needs_merge(self, statistics):
+        if statistics["segment_count"] > self.max_segments:
+            return True
+        all_documents = statistics["document_count"] + statistics["deleted_count"]
+        return all_documents > 0 and statistics["deleted_count"] / all_documents > self.max_deleted_ratio
+
+    def apply(self, index, index_path):
+        """
+        Merge all segments of index if needed and return True if they were merged.
+        """
+        if not self.needs_merge(index_statistics(index, index_path)):
+            return False
+        return merge_segments(index)
+
+
+def live_document_urls(repo_states):
+    return set(indexed_file["url"]
+               for repo_state in repo_states.values()
+               for indexed_file in repo_state["files"].values()
+               if indexed_file["url"])
+
+
+def purge_stale_documents(index, repo_states):
+    """
+    Delete all documents of cloned repos that are not part of the indexed state of any repo, e.g. files of repos that were removed from the repo states.
+    Documents crawled from the Python docs are never purged.
+    Return the amount of deleted documents.
+    """
+    live_urls = live_document_urls(repo_states)
+    stale_urls = [fields['url']
+                  for fields in index.iter_stored_fields()
+                  if "/blob/" in fields['url'] and fields['url'] not in live_urls]
+    if stale_urls:
+        with index.bulk_writer() as writer:
+            for url in stale_urls:
+                writer.delete_document(url)
+    return len(stale_urls)
+
+
+def purge_stale_near_duplicates(index_path, repo_states):
+    """
+    Delete the near-duplicate signatures and aliases of all files that are not part of the indexed state of any repo.
+    Return the amount of deleted signatures and aliases.
+    """
+    path = near_duplicates.database_path(index_path)
+    if not os.path.exists(path):
+        return 0
+    live_urls = live_document_urls(repo_states)
+    live_urls.update(indexed_file["alias_url"]
+                     for repo_state in repo_states.values()
+                     for indexed_file in repo_state["files"].values()
+                     if indexed_file.get("alias_url"))
+    with near_duplicates.NearDuplicateIndex(path) as duplicates:
+        stale_urls = duplicates.urls() - live_urls
+        for url in stale_urls:
+            duplicates.delete(url)
+    return len(stale_urls)
+
+
+def vacuum_blobs(index, min_age=settings.HOUSEKEEPING_BLOB_MIN_AGE):
+    """
+    Delete all blobs that are not referenced by any document in index and return the amount of deleted blobs.
+    Blobs written or reused during the last min_age seconds are kept, since an ongoing ingest might not have committed the documents referencing them yet.
+    """
+    referenced = set(fields.get('content_hash') for fields in index.iter_stored_fields())
+    unreferenced = [key for key in index.blob_store.keys()
+                    if key not in referenced and index.blob_store.age(key) > min_age]
+    for key in unreferenced:
+        index.blob_store.delete(key)
+    return len(unreferenced)
+
+
+def forget_repos(repo_states, keep_repo_names):
+    """
+    Remove the states of all repos not in keep_repo_names, so that their documents become stale.
+    """
+    for repo_name in set(repo_states) - set(keep_repo_names):
+        print("forgetting repo '{}'".format(repo_name))
+        del repo_states[repo_name]
+
+
+def run_housekeeping(index, index_path, optimize=False, purge=False, vacuum=False, keep_repo_names=None, merge_policy=None, freeze_path=None):
+    """
+    Run the housekeeping tasks that were asked for on an index at index_path, opened with profile_index.open_index, and print its statistics.
+    Documents, segments and blobs are purged, merged and vacuumed in the index of every profile of a profile_index.ProfileIndex.
+    Segments are merged only if optimize is True, or if merge_policy is a MergePolicy that finds a merge due.
+    If freeze_path is given, a snapshot of the index is written there after all other tasks.
+    """
+    repo_states = None
+    if purge:
+        repo_states = indexer.load_repo_states(index_path)
+        if keep_repo_names is not None:
+            forget_repos(repo_states, keep_repo_names)
+            indexer.save_repo_states(index_path, repo_states)
+        if not repo_states:
+            print("no repo states found at '{}', not purging".format(index_path), file=sys.stderr)
+        else:
+            print("purged {} stale near-duplicate signatures and aliases".format(purge_stale_near_duplicates(index_path, repo_states)))
+    indexes = profile_index.profile_indexes(index)
+    for profile, subindex in indexes.items():
+        prefix = "" if profile is None else "profile '{}': ".format(profile)
+        if repo_states:
+            try:
+                print(prefix + "purged {} stale documents".format(purge_stale_documents(subindex, repo_states)))
+            except LockError:
+                print(prefix + "the index is locked by another writer, not purging stale documents", file=sys.stderr)
+        if optimize:
+            print(prefix + "merging all segments")
+            if merge_segments(subindex):
+                print(prefix + "merged all segments")
+        elif merge_policy is not None and merge_policy.apply(subindex, subindex.index_path):
+            print(prefix + "merged all segments according to the merge policy")
+        if vacuum:
+            # Vacuum last to also delete the blobs of purged documents
+            print(prefix + "deleted {} unreferenced blobs".format(vacuum_blobs(subindex)))
+    if freeze_path is not None:
+        print("wrote a snapshot to '{}': {}".format(freeze_path, json.dumps(index.freeze(freeze_path))))
+    for profile, subindex in indexes.items():
+        prefix = "" if profile is None else "profile '{}': ".format(profile)
+        print(prefix + json.dumps(index_statistics(subindex, subindex.index_path)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index housekeeping")
+    parser.add_argument("--index-path", default=settings.INDEX_DIRNAME)
+    parser.add_argument("--optimize", action="store_true", help="merge all segments regardless of the merge policy")
+    parser.add_argument("--merge", action="store_true", help="merge all segments if the merge policy finds a merge due")
+    parser.add_argument("--purge", action="store_true", help="delete documents of files and repos that are no longer indexed")
+    parser.add_argument("--repo-data", help="with --purge, also purge repos missing from this repo data json file")
+    parser.add_argument("--vacuum", action="store_true", help="delete blobs not referenced by any document")
+    parser.add_argument("--freeze", nargs="?", const=settings.FROZEN_INDEX_DIRNAME or os.path.join(settings.INDEX_DIRNAME, "frozen"), metavar="PATH",
+                        help="write a read-only snapshot of the index to PATH, by default FROZEN_INDEX_DIRNAME")
+    parser.add_argument("--interval", type=float, help="repeat every INTERVAL seconds")
+    args = parser.parse_args()
+
+    keep_repo_names = None
+    if args.repo_data:
+        with open(args.repo_data) as f:
+            keep_repo_names = [repo['name'] for repo in json.load(f)]
+
+    index = profile_index.open_index(args.index_path)
+    while True:
+        run_housekeeping(index, args.index_path, args.optimize, args.purge, args.vacuum, keep_repo_names,
+                         MergePolicy() if args.merge else None, args.freeze)
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
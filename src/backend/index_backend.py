@@ -0,0 +1,74 @@
+"""
+The interface of the index backends of indexer.Index, implemented by whoosh_index.WhooshIndex and sqlite_index.SQLiteIndex.
+
+A backend module has the functions exists_in(path, name), create_in(path, name, tokenizer_options) and open_in(path, name),
+which return an IndexBackend for the index called name in the directory path.
+
+The writers returned by IndexBackend.writer have the add_document, update_document, delete_by_term, commit and cancel methods
+of whoosh.writing.IndexWriter, where the content field is the list of the subtree tokens of the document.
+The searchers returned by IndexBackend.searcher are context managers with the search_page, doc_frequency, doc_count, doc_count_all,
+all_stored_fields, up_to_date, refresh and close methods of whoosh.searching.Searcher, used by indexer.Index and searcher_pool.SearcherPool.
+"""
+
+
+class IndexBackend:
+    """
+    An index of documents with title, url, content and content_hash fields.
+    """
+    # Name of the backend, as in settings.INDEX_BACKEND
+    name = None
+    # Names of the fields of the documents
+    schema = frozenset()
+
+    def writer(self, **options):
+        """
+        Return a writer holding the write lock of the index until it is committed or cancelled.
+        The options are the whoosh writer options, which backends other than whoosh ignore.
+        """
+        raise NotImplementedError
+
+    def searcher(self):
+        """
+        Return a searcher of the current generation of the index.
+        """
+        raise NotImplementedError
+
+    def suspend_searcher(self, searcher):
+        """
+        Release what an idle searcher of a searcher_pool.SearcherPool holds on to between searches, e.g. a read transaction.
+        """
+
+    def resume_searcher(self, searcher):
+        """
+        Prepare a searcher suspended by suspend_searcher for the next search.
+        """
+
+    def latest_generation(self):
+        """
+        Return the generation of the index, which changes on every commit.
+        """
+        raise NotImplementedError
+
+    def doc_count(self):
+        """
+        Return the amount of documents that have not been deleted.
+        """
+        raise NotImplementedError
+
+    def statistics(self):
+        """
+        Return a dict of the amount of segments, of documents that have not been deleted and of deleted documents still in the segments.
+        """
+        raise NotImplementedError
+
+    def document_frequencies(self):
+        """
+        Return the amount of documents and a dict of the document frequency of every subtree token of the index.
+        """
+        raise NotImplementedError
+
+    def optimize(self):
+        """
+        Reclaim the space of deleted documents, raising whoosh.index.LockError if another writer holds the write lock.
+        """
+        raise NotImplementedError
@@ -1,27 +1,85 @@
 import os.path
 import ast
 import ast_parser
+import blob_store
+import corpus_statistics
+import frozen_index
+import query_planner
 import result_formatter
+import search_results
+import searcher_pool
+import settings
+import sqlite_index
+import whoosh_index
 import itertools
-from whoosh.index import exists_in, create_in, open_dir
-from whoosh.fields import Schema, TEXT, ID
-from whoosh.query import Term, Every
+import json
+import time
 
 
-def create_new_index(path, name, tokenizer_options):
-    if exists_in(path, name):
+# Modules of the index backends by name, see index_backend for the functions and the interface they implement
+BACKENDS = {"whoosh": whoosh_index, "sqlite": sqlite_index}
+
+
+def create_new_index(path, name, tokenizer_options, backend=settings.INDEX_BACKEND):
+    """
+    Create an index at the directory path with the backend of that name in BACKENDS.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown index backend '{}'".format(backend))
+    if any(module.exists_in(path, name) for module in BACKENDS.values()):
         raise RuntimeError("Index already exists at {}".format(path))
-    schema = Schema(
-        title=TEXT(stored=True),
-        url=ID(stored=True, unique=True),
-        content=TEXT(stored=True, analyzer=ast_parser.ASTTokenizer(tokenizer_options))
-    )
     os.mkdir(path)
-    return create_in(path, schema, indexname=name)
+    return BACKENDS[backend].create_in(path, name, tokenizer_options)
+
+
+def blob_store_path(index_path):
+    return os.path.join(index_path, "blobs")
+
+
+def load_repo_states(index_path):
+    """
+    Return the indexed state of all repos in the index at index_path, by repo name.
+    The state of a repo is a dict with the indexed git HEAD hash and a dict of indexed files, with the blob hash and document url of every file.
+    """
+    path = os.path.join(index_path, settings.REPO_STATE_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
 
 
-def all_linenumbers(root):
-    return [node.lineno for node in ast.walk(root) if hasattr(node, "lineno")]
+def load_stopwords(index_path):
+    """
+    Return the set of stopword tokens of the index at index_path, written by stopwords.py, or None if it has no stopwords.
+    """
+    path = os.path.join(index_path, settings.STOPWORDS_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return set(json.load(f)["stopwords"])
+
+
+def save_stopwords(index_path, report):
+    """
+    Save a report dict of stopwords.py with the list of stopword tokens in the stopwords key for the index at index_path.
+    """
+    path = os.path.join(index_path, settings.STOPWORDS_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def save_repo_states(index_path, repo_states):
+    """
+    Save the indexed state of all repos and the corpus statistics computed from them in the index at index_path.
+    """
+    path = os.path.join(index_path, settings.REPO_STATE_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(repo_states, f)
+    os.replace(tmp_path, path)
+    corpus_statistics.save(index_path, corpus_statistics.corpus_statistics(repo_states))
 
 
 def subsequence_increasing_by_one(seq):
@@ -68,96 +126,362 @@ def content_is_valid_code(content):
     return True
 
 
-#TODO incremental indexing and housekeeping
+def tokenize_content(content, tokenizer_options):
+    """
+    Return a dict with the subtree tokens of content and their line ranges, as returned by ast_parser.tokenize_source,
+    and the multi-line strings of content for highlighting, as returned by result_formatter.multiline_string_spans.
+    All are None if content is not valid Python.
+    """
+    try:
+        tokens, line_ranges = ast_parser.tokenize_source(content, **tokenizer_options)
+    except (SyntaxError, ValueError, RecursionError):
+        return {"tokens": None, "line_ranges": None, "string_spans": None}
+    return {"tokens": tokens, "line_ranges": line_ranges, "string_spans": result_formatter.multiline_string_spans(content)}
+
+
 class Index:
-    def __init__(self, index_path, name, tokenizer_options):
-        if not exists_in(index_path, name):
+    """
+    Documents indexed by their subtree tokens in one of the BACKENDS, which implement the interface of index_backend.IndexBackend.
+    """
+    def __init__(self, index_path, name, tokenizer_options, frozen_path=None):
+        """
+        If frozen_path is given, all searches are done in the read-only snapshot at frozen_path, written by frozen_index.freeze.
+        Subtrees with a stopword token of the index are neither indexed nor searched for.
+        """
+        for module in BACKENDS.values():
+            if module.exists_in(index_path, name):
+                self.index = module.open_in(index_path, name)
+                break
+        else:
             raise RuntimeError("There is no index at {}".format(index_path))
-        self.index = open_dir(index_path, name)
+        self.backend = self.index.name
+        self.index_path = index_path
         self.name = name
+        stopwords = load_stopwords(index_path)
+        if stopwords:
+            tokenizer_options = dict(tokenizer_options, drop_tokens=stopwords)
         self.tokenizer_options = tokenizer_options
+        self.blob_store = blob_store.BlobStore(blob_store_path(index_path))
+        self.query_planner = query_planner.QueryPlanner(tokenizer_options)
+        self.frozen = frozen_index.FrozenIndex(frozen_path) if frozen_path else None
+        self.searcher_pool = None
 
     def add_document(self, data):
-        if not content_is_valid_code(data['content']):
-            return False
-        writer = self.index.writer()
-        writer.add_document(title=data['title'], url=data['url'], content=data['content'])
-        writer.commit()
-        return True
+        with self.bulk_writer() as writer:
+            return writer.add_document(data)
 
     def add_documents(self, data):
-        writer = self.index.writer()
-        for code in data['code_snippets']:
-            if not content_is_valid_code(code):
-                continue
-            writer.add_document(title=data['title'], url=data['url'], content=code)
-        writer.commit()
+        with self.bulk_writer() as writer:
+            writer.add_documents(data)
+
+    def bulk_writer(self, **options):
+        """
+        Return a BulkWriter for streaming many documents into the index through a single writer.
+        See BulkWriter for the options.
+        """
+        return BulkWriter(self.index, self.blob_store, self.tokenizer_options, **options)
+
+    def add_many(self, documents, **options):
+        """
+        Add all document dicts with title, url and content keys from the iterable documents using a single BulkWriter.
+        Return the BulkWriter, which contains the counts of added and skipped documents.
+        """
+        with self.bulk_writer(**options) as writer:
+            for data in documents:
+                writer.add_document(data)
+        return writer
 
     def update_documents(self, data):
-        writer = self.index.writer()
-        for code in data['code_snippets']:
-            writer.update_document(title=data['title'], url=data['url'], content=code)
-        writer.commit()
+        with self.bulk_writer(update=True) as writer:
+            writer.add_documents(data)
+
+    def document_content(self, hit):
+        """
+        Return the source code of a search hit or stored fields dict.
+        """
+        if 'content' in hit:
+            # Indexes created before the blob store have the contents as a stored field
+            return hit['content']
+        return self.blob_store.get(hit['content_hash'])
 
     def iter_documents(self):
+        """
+        Yield a hit with the stored fields of every document that has not been deleted.
+        """
+        for fields in self.iter_stored_fields():
+            yield search_results.Hit(fields, 1.0, [])
+
+    def iter_stored_fields(self):
+        """
+        Yield the stored fields dicts of all documents that have not been deleted.
+        """
         with self.index.searcher() as searcher:
-            for result in searcher.search(Every()):
-                yield result
+            yield from searcher.all_stored_fields()
 
     def __len__(self):
-        with self.index.searcher() as searcher:
-            return searcher.doc_count()
+        return self.index.doc_count()
 
-    def parse_query(self, code_query):
-        subtrees = ast_parser.dump(ast.parse(code_query), **self.tokenizer_options)
-        full_tree = next(subtrees)
-        query = Term(u"content", full_tree)
-        for subtree in subtrees:
-            query |= Term(u"content", subtree)
-        return query
+    def generation(self):
+        """
+        Return the generation of the index, which changes on every commit, or the generation of the frozen snapshot that is searched.
+        With a searcher pool, this is the generation the pooled searchers are refreshed to.
+        """
+        if self.frozen is not None:
+            return self.frozen.generation
+        if self.searcher_pool is not None:
+            return self.searcher_pool.generation()
+        return self.index.latest_generation()
 
-    def get_documents(self, code_query):
-        with self.index.searcher() as searcher:
-            for result in searcher.search(self.parse_query(code_query), terms=True):
+    def use_searcher_pool(self, max_size=settings.SEARCHER_POOL_SIZE, refresh_interval=settings.SEARCHER_REFRESH_INTERVAL):
+        """
+        Reuse open searchers in all searches, picking up new commits within refresh_interval seconds, see searcher_pool.SearcherPool.
+        """
+        self.searcher_pool = searcher_pool.SearcherPool(self.index, max_size, refresh_interval)
+
+    def freeze(self, path):
+        """
+        Write a read-only snapshot of the current generation of the index to path, see frozen_index.freeze.
+        """
+        return frozen_index.freeze(self, path)
+
+    def query_key(self, code_query):
+        """
+        Return the set of subtree tokens of code_query, which is equal for all queries with the same search results.
+        """
+        return frozenset(ast_parser.dump(ast.parse(code_query), **self.tokenizer_options))
+
+    def parse_query(self, code_query, searcher=None):
+        """
+        Return a query of the subtree tokens of code_query chosen by the query planner from the document frequencies seen by searcher.
+        """
+        if searcher is None:
+            with self.searcher() as searcher:
+                return self.parse_query(code_query, searcher)
+        return self.query_planner.query(code_query, searcher)
+
+    def get_documents(self, code_query, page=1, page_size=settings.SEARCH_RESULTS_PER_PAGE):
+        with self.searcher() as searcher:
+            for result in searcher.search_page(self.parse_query(code_query, searcher), page, pagelen=page_size, terms=True):
                 yield result
 
-    def get_similar_snippets(self, code):
-        for hit in self.get_documents(code):
+    def searcher(self):
+        """
+        Return a new searcher of the current generation of the index, to share between several calls to get_similar_snippets.
+        Use the searcher as a context manager, which closes it or gives it back to the searcher pool.
+        If the index was opened with a frozen snapshot, the snapshot is returned instead.
+        """
+        if self.frozen is not None:
+            return self.frozen.searcher()
+        if self.searcher_pool is not None:
+            return self.searcher_pool.searcher()
+        return self.index.searcher()
+
+    def get_similar_snippets(self, code, page=1, page_size=settings.SEARCH_RESULTS_PER_PAGE, searcher=None):
+        """
+        Return the total amount of documents matching code and a list of dicts of the metadata of matching documents on page.
+        The whoosh backend estimates the total if there are more matching documents than on the pages up to page, see whoosh_index.WhooshSearcher.
+        Highlighting is expensive, so it is left for highlight_snippet to do for only those results that will be rendered.
+        If searcher is None, a new searcher is opened and closed for this query only.
+        """
+        if searcher is None:
+            with self.searcher() as searcher:
+                return self.get_similar_snippets(code, page, page_size, searcher)
+        results = searcher.search_page(self.parse_query(code, searcher), page, pagelen=page_size, terms=True)
+        snippets = []
+        if results.pagenum != page:
+            # whoosh returns the last page for pages past the end
+            return results.total, snippets
+        for hit in results:
             is_python_docs = "docs.python.org" in hit['url']
             if is_python_docs:
                 repo, filename = "Python Docs", hit['title']
             else:
-                repo, filename = tuple(hit['title'].split(" "))
-            data = {'title': {'repo': repo, 'filename': filename},
-                    'url': hit['url']}
-            matched_tokens = set(pair[1]
-                                 for pair in hit.matched_terms()
-                                 if pair[0] == 'content')
-            data['matched_tokens_count'] = len(matched_tokens)
-            data['source_html_highlighted'], highlighted_lines = self.highlight_matches(hit['content'], matched_tokens)
-            if not is_python_docs:
-                first_highlighted_range = subsequence_increasing_by_one(highlighted_lines)
-                if len(first_highlighted_range) == 1:
-                    data['url'] += "#L{}".format(first_highlighted_range[0])
-                else:
-                    data['url'] += "#L{}-L{}".format(first_highlighted_range[0], first_highlighted_range[-1])
-            yield data
+                repo, _, filename = hit['title'].partition(" ")
+            matched_tokens = sorted(set(pair[1].decode()
+                                        for pair in hit.matched_terms()
+                                        if pair[0] == 'content'))
+            snippets.append({'title': {'repo': repo, 'filename': filename},
+                             'url': hit['url'],
+                             'is_python_docs': is_python_docs,
+                             'score': hit.score,
+                             'matched_tokens_count': len(matched_tokens),
+                             'matched_tokens': matched_tokens,
+                             'document': hit.fields()})
+        return results.total, snippets
 
+    def snippet_metadata(self, snippet):
+        """
+        Return a copy of a snippet dict from get_similar_snippets without the fields used only for highlighting.
+        """
+        return {key: value for key, value in snippet.items() if key not in ('matched_tokens', 'document')}
 
-    # TODO: implement a custom lexer to highlight matching tokens instead of the whole line containing a matching token
-    # TODO: make the use the line_numbers more consistent
-    def highlight_matches(self, code, matched_tokens):
+    def highlight_snippet(self, snippet):
+        """
+        Return a copy of a snippet dict from get_similar_snippets with the highlighted source code and the url pointing to the first highlighted lines.
+        """
+        return self.highlight_snippet_lines(snippet, self.matched_lines(snippet['document'], snippet['matched_tokens']))
+
+    def highlight_snippet_lines(self, snippet, line_numbers):
+        """
+        Like highlight_snippet, but highlight line_numbers instead of the lines of the matched tokens of snippet.
+        """
+        data = self.snippet_metadata(snippet)
+        data['source_html_highlighted'], highlighted_lines = self.highlight_lines(snippet['document'], line_numbers)
+        if not snippet['is_python_docs'] and highlighted_lines:
+            first_highlighted_range = subsequence_increasing_by_one(highlighted_lines)
+            if len(first_highlighted_range) == 1:
+                data['url'] += "#L{}".format(first_highlighted_range[0])
+            else:
+                data['url'] += "#L{}-L{}".format(first_highlighted_range[0], first_highlighted_range[-1])
+        return data
+
+    def line_ranges(self, hit, code):
+        """
+        Return the dict of subtree tokens to line ranges of a search hit, computed at ingest time if possible.
+        """
+        line_ranges = None
+        if 'content_hash' in hit:
+            line_ranges = self.blob_store.get_line_ranges(hit['content_hash'])
+        if line_ranges is None:
+            _, line_ranges = ast_parser.tokenize_source(code, **self.tokenizer_options)
+        return line_ranges
+
+    def matched_lines(self, hit, matched_tokens, code=None):
+        """
+        Return the set of line numbers covered by the subtrees of the document of hit that have a token in matched_tokens.
+        """
+        if code is None:
+            code = self.document_content(hit)
+        line_ranges = self.line_ranges(hit, code)
         line_numbers = set()
-        # TODO: when found a matching subtree, don't traverse its children
-        for node in ast.walk(ast.parse(code)):
-            dumps = ast_parser.dump(node, **self.tokenizer_options)
-            node_dump = next(dumps, '').encode()
-            if node_dump in matched_tokens:
-                line_numbers |= set(all_linenumbers(node))
+        for token in matched_tokens:
+            for first, last in line_ranges.get(token, ()):
+                line_numbers.update(range(first, last + 1))
+        return line_numbers
+
+    # TODO: implement a custom lexer to highlight matching tokens instead of the whole line containing a matching token
+    def highlight_lines(self, hit, line_numbers, code=None):
+        if code is None:
+            code = self.document_content(hit)
         # Drop scattered matches from the beginning if there is a
         # larger chunk match in the middle
         line_numbers = sorted(line_numbers)
-        line_numbers = line_numbers[LIS_by_one_starting_index(line_numbers):]
-        return result_formatter.html_highlight(code, line_numbers), line_numbers
+        if line_numbers:
+            line_numbers = line_numbers[LIS_by_one_starting_index(line_numbers):]
+        string_spans = None
+        if 'content_hash' in hit:
+            string_spans = self.blob_store.get_string_spans(hit['content_hash'])
+        return result_formatter.html_highlight(code, line_numbers, hit.get('content_hash'), string_spans), line_numbers
+
+    def highlight_matches(self, hit, matched_tokens):
+        code = self.document_content(hit)
+        return self.highlight_lines(hit, self.matched_lines(hit, matched_tokens, code), code)
+
+
+class BulkWriter:
+    """
+    Add documents to the backend of an Index through one writer, committing every commit_every documents or commit_mb megabytes of source code.
+    The documents are tokenized before they are added, e.g. by parallel_tokenizer.TokenizerPool, so the writer only buffers their postings,
+    using at most limitmb megabytes in the whoosh backend before writing them to a new segment.
+    If update is True, existing documents with the same url are replaced.
+    Source code and the line ranges of its subtree tokens are written into blob_store, unless the index is old enough to store the code in the content field.
+    Use as a context manager to commit the remaining documents on exit.
+    """
+    def __init__(self, index, blob_store, tokenizer_options,
+                 update=False,
+                 commit_every=settings.BULK_COMMIT_DOCUMENTS,
+                 commit_mb=settings.BULK_COMMIT_MB,
+                 limitmb=settings.INDEX_WRITER_LIMIT_MB):
+        self.index = index
+        self.blob_store = blob_store
+        self.tokenizer_options = tokenizer_options
+        self.update = update
+        self.stores_content_hash = "content_hash" in index.schema
+        self.commit_every = commit_every
+        self.commit_bytes = int(commit_mb * 1e6)
+        self.writer_options = {"limitmb": limitmb}
+        self.writer = None
+        self.pending_count = self.pending_bytes = 0
+        self.added_count = self.skipped_count = self.commit_count = 0
+        self.start_time = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        elif self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+
+    def add_document(self, data):
+        """
+        Add a document dict with title, url and content keys and return True, or False if the content is not valid Python.
+        """
+        return self.add_tokenized(dict(data, **tokenize_content(data['content'], self.tokenizer_options)))
+
+    def add_documents(self, data):
+        """
+        Add every valid code snippet in a crawled section dict with title, url and code_snippets keys.
+        """
+        for code in data['code_snippets']:
+            self.add_document({"title": data['title'], "url": data['url'], "content": code})
+
+    def add_tokenized(self, data):
+        """
+        Add a document dict with title, url, content, tokens, line_ranges and string_spans keys, as returned by tokenize_content.
+        The tokens must have been produced with the tokenizer options of the index, e.g. by parallel_tokenizer.TokenizerPool.
+        Return False if tokens is None, i.e. the content could not be parsed.
+        """
+        if data['tokens'] is None:
+            self.skipped_count += 1
+            return False
+        self._add(data['title'], data['url'], data['content'], data['tokens'], data.get('line_ranges'), data.get('string_spans'))
+        return True
+
+    def delete_document(self, url):
+        """
+        Delete the document with url from the index.
+        """
+        if self.writer is None:
+            self.writer = self.index.writer(**self.writer_options)
+        self.writer.delete_by_term("url", url)
+
+    def _add(self, title, url, content, tokens, line_ranges=None, string_spans=None):
+        if self.writer is None:
+            self.writer = self.index.writer(**self.writer_options)
+        # whoosh indexes a list value as is, without running the analyzer
+        fields = {"title": title, "url": url, "content": tokens}
+        if self.stores_content_hash:
+            fields["content_hash"] = self.blob_store.put(content)
+            if line_ranges is not None:
+                self.blob_store.put_line_ranges(fields["content_hash"], line_ranges)
+            if string_spans is not None:
+                self.blob_store.put_string_spans(fields["content_hash"], string_spans)
+        else:
+            fields["_stored_content"] = content
+        if self.update:
+            self.writer.update_document(**fields)
+        else:
+            self.writer.add_document(**fields)
+        self.added_count += 1
+        self.pending_count += 1
+        self.pending_bytes += len(content)
+        if self.pending_count >= self.commit_every or self.pending_bytes >= self.commit_bytes:
+            self.commit()
+
+    def commit(self):
+        if self.writer is None:
+            return
+        self.writer.commit()
+        self.writer = None
+        self.pending_count = self.pending_bytes = 0
+        self.commit_count += 1
 
+    def docs_per_second(self):
+        return self.added_count / max(time.perf_counter() - self.start_time, 1e-9)
 
+    def report(self):
+        return "{} documents added, {} skipped, {} commits, {:.1f} docs/s".format(
+            self.added_count, self.skipped_count, self.commit_count, self.docs_per_second())
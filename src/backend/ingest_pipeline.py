@@ -0,0 +1,156 @@
+"""
+Clone, index and delete repos in one pipeline, so that the indexer works on cloned repos while the next ones are being cloned,
+and only the checkouts that have not been indexed yet take up disk space.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import os
+import shutil
+import time
+import housekeeping
+import repo_cloner
+import settings
+
+
+class StopPipeline(Exception):
+    """
+    Raised by the index function of run_pipeline to stop cloning and indexing, e.g. when the index is full.
+    """
+    pass
+
+
+class CloneSlots:
+    """
+    Async context manager for limiting the clones running at the same time to concurrency,
+    and starting a clone only while the checkouts that are cloned but not yet indexed take up less than max_bytes.
+    The first clone always starts, so a single checkout larger than max_bytes does not stop the pipeline.
+    """
+    def __init__(self, concurrency, max_bytes):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.used_bytes == 0 or self.used_bytes < self.max_bytes)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+    async def add(self, size):
+        async with self.condition:
+            self.used_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+
+    async def remove(self, size):
+        async with self.condition:
+            self.used_bytes -= size
+            self.condition.notify_all()
+
+
+async def run_pipeline_async(repos, destination, index_repo,
+                             max_bytes=settings.INGEST_DISK_BUDGET_MB * 2 ** 20,
+                             concurrency=settings.CLONE_CONCURRENCY,
+                             **clone_options):
+    """
+    Clone every repo dict with name and clone_url keys into destination with repo_cloner, while index_repo(repo, path) indexes the cloned repos one at a time in a worker thread.
+    Every checkout is deleted after it is indexed. Repos already in destination, e.g. after an interrupted run, are indexed without cloning them,
+    and are kept if the pipeline stops before indexing them.
+    If index_repo raises StopPipeline, the remaining repos are neither cloned nor indexed, and stopped is True in the returned statistics.
+    If it raises another exception, the repo counts as failed to index and the pipeline goes on with the next repo.
+    Return a dict of the amount of indexed repos, of repos that failed to clone and to index, the wall time,
+    the total time spent cloning and indexing and the peak size of the checkouts waiting to be indexed.
+    """
+    loop = asyncio.get_running_loop()
+    slots = CloneSlots(concurrency, max_bytes)
+    cloned = asyncio.Queue()
+    statistics = {"indexed": 0, "failed": 0, "index_failed": 0, "seconds": 0.0, "clone_seconds": 0.0, "index_seconds": 0.0, "peak_bytes": 0, "stopped": False}
+    start_time = time.perf_counter()
+
+    async def clone(repo):
+        path = os.path.join(destination, repo["name"])
+        if os.path.exists(path):
+            print("not cloning into existing '{}'".format(path))
+            await cloned.put((repo, path, {"ok": True, "seconds": 0.0}, 0, False))
+            return
+        clone_start_time = time.perf_counter()
+        try:
+            # Keep the slot until the checkout is counted, so that the next clone sees its size
+            async with slots:
+                result = await repo_cloner.clone_with_retries(repo["name"], repo["clone_url"], path, contextlib.nullcontext(), **clone_options)
+                size = await loop.run_in_executor(None, housekeeping.directory_size, path) if result["ok"] else 0
+                await slots.add(size)
+        except asyncio.CancelledError:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        except Exception as error:
+            # Every clone must put a result, since the indexing loop waits for one result per repo
+            print("failed to clone '{}': {!r}".format(repo["name"], error))
+            shutil.rmtree(path, ignore_errors=True)
+            result = {"ok": False, "seconds": time.perf_counter() - clone_start_time, "error": str(error)}
+            size = 0
+        await cloned.put((repo, path, result, size, True))
+
+    def index_and_delete(repo, path, cloned_here):
+        index_start_time = time.perf_counter()
+        indexed = False
+        try:
+            index_repo(repo, path)
+            indexed = True
+        finally:
+            # Checkouts that were not cloned by this run are deleted only once they are indexed
+            if indexed or cloned_here:
+                print("removing cloned repo at '{}'".format(path))
+                shutil.rmtree(path, ignore_errors=True)
+        return time.perf_counter() - index_start_time
+
+    clones = [asyncio.ensure_future(clone(repo)) for repo in repos]
+    # The index is written by one thread at a time
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        try:
+            for _ in clones:
+                repo, path, result, size, cloned_here = await cloned.get()
+                statistics["clone_seconds"] += result["seconds"]
+                if result["ok"]:
+                    try:
+                        statistics["index_seconds"] += await loop.run_in_executor(executor, index_and_delete, repo, path, cloned_here)
+                    except StopPipeline as stop:
+                        print("stopping the pipeline: {}".format(stop))
+                        statistics["stopped"] = True
+                        break
+                    except Exception as error:
+                        print("failed to index '{}': {!r}".format(repo["name"], error))
+                        statistics["index_failed"] += 1
+                    else:
+                        statistics["indexed"] += 1
+                else:
+                    statistics["failed"] += 1
+                await slots.remove(size)
+        finally:
+            for task in clones:
+                task.cancel()
+            await asyncio.gather(*clones, return_exceptions=True)
+            # Delete the checkouts that were cloned by this run but not indexed
+            while not cloned.empty():
+                _, path, _, _, cloned_here = cloned.get_nowait()
+                if cloned_here:
+                    shutil.rmtree(path, ignore_errors=True)
+    statistics["seconds"] = time.perf_counter() - start_time
+    statistics["peak_bytes"] = slots.peak_bytes
+    return statistics
+
+
+def run_pipeline(repos, destination, index_repo, **options):
+    """
+    Run run_pipeline_async in a new event loop and return its statistics.
+    """
+    return asyncio.run(run_pipeline_async(repos, destination, index_repo, **options))
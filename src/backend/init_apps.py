@@ -1,15 +1,25 @@
 import flask
 import settings
-import indexer
+import profile_index
+import query_cache
 
 def make_flask(name):
     return flask.Flask(name)
 
 def load_index():
-    return indexer.Index(
+    index = profile_index.open_index(
         settings.INDEX_DIRNAME,
         settings.INDEX_NAME,
-        settings.TOKENIZER_OPTIONS
+        settings.FROZEN_INDEX_DIRNAME
     )
+    index.use_searcher_pool(
+        settings.SEARCHER_POOL_SIZE,
+        settings.SEARCHER_REFRESH_INTERVAL
+    )
+    return index
 
-
+def make_result_cache():
+    return query_cache.QueryCache(
+        settings.RESULT_CACHE_SIZE,
+        settings.RESULT_CACHE_TTL
+    )
@@ -1,10 +1,14 @@
 import flask
+import corpus_statistics
 import init_apps
 import json
+import math
+import settings
 
 
 flask_app = init_apps.make_flask(__name__)
 index = init_apps.load_index()
+result_cache = init_apps.make_result_cache()
 
 
 @flask_app.route("/")
@@ -12,26 +16,135 @@ def root():
     return flask.render_template("index.html", is_index_page=True)
 
 
+def positive_int(value, default, maximum=None):
+    """
+    Return value as a positive integer no larger than maximum, or default if it is not a positive integer.
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    if value < 1:
+        return default
+    if maximum is not None:
+        return min(value, maximum)
+    return value
+
+
+def int_argument(name, default, maximum=None):
+    """
+    Return the positive integer query string argument name, or default if it is missing or invalid.
+    """
+    return positive_int(flask.request.args.get(name, default), default, maximum)
+
+
 @flask_app.route("/parse")
 def parse():
     render_context = dict()
     try:
         raw_text = flask.request.args.get("spaghetti").lstrip()
         render_context["previous_input"] = raw_text
-        similar_snippets = list(index.get_similar_snippets(raw_text))
+        page = int_argument("page", 1, settings.MAX_SEARCH_PAGE)
+        page_size = int_argument("page_size", settings.SEARCH_RESULTS_PER_PAGE, settings.MAX_SEARCH_RESULTS_PER_PAGE)
+        def search(page):
+            def compute():
+                total, snippets = index.get_similar_snippets(raw_text, page, page_size)
+                return total, [index.highlight_snippet(snippet) for snippet in snippets]
+            return result_cache.get_or_compute(
+                (index.query_key(raw_text), page, page_size),
+                index.generation(),
+                compute)
+        total, similar_snippets = search(page)
+        last_page = max(1, math.ceil(total / page_size))
+        if page > last_page:
+            # Show the last page instead of an empty page past the end, e.g. a link to a page of an older generation of the index
+            page = last_page
+            total, similar_snippets = search(page)
         render_context["similar"] = similar_snippets
         render_context["has_results"] = len(similar_snippets) > 0
+        render_context["total_results"] = total
+        render_context["page"] = page
+        render_context["page_size"] = page_size
+        render_context["has_next_page"] = page * page_size < total
     except SyntaxError as syntax_error:
         render_context["errors"] = str(syntax_error)
+    except (RecursionError, MemoryError):
+        render_context["errors"] = "code is nested too deeply"
     if flask.request.args.get("hasJavascript"):
         return json.dumps(render_context)
     return flask.render_template("index.html", **render_context)
 
 
+def search_results_lines(queries, default_limit, default_highlight):
+    """
+    Yield one line of JSON with the search results of each query, as soon as the results are ready.
+    All queries share one searcher, so they are all answered from the same generation of the index.
+    """
+    with index.searcher() as searcher:
+        for i, query in enumerate(queries):
+            if not isinstance(query, dict):
+                query = {"code": query}
+            line = {"id": query.get("id", i)}
+            code = query.get("code")
+            if not isinstance(code, str):
+                line["error"] = "code must be a string"
+                yield json.dumps(line) + "\n"
+                continue
+            limit = positive_int(query.get("limit"), default_limit, settings.MAX_SEARCH_RESULTS_PER_PAGE)
+            page = positive_int(query.get("page"), 1, settings.MAX_SEARCH_PAGE)
+            try:
+                total, snippets = index.get_similar_snippets(code.lstrip(), page, limit, searcher)
+                if query.get("highlight", default_highlight):
+                    line["results"] = [index.highlight_snippet(snippet) for snippet in snippets]
+                else:
+                    line["results"] = [index.snippet_metadata(snippet) for snippet in snippets]
+                line["total_results"] = total
+                line["page"] = page
+            except (SyntaxError, ValueError) as error:
+                line["error"] = str(error)
+            except (RecursionError, MemoryError):
+                # Raised by the parser and the tokenizer for too deeply nested code
+                line["error"] = "code is nested too deeply"
+            yield json.dumps(line) + "\n"
+
+
+@flask_app.route("/api/search", methods=["POST"])
+def api_search():
+    """
+    Search with many snippets in one request.
+    The request body is a JSON object with a list of queries, each either a string of code or an object with the keys:
+    code, and optionally id, limit (amount of results), page (at most settings.MAX_SEARCH_PAGE) and highlight (include highlighted html of the results).
+    The default limit and highlight of all queries can be given as keys of the request body.
+    The response is newline delimited JSON with one object per query, in the same order as the queries.
+    """
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("queries"), list):
+        return flask.jsonify(error="request body must be a JSON object with a list of queries"), 400
+    queries = body["queries"]
+    if len(queries) > settings.MAX_API_SEARCH_QUERIES:
+        return flask.jsonify(error="at most {} queries per request".format(settings.MAX_API_SEARCH_QUERIES)), 400
+    default_limit = positive_int(body.get("limit"), settings.API_SEARCH_RESULTS_PER_QUERY, settings.MAX_SEARCH_RESULTS_PER_PAGE)
+    lines = search_results_lines(queries, default_limit, bool(body.get("highlight", False)))
+    return flask.Response(flask.stream_with_context(lines), mimetype="application/x-ndjson")
+
+
+@flask_app.route("/cache")
+def cache():
+    statistics = result_cache.statistics()
+    if index.searcher_pool is not None:
+        statistics["searchers"] = index.searcher_pool.statistics()
+    return json.dumps(statistics)
+
+
 @flask_app.route("/about")
 def about():
-    with flask_app.open_resource("cloned_meta.json", "r") as f:
-        render_context = json.load(f)
+    statistics = corpus_statistics.load(settings.INDEX_DIRNAME)
+    if statistics is None:
+        # Indexes built before the statistics were saved with the index
+        with flask_app.open_resource("cloned_meta.json", "r") as f:
+            render_context = json.load(f)
+    else:
+        render_context = dict(statistics, python_line_count=statistics["line_count"])
     return flask.render_template("about.html", **render_context)
 
 
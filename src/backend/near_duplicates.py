@@ -0,0 +1,204 @@
+"""
+Find files that are near-duplicates of already indexed files, such as vendored or copy-pasted modules,
+by the MinHash signatures of their sets of subtree tokens and locality-sensitive hashing of the signatures.
+"""
+import hashlib
+import os
+import sqlite3
+import numpy
+import ast_parser
+import settings
+
+
+FILENAME = "near_duplicates.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parameters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS signatures (
+    url TEXT PRIMARY KEY,
+    -- MinHash signature as an array of unsigned 64-bit integers
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS buckets_band_bucket ON buckets (band, bucket);
+CREATE INDEX IF NOT EXISTS buckets_url ON buckets (url);
+CREATE TABLE IF NOT EXISTS aliases (
+    url TEXT PRIMARY KEY,
+    canonical_url TEXT NOT NULL,
+    similarity REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_canonical_url ON aliases (canonical_url);
+"""
+
+def database_path(index_path):
+    return os.path.join(index_path, FILENAME)
+
+
+def mix64(values):
+    """
+    The splitmix64 finalizer, a bijection of 64-bit integers that spreads every input bit over all output bits.
+    """
+    values = values ^ (values >> numpy.uint64(30))
+    values = values * numpy.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> numpy.uint64(27))
+    values = values * numpy.uint64(0x94d049bb133111eb)
+    return values ^ (values >> numpy.uint64(31))
+
+
+def permutation_seeds(num_perm):
+    return mix64(numpy.arange(1, num_perm + 1, dtype=numpy.uint64))
+
+
+def minhash(tokens, num_perm, hash_tokens):
+    """
+    Return the MinHash signature of the set of tokens, the minimum of num_perm different hash functions over all tokens.
+    Hashed tokens are used as 64-bit integers as is, string tokens are hashed first.
+    """
+    if hash_tokens:
+        ids = [int(token, 16) for token in set(tokens)]
+    else:
+        ids = [int(ast_parser.weak_hash(token), 16) for token in set(tokens)]
+    ids = numpy.array(ids, dtype=numpy.uint64)
+    with numpy.errstate(over="ignore"):
+        return mix64(ids[numpy.newaxis, :] ^ permutation_seeds(num_perm)[:, numpy.newaxis]).min(axis=1)
+
+
+def similarity(signature, other_signature):
+    """
+    Return the estimated Jaccard similarity of the token sets of two signatures.
+    """
+    return float(numpy.mean(signature == other_signature))
+
+
+def band_buckets(signature, bands):
+    """
+    Yield pairs of every band number and the bucket of signature in that band as a signed 64-bit integer.
+    """
+    for band, rows in enumerate(numpy.split(signature, bands)):
+        yield band, int.from_bytes(hashlib.blake2b(rows.tobytes(), digest_size=8).digest(), "little", signed=True)
+
+
+class NearDuplicateIndex:
+    """
+    LSH table of the MinHash signatures of indexed documents by url, and the aliases of the documents that were skipped as their near-duplicates, in an SQLite database.
+    Documents with a signature equal to that of an indexed document in all rows of at least one of bands bands are candidates,
+    and a candidate is a near-duplicate if the estimated similarity of the signatures is at least threshold.
+    Documents with fewer than min_tokens distinct tokens are never near-duplicates, since small files are often equal by chance.
+    Changes are visible right away but only saved by commit.
+    """
+    def __init__(self, path,
+                 hash_tokens=True,
+                 threshold=settings.NEAR_DUPLICATE_THRESHOLD,
+                 num_perm=settings.NEAR_DUPLICATE_NUM_PERM,
+                 bands=settings.NEAR_DUPLICATE_BANDS,
+                 min_tokens=settings.NEAR_DUPLICATE_MIN_TOKENS):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.path = path
+        self.hash_tokens = hash_tokens
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.min_tokens = min_tokens
+        # Used by one thread at a time, but not necessarily the thread that opened it
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO parameters VALUES (?, ?)",
+            (("num_perm", num_perm), ("bands", bands)))
+        parameters = dict(self.connection.execute("SELECT name, value FROM parameters"))
+        if (parameters["num_perm"], parameters["bands"]) != (num_perm, bands):
+            raise ValueError("the signatures at {} were computed with num_perm={num_perm} and bands={bands}".format(path, **parameters))
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commit()
+        self.close()
+
+    def signature(self, tokens):
+        """
+        Return the MinHash signature of subtree tokens, or None if they have too few distinct tokens to compare.
+        """
+        tokens = set(tokens)
+        if not tokens or len(tokens) < self.min_tokens:
+            return None
+        return minhash(tokens, self.num_perm, self.hash_tokens)
+
+    def find(self, url, signature):
+        """
+        Return the url of the most similar indexed document of which the document with signature is a near-duplicate and their similarity,
+        or (None, 0.0) if there is no such document.
+        A document is not a near-duplicate of a previous version with the same url.
+        """
+        candidates = set()
+        for band, bucket in band_buckets(signature, self.bands):
+            candidates.update(row[0] for row in self.connection.execute(
+                "SELECT url FROM buckets WHERE band = ? AND bucket = ?", (band, bucket)))
+        candidates.discard(url)
+        best_url, best_similarity = None, 0.0
+        for candidate in sorted(candidates):
+            signature_bytes, = self.connection.execute("SELECT signature FROM signatures WHERE url = ?", (candidate, )).fetchone()
+            candidate_similarity = similarity(signature, numpy.frombuffer(signature_bytes, dtype=numpy.uint64))
+            if candidate_similarity >= self.threshold and candidate_similarity > best_similarity:
+                best_url, best_similarity = candidate, candidate_similarity
+        return best_url, best_similarity
+
+    def add(self, url, signature):
+        """
+        Add the signature of the indexed document with url, replacing any previous signature of url.
+        """
+        self.delete(url)
+        self.connection.execute("INSERT INTO signatures VALUES (?, ?)", (url, signature.tobytes()))
+        self.connection.executemany(
+            "INSERT INTO buckets VALUES (?, ?, ?)",
+            ((band, bucket, url) for band, bucket in band_buckets(signature, self.bands)))
+
+    def add_alias(self, url, canonical_url, similarity):
+        """
+        Record that the document with url was skipped as a near-duplicate of the indexed document with canonical_url.
+        """
+        self.delete(url)
+        self.connection.execute("INSERT INTO aliases VALUES (?, ?, ?)", (url, canonical_url, similarity))
+
+    def delete(self, url):
+        """
+        Delete the signature or alias of url.
+        The aliases of url are kept, but the documents they were skipped for are no longer searchable.
+        """
+        self.connection.execute("DELETE FROM signatures WHERE url = ?", (url, ))
+        self.connection.execute("DELETE FROM buckets WHERE url = ?", (url, ))
+        self.connection.execute("DELETE FROM aliases WHERE url = ?", (url, ))
+
+    def aliases(self, canonical_url):
+        """
+        Return the list of urls of the documents that were skipped as near-duplicates of canonical_url.
+        """
+        return [row[0] for row in self.connection.execute(
+            "SELECT url FROM aliases WHERE canonical_url = ? ORDER BY url", (canonical_url, ))]
+
+    def urls(self):
+        """
+        Return the set of urls of all signatures and aliases.
+        """
+        return set(row[0] for row in self.connection.execute("SELECT url FROM signatures UNION SELECT url FROM aliases"))
+
+    def statistics(self):
+        signature_count, = self.connection.execute("SELECT COUNT(*) FROM signatures").fetchone()
+        alias_count, canonical_count = self.connection.execute("SELECT COUNT(*), COUNT(DISTINCT canonical_url) FROM aliases").fetchone()
+        return {"signatures": signature_count, "aliases": alias_count, "canonical_documents": canonical_count}
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
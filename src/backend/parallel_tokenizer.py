@@ -0,0 +1,76 @@
+"""
+Read, validate and tokenize source files in a pool of worker processes, while the indexing process consumes the results.
+"""
+import concurrent.futures
+import os
+import indexer
+
+
+# Tokenize function and tokenizer options of the worker process, set once by the pool initializer
+_worker_tokenize = None
+_worker_tokenizer_options = None
+
+
+def _init_worker(tokenize, tokenizer_options):
+    global _worker_tokenize, _worker_tokenizer_options
+    _worker_tokenize = tokenize
+    _worker_tokenizer_options = tokenizer_options
+
+
+def read_and_tokenize(job, tokenizer_options, tokenize=indexer.tokenize_content):
+    """
+    Read the file at job['path'] and return job as a document dict with its content, subtree tokens and their line ranges.
+    The tokens are None if the file could not be read or does not contain valid Python.
+    The tokens are computed with tokenize(content, tokenizer_options), which returns a dict of the keys to add to the document dict.
+    """
+    document = {key: value for key, value in job.items() if key != 'path'}
+    try:
+        with open(job['path']) as f:
+            document['content'] = f.read()
+    except (OSError, UnicodeDecodeError):
+        document.update(content=None, tokens=None, line_ranges=None, string_spans=None)
+        return document
+    document.update(tokenize(document['content'], tokenizer_options))
+    return document
+
+
+def _worker_read_and_tokenize(job):
+    return read_and_tokenize(job, _worker_tokenizer_options, _worker_tokenize)
+
+
+class TokenizerPool:
+    """
+    Pool of processes that turn jobs, i.e. dicts with a path key and any other document fields, into tokenized document dicts.
+    At most max_pending jobs are in flight at any time, so a slow consumer pauses the reading of new jobs.
+    tokenize must be a module level function, such as indexer.tokenize_content or profile_index.tokenize_profiles.
+    """
+    def __init__(self, tokenizer_options, processes=None, max_pending=None, tokenize=indexer.tokenize_content):
+        self.processes = processes or os.cpu_count()
+        self.max_pending = max_pending or 4 * self.processes
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.processes,
+            initializer=_init_worker,
+            initargs=(tokenize, tokenizer_options))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def tokenize(self, jobs):
+        """
+        Yield tokenized document dicts for all jobs, in the order they complete.
+        """
+        pending = set()
+        for job in jobs:
+            if len(pending) >= self.max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(self.executor.submit(_worker_read_and_tokenize, job))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
@@ -0,0 +1,243 @@
+"""
+Search several indexes of the same documents, each tokenized with a different named token profile, and merge their results.
+For example, one profile can keep names and shallow subtrees for matching scattered lines while another keeps only tall, name-free subtrees for matching larger constructs.
+"""
+import concurrent.futures
+import contextlib
+import os
+import indexer
+import settings
+
+
+def profile_path(index_path, profile):
+    return os.path.join(index_path, profile)
+
+
+def create_new_index(index_path, name, profiles, backend=settings.INDEX_BACKEND):
+    """
+    Create an index for every profile in the dict profiles, see settings.TOKEN_PROFILES, in subdirectories of index_path.
+    """
+    if os.path.exists(index_path):
+        raise RuntimeError("Index already exists at {}".format(index_path))
+    os.mkdir(index_path)
+    for profile, options in profiles.items():
+        indexer.create_new_index(profile_path(index_path, profile), name, options["tokenizer_options"], backend)
+
+
+def create_index(index_path, name=settings.INDEX_NAME, backend=settings.INDEX_BACKEND):
+    """
+    Create an index at index_path for opening with open_index, with an index for every profile if settings.TOKEN_PROFILES is set.
+    """
+    if settings.TOKEN_PROFILES:
+        create_new_index(index_path, name, settings.TOKEN_PROFILES, backend)
+    else:
+        indexer.create_new_index(index_path, name, settings.TOKENIZER_OPTIONS, backend)
+
+
+def open_index(index_path, name=settings.INDEX_NAME, frozen_path=None):
+    """
+    Return a ProfileIndex of the index at index_path if settings.TOKEN_PROFILES is set, otherwise an indexer.Index with settings.TOKENIZER_OPTIONS.
+    All scripts and the web app open the index with this function, so that they agree on its layout.
+    """
+    if settings.TOKEN_PROFILES:
+        return ProfileIndex(index_path, name, settings.TOKEN_PROFILES, frozen_path)
+    return indexer.Index(index_path, name, settings.TOKENIZER_OPTIONS, frozen_path)
+
+
+def profile_indexes(index):
+    """
+    Return a dict of the indexer.Index of every profile of a ProfileIndex by profile name, or {None: index} for an indexer.Index.
+    """
+    if isinstance(index, ProfileIndex):
+        return dict(index.indexes)
+    return {None: index}
+
+
+def tokenize_profiles(content, profile_tokenizer_options):
+    """
+    Return a dict with the subtree tokens and line ranges of content for every profile, as returned by indexer.tokenize_content,
+    by profile name in the profiles key.
+    """
+    return {"profiles": {profile: indexer.tokenize_content(content, tokenizer_options)
+                         for profile, tokenizer_options in profile_tokenizer_options.items()}}
+
+
+class ProfileIndex:
+    """
+    An indexer.Index for every profile in the dict profiles, see settings.TOKEN_PROFILES.
+    Implements the part of the indexer.Index interface used by the web app and the ingest scripts.
+    """
+    def __init__(self, index_path, name, profiles, frozen_path=None):
+        """
+        If frozen_path is given, the index of every profile searches its snapshot in a subdirectory of frozen_path, written by freeze.
+        """
+        if not profiles:
+            raise ValueError("at least one token profile is required")
+        self.index_path = index_path
+        self.indexes = {profile: indexer.Index(profile_path(index_path, profile), name, options["tokenizer_options"],
+                                               profile_path(frozen_path, profile) if frozen_path else None)
+                        for profile, options in profiles.items()}
+        self.weights = {profile: options["weight"] for profile, options in profiles.items()}
+        # For parallel_tokenizer.TokenizerPool with tokenize_profiles
+        self.tokenizer_options = {profile: index.tokenizer_options for profile, index in self.indexes.items()}
+        self.primary = next(iter(self.indexes.values()))
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(self.indexes))
+        self.searcher_pool = None
+
+    def use_searcher_pool(self, max_size=settings.SEARCHER_POOL_SIZE, refresh_interval=settings.SEARCHER_REFRESH_INTERVAL):
+        for index in self.indexes.values():
+            index.use_searcher_pool(max_size, refresh_interval)
+        self.searcher_pool = ProfileSearcherPools({profile: index.searcher_pool for profile, index in self.indexes.items()})
+
+    def freeze(self, path):
+        """
+        Write a snapshot of the index of every profile to a subdirectory of path, see indexer.Index.freeze.
+        """
+        return {profile: index.freeze(profile_path(path, profile)) for profile, index in self.indexes.items()}
+
+    def generation(self):
+        return tuple(index.generation() for index in self.indexes.values())
+
+    def query_key(self, code_query):
+        return tuple(index.query_key(code_query) for index in self.indexes.values())
+
+    def __len__(self):
+        return len(self.primary)
+
+    @contextlib.contextmanager
+    def searcher(self):
+        """
+        Context manager for a dict of a searcher of every profile by profile name.
+        """
+        with contextlib.ExitStack() as stack:
+            yield {profile: stack.enter_context(index.searcher()) for profile, index in self.indexes.items()}
+
+    def get_similar_snippets(self, code, page=1, page_size=settings.SEARCH_RESULTS_PER_PAGE, searcher=None):
+        """
+        Search code in every profile in parallel threads and return an approximate total of matching documents and the snippets on page, see indexer.Index.get_similar_snippets.
+        The score of a snippet is the weighted sum of its scores in the profiles where it is among the PROFILE_CANDIDATES_FACTOR * page * page_size best matches.
+        The ranking is approximate: a document just outside the candidates of one profile misses the score of that profile,
+        and may be ranked below a document it would outrank if all matches of every profile were merged.
+        The matched tokens of a snippet are a dict of the matched tokens in each profile.
+        """
+        if searcher is None:
+            with self.searcher() as searcher:
+                return self.get_similar_snippets(code, page, page_size, searcher)
+        # Pages past MAX_SEARCH_PAGE are empty instead of ranking ever more candidates
+        candidate_count = settings.PROFILE_CANDIDATES_FACTOR * min(page, settings.MAX_SEARCH_PAGE) * page_size
+        futures = {profile: self.executor.submit(index.get_similar_snippets, code, 1, candidate_count, searcher[profile])
+                   for profile, index in self.indexes.items()}
+        total = 0
+        merged = {}
+        for profile, future in futures.items():
+            profile_total, snippets = future.result()
+            # Most documents match in every profile, so the largest total is closest to the amount of distinct matching documents
+            total = max(total, profile_total)
+            for snippet in snippets:
+                # Snippets crawled from the same page of the Python docs have the same url
+                key = snippet['url'], snippet['document'].get('content_hash')
+                if key not in merged:
+                    merged[key] = dict(snippet, score=0.0, matched_tokens_count=0, matched_tokens={})
+                merged_snippet = merged[key]
+                merged_snippet['score'] += self.weights[profile] * snippet['score']
+                merged_snippet['matched_tokens_count'] += snippet['matched_tokens_count']
+                merged_snippet['matched_tokens'][profile] = snippet['matched_tokens']
+        ranked = sorted(merged.values(), key=lambda snippet: -snippet['score'])
+        return total, ranked[(page - 1) * page_size:page * page_size]
+
+    def snippet_metadata(self, snippet):
+        return self.primary.snippet_metadata(snippet)
+
+    def highlight_snippet(self, snippet):
+        """
+        Highlight the lines matched in all profiles, see indexer.Index.highlight_snippet.
+        """
+        line_numbers = set()
+        for profile, matched_tokens in snippet['matched_tokens'].items():
+            line_numbers.update(self.indexes[profile].matched_lines(snippet['document'], matched_tokens))
+        return self.primary.highlight_snippet_lines(snippet, line_numbers)
+
+    def bulk_writer(self, **options):
+        return ProfileBulkWriter({profile: index.bulk_writer(**options) for profile, index in self.indexes.items()})
+
+    def add_many(self, documents, **options):
+        with self.bulk_writer(**options) as writer:
+            for data in documents:
+                writer.add_document(data)
+        return writer
+
+
+class ProfileSearcherPools:
+    """
+    The searcher_pool.SearcherPool of the index of every profile, with the statistics of all of them.
+    """
+    def __init__(self, pools):
+        self.pools = pools
+
+    def statistics(self):
+        return {profile: pool.statistics() for profile, pool in self.pools.items()}
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+
+class ProfileBulkWriter:
+    """
+    An indexer.BulkWriter for every profile, used like one BulkWriter.
+    """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.exit_stack().__exit__(*exc_info)
+
+    def exit_stack(self):
+        """
+        Return an ExitStack exiting every writer in the order of the profiles, also if exiting a writer raises,
+        in which case the writers exited after it are cancelled.
+        """
+        stack = contextlib.ExitStack()
+        for writer in reversed(list(self.writers.values())):
+            stack.push(writer)
+        return stack
+
+    @property
+    def added_count(self):
+        return next(iter(self.writers.values())).added_count
+
+    @property
+    def skipped_count(self):
+        return next(iter(self.writers.values())).skipped_count
+
+    def add_document(self, data):
+        return all([writer.add_document(data) for writer in self.writers.values()])
+
+    def add_documents(self, data):
+        for writer in self.writers.values():
+            writer.add_documents(data)
+
+    def add_tokenized(self, data):
+        """
+        Add a document dict from parallel_tokenizer.TokenizerPool with tokenize_profiles.
+        Return False if the document has no tokens for some profile, i.e. the file could not be read or parsed.
+        """
+        profiles = data.get('profiles', {})
+        return all([writer.add_tokenized(dict(data, **profiles.get(profile, {"tokens": None})))
+                    for profile, writer in self.writers.items()])
+
+    def delete_document(self, url):
+        for writer in self.writers.values():
+            writer.delete_document(url)
+
+    def commit(self):
+        # If committing a writer raises, the writers not committed yet are cancelled
+        with self.exit_stack():
+            for writer in self.writers.values():
+                writer.commit()
+
+    def report(self):
+        return "; ".join("{}: {}".format(profile, writer.report()) for profile, writer in self.writers.items())
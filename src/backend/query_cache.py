@@ -0,0 +1,64 @@
+"""
+Cache of search results for the web app.
+"""
+import collections
+import threading
+import time
+
+
+class QueryCache:
+    """
+    LRU cache of at most max_size search results, each valid for ttl seconds.
+    Keys should be the canonical set of subtree tokens of a query, so that queries with the same structure share an entry.
+    All entries are dropped when the generation of the index changes.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, generation):
+        """
+        Return the cached value for key computed from the index at generation, or None if there is no such value.
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, value):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, generation, compute):
+        """
+        Return the cached value for key, calling compute to create and cache it on a miss.
+        """
+        value = self.get(key, generation)
+        if value is None:
+            value = compute()
+            self.put(key, generation, value)
+        return value
+
+    def statistics(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self.entries),
+                    "generation": self.generation}
@@ -0,0 +1,58 @@
+"""
+Choose which subtree tokens of a query snippet to search for, using the document frequencies of the tokens in the index.
+"""
+import ast
+import math
+import ast_parser
+import settings
+from whoosh.query import Term, Or
+
+
+class QueryPlanner:
+    """
+    A long snippet has thousands of subtree tokens, most of them shallow subtrees found in almost every document.
+    The planner drops tokens that are not in the index or are found in more than max_document_ratio of all documents,
+    and keeps at most max_terms of the remaining tokens, preferring tall and rare subtrees.
+    """
+    def __init__(self, tokenizer_options,
+                 max_terms=settings.QUERY_MAX_TERMS,
+                 max_document_ratio=settings.QUERY_MAX_DOCUMENT_RATIO):
+        self.tokenizer_options = tokenizer_options
+        self.max_terms = max_terms
+        self.max_document_ratio = max_document_ratio
+
+    def token_heights(self, code):
+        """
+        Return a dict of the subtree tokens of code to the height of the tallest subtree with that token.
+        """
+        tree = ast.parse(code)
+        heights = ast_parser.subtree_heights(tree)
+        token_heights = {}
+        for node, token in ast_parser.dump_with_nodes(tree, **self.tokenizer_options):
+            token_heights[token] = max(token_heights.get(token, 0), heights[id(node)])
+        return token_heights
+
+    def plan(self, code, searcher):
+        """
+        Return a list of (token, weight) pairs of the tokens of code to search for with searcher, highest weight first.
+        The weight of a token is its height times its BM25 inverse document frequency.
+        """
+        document_count = searcher.doc_count_all()
+        rare, common = [], []
+        for token, height in self.token_heights(code).items():
+            frequency = searcher.doc_frequency("content", token)
+            if frequency == 0:
+                # Tokens missing from the index cannot match but still cost a lookup for every segment
+                continue
+            idf = math.log(1 + (document_count - frequency + 0.5) / (frequency + 0.5))
+            if frequency > self.max_document_ratio * document_count:
+                common.append((token, height * idf))
+            else:
+                rare.append((token, height * idf))
+        # Search for common tokens only if there is nothing else to search for
+        planned = rare or common
+        planned.sort(key=lambda pair: (-pair[1], pair[0]))
+        return planned[:self.max_terms]
+
+    def query(self, code, searcher):
+        return Or([Term(u"content", token) for token, _ in self.plan(code, searcher)])
@@ -0,0 +1,127 @@
+"""
+Clone many git repositories concurrently, downloading and checking out only their Python files.
+Every clone is a shallow partial clone without file contents, followed by a sparse checkout of the files matching SPARSE_PATTERNS,
+so git fetches only the blobs of the Python files at HEAD and nothing else is written to disk.
+"""
+import asyncio
+import os
+import shutil
+import signal
+import time
+import settings
+
+
+# Sparse checkout patterns in the .gitignore format, without cone mode
+SPARSE_PATTERNS = ("*.py", )
+
+
+class CloneError(Exception):
+    pass
+
+
+async def kill_git(process):
+    """
+    Kill a git process started by run_git and all its helper processes, and wait for it to exit.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # All of them have exited already, e.g. if the cancellation arrived right after git finished
+        pass
+    await process.wait()
+
+
+async def run_git(args, timeout):
+    """
+    Run git with args and return its stdout, or raise CloneError if it fails or runs for longer than timeout seconds.
+    """
+    process = await asyncio.create_subprocess_exec(
+        "git", *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        # Fail instead of waiting for credentials of private or missing repositories
+        env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+        # In a process group of its own, so that kill_git also kills the helper processes git starts, e.g. to fetch and unpack objects
+        start_new_session=True)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        await kill_git(process)
+        raise CloneError("git {} timed out after {} seconds".format(args[0], timeout))
+    except asyncio.CancelledError:
+        await kill_git(process)
+        raise
+    if process.returncode != 0:
+        raise CloneError("git {} failed with exit code {}: {}".format(
+            args[0], process.returncode, str(stderr, "utf-8", "replace").strip()))
+    return stdout
+
+
+async def clone_python_files(url, path, timeout=settings.CLONE_TIMEOUT):
+    """
+    Clone the latest commit of the repository at url into path, checking out only the files matching SPARSE_PATTERNS.
+    Symbolic links are checked out as plain files containing the link target, so they never point outside the clone.
+    """
+    await run_git(("clone", "--quiet", "--depth=1", "--filter=blob:none", "--no-checkout",
+                   "--config", "core.symlinks=false", url, path), timeout)
+    await run_git(("-C", path, "sparse-checkout", "set", "--no-cone") + SPARSE_PATTERNS, timeout)
+    await run_git(("-C", path, "checkout", "--quiet"), timeout)
+
+
+async def clone_with_retries(name, url, path, semaphore,
+                             attempts=settings.CLONE_ATTEMPTS,
+                             retry_delay=settings.CLONE_RETRY_DELAY,
+                             timeout=settings.CLONE_TIMEOUT):
+    """
+    Clone url into path, trying at most attempts times and waiting retry_delay seconds before the first retry, twice as long before the next one, etc.
+    The clone waits for semaphore, or any other async context manager limiting the clones running at the same time.
+    Return a dict with the name, path, whether the clone succeeded, the amount of attempts, the seconds spent cloning and the last error.
+    """
+    result = {"name": name, "path": path, "ok": False, "attempts": 0, "seconds": 0.0, "error": None}
+    async with semaphore:
+        start_time = time.perf_counter()
+        for attempt in range(attempts):
+            if attempt > 0:
+                await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
+            result["attempts"] += 1
+            try:
+                await clone_python_files(url, path, timeout)
+            except CloneError as error:
+                result["error"] = str(error)
+                # git leaves a partial clone behind if a later command fails
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            result["ok"] = True
+            result["error"] = None
+            break
+        result["seconds"] = time.perf_counter() - start_time
+    if result["ok"]:
+        print("cloned '{}' in {:.1f} seconds, {} attempts".format(name, result["seconds"], result["attempts"]))
+    else:
+        print("failed to clone '{}' after {} attempts: {}".format(name, result["attempts"], result["error"]))
+    return result
+
+
+async def clone_all(repos, destination, concurrency=settings.CLONE_CONCURRENCY, **options):
+    """
+    Clone every repo dict with name and clone_url keys into a directory named after the repo in destination, at most concurrency at a time.
+    Repos that already have a directory in destination are skipped.
+    Return a list of the result dicts of clone_with_retries of the cloned repos.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    clones = []
+    for repo in repos:
+        path = os.path.join(destination, repo["name"])
+        if os.path.exists(path):
+            print("not cloning into existing '{}'".format(path))
+            continue
+        clones.append(clone_with_retries(repo["name"], repo["clone_url"], path, semaphore, **options))
+    return await asyncio.gather(*clones)
+
+
+def clone_repos(repos, destination, concurrency=settings.CLONE_CONCURRENCY, **options):
+    """
+    Run clone_all in a new event loop and return its results.
+    """
+    return asyncio.run(clone_all(repos, destination, concurrency, **options))
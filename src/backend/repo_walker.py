@@ -0,0 +1,123 @@
+"""
+Enumerate the Python files of a cloned repo for indexing with a single git command per repo,
+or by scanning the directory tree if the repo is not a git work tree, e.g. an exported archive.
+"""
+import hashlib
+import os
+import subprocess
+import time
+import settings
+
+
+# Modes of regular and executable files in the git index, which excludes symbolic links and submodules
+REGULAR_FILE_MODES = ("100644", "100755")
+
+
+def git_root_path(repo_path):
+    """
+    Return the absolute path of the root of the git work tree containing repo_path, or None if it is not in a git work tree.
+    """
+    result = subprocess.run(("git", "-C", repo_path, "rev-parse", "--show-toplevel"),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    return str(result.stdout.strip(), "utf-8", "surrogateescape")
+
+
+def git_blob_hash(path):
+    """
+    Return the git blob hash of the file at path, equal to the hash of the file in the git index if it is unchanged.
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def iter_git_files(repo_path):
+    """
+    Yield pairs of the path relative to the git root and the blob hash of every Python file in the git index under repo_path.
+    """
+    command = ("git", "-C", repo_path, "ls-files", "-z", "--stage", "--full-name", "--", "*.py")
+    stdout = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    for entry in str(stdout, "utf-8", "surrogateescape").split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        mode, blob, stage = info.split(" ")
+        # Files with merge conflicts have an entry for every side of the conflict
+        if mode in REGULAR_FILE_MODES and stage == "0":
+            yield path, blob
+
+
+def iter_directory_files(repo_path):
+    """
+    Yield pairs of the path relative to repo_path and the git blob hash of every Python file under repo_path, without following symbolic links.
+    """
+    directories = [""]
+    while directories:
+        directory = directories.pop()
+        with os.scandir(os.path.join(repo_path, directory)) as entries:
+            for entry in entries:
+                path = directory + "/" + entry.name if directory else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".git":
+                        directories.append(path)
+                elif entry.is_file(follow_symlinks=False) and entry.name.endswith(".py"):
+                    yield path, git_blob_hash(entry.path)
+
+
+def iter_repo_files(repo_path, blob_url, git_root=None):
+    """
+    Yield a dict for every Python file of the repo at repo_path with the path of the file, the path relative to the repository root,
+    the url of the file under blob_url, the size of the file in bytes and its git blob hash.
+    If git_root is the root of the git work tree containing repo_path, the tracked files are listed from the git index,
+    otherwise all files under repo_path are listed and hashed.
+    Tracked files that are not checked out, e.g. outside of a sparse checkout, are skipped.
+    """
+    if git_root is None:
+        root, files = repo_path, iter_directory_files(repo_path)
+    else:
+        root, files = git_root, iter_git_files(repo_path)
+    for relpath, blob in files:
+        path = os.path.join(root, relpath)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            continue
+        yield {"path": path, "relpath": relpath, "url": blob_url + "/" + relpath, "size": size, "blob": blob}
+
+
+def files_hash(files):
+    """
+    Return a hash of the paths and blob hashes of the file dicts from iter_repo_files, which changes whenever any file changes.
+    Used instead of the git HEAD hash of repos that are not git work trees.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for relpath, blob in sorted((f["relpath"], f["blob"]) for f in files):
+        digest.update("{}\0{}\0".format(relpath, blob).encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+class Progress:
+    """
+    Print progress messages on one line, at most once every interval seconds, so that printing does not slow down loops over many files.
+    """
+    def __init__(self, interval=settings.PROGRESS_INTERVAL):
+        self.interval = interval
+        self.last_time = None
+
+    def update(self, message, *args):
+        """
+        Print message formatted with args, unless a message was printed less than interval seconds ago.
+        """
+        now = time.perf_counter()
+        if self.last_time is not None and now - self.last_time < self.interval:
+            return
+        self.last_time = now
+        print(message.format(*args), end='\r')
+
+    def done(self, message, *args):
+        """
+        Print the final message formatted with args, ending the line.
+        """
+        print(message.format(*args))
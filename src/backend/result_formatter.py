@@ -1,43 +1,131 @@
+import bisect
+import itertools
+import re
+import threading
 import settings
+import blob_store
+import query_cache
 import pygments
 from pygments.lexers import Python3Lexer
 from pygments.formatters import HtmlFormatter
 
 
-def html_highlight(code, line_numbers):
-    format_options = {
-        "hl_lines": line_numbers,
-        "linenos": "table"
-    }
-    lexer = Python3Lexer()
+# Lexers keep no state between calls to get_tokens, so one instance is enough
+LEXER = Python3Lexer(stripnl=False)
+# HtmlFormatter options are set for every call, so every thread needs its own instance
+_thread_local = threading.local()
+# Rendered html by content hash and highlighted line numbers
+_html_cache = query_cache.QueryCache(settings.HIGHLIGHT_CACHE_SIZE, float("inf"))
+# Multi-line strings by content hash, of documents indexed without them
+_string_spans_cache = query_cache.QueryCache(settings.HIGHLIGHT_CACHE_SIZE, float("inf"))
+
+NEWLINE = re.compile(r"\r\n|\r|\n")
+# Things that can contain triple quotes without starting a string, and triple quotes
+STRING_START = re.compile(r"""#[^\r\n]*|[rRbBuUfF]{0,2}(\"\"\"|'''|"(?:\\.|[^"\\\r\n])*"|'(?:\\.|[^'\\\r\n])*')""")
+
+
+def get_formatter():
+    if not hasattr(_thread_local, "formatter"):
+        _thread_local.formatter = HtmlFormatter(linenos="table")
+    return _thread_local.formatter
+
+
+def html_highlight(code, line_numbers, content_hash=None, string_spans=None):
+    """
+    Render at most MAX_LINES_IN_SEARCH_RESULT_CODE_BLOCK lines of code as html, starting at the first of line_numbers and highlighting all line_numbers.
+    If line_numbers is empty, the first lines are rendered without highlighting.
+    Only the rendered lines are lexed, unless they start inside one of the multi-line strings string_spans, see multiline_string_spans,
+    which are computed once per content hash if not given.
+    The html is cached by the hash of code and line_numbers.
+    """
+    if content_hash is None:
+        content_hash = blob_store.content_hash(code)
+    def compute():
+        spans = string_spans
+        if spans is None:
+            spans = _string_spans_cache.get_or_compute(content_hash, None, lambda: multiline_string_spans(code))
+        return _html_highlight(code, line_numbers, spans)
+    return _html_cache.get_or_compute((content_hash, tuple(line_numbers)), None, compute)
+
+
+def _html_highlight(code, line_numbers, string_spans=None):
     max_lines = settings.MAX_LINES_IN_SEARCH_RESULT_CODE_BLOCK
-    lexer.add_filter(LineFilter(line_numbers, max_lines))
-    format_options["hl_lines"] = [n - min(line_numbers) + 1  for n in line_numbers]
-    format_options["linenostart"] = max(1, min(line_numbers) - 1)
-    return pygments.highlight(
-        code,
-        lexer,
-        HtmlFormatter(**format_options))
-
-
-class LineFilter(pygments.filter.Filter):
-    def __init__(self, line_numbers, max_lines, **options):
-        super().__init__(**options)
-        self.include_lines = set(line_numbers)
-        self.max_lines = max_lines
-
-    def filter(self, lexer, stream):
-        current_lineno = 1
-        yielding = False
-        yielded = 0
-        for token, value in stream:
-            if yielded > self.max_lines:
-                return
-            newline_count = value.count("\n")
-            if not yielding and current_lineno in self.include_lines:
-                yielding = True
-            if yielding:
-                yield token, value
-                yielded += newline_count
-            current_lineno += newline_count
+    first_line = min(line_numbers, default=1)
+    if string_spans is None:
+        string_spans = multiline_string_spans(code)
+    lexing_start = lexing_start_line(string_spans, first_line)
+    end_line = first_line + max_lines
+    # Only the starts of the lines up to the end of the window are needed
+    line_starts = [0] + [m.end() for m in itertools.islice(NEWLINE.finditer(code), end_line - 1)]
+    window = code[line_starts[lexing_start - 1]:line_starts[end_line - 1] if end_line <= len(line_starts) else len(code)]
+    tokens = LEXER.get_tokens(window)
+    tokens = skip_lines(tokens, first_line - lexing_start)
+    formatter = get_formatter()
+    formatter.hl_lines = set(n - first_line + 1 for n in line_numbers)
+    formatter.linenostart = first_line
+    return pygments.format(tokens, formatter)
 
+
+def multiline_string_spans(code):
+    """
+    Return the sorted list of the first and last line numbers of every triple quoted string of code that spans several lines.
+    An unterminated string spans to the last line.
+    Computed once per document, at ingest time if possible, since it scans all of code.
+    """
+    line_starts = [0] + [m.end() for m in NEWLINE.finditer(code)]
+    spans = []
+    position = 0
+    while True:
+        match = STRING_START.search(code, position)
+        if match is None:
+            return spans
+        quotes = match.group(1)
+        if quotes not in ('"""', "'''"):
+            position = match.end()
+            continue
+        closing = code.find(quotes, match.end())
+        while closing != -1 and is_escaped(code, closing):
+            closing = code.find(quotes, closing + 1)
+        first_line = bisect.bisect_right(line_starts, match.start())
+        last_line = bisect.bisect_right(line_starts, len(code) if closing == -1 else closing)
+        if last_line > first_line:
+            spans.append([first_line, last_line])
+        if closing == -1:
+            return spans
+        position = closing + 3
+
+
+def lexing_start_line(string_spans, line):
+    """
+    Return the line number from which code with the multi-line strings string_spans must be lexed for the lexer to be in the correct state at the beginning of line.
+    That is the line of the opening quotes if line is within a triple quoted string, otherwise line itself.
+    """
+    i = bisect.bisect_left(string_spans, [line])
+    if i > 0 and string_spans[i - 1][1] >= line:
+        return string_spans[i - 1][0]
+    return line
+
+
+def is_escaped(code, index):
+    backslashes = 0
+    while index > 0 and code[index - 1] == "\\":
+        backslashes += 1
+        index -= 1
+    return backslashes % 2 == 1
+
+
+def skip_lines(tokens, line_count):
+    """
+    Drop the first line_count lines from a pygments token stream, splitting tokens that span over the first kept line.
+    """
+    for token, value in tokens:
+        if line_count > 0:
+            newline_count = value.count("\n")
+            if newline_count < line_count:
+                line_count -= newline_count
+                continue
+            value = value.split("\n", line_count)[-1]
+            line_count = 0
+            if not value:
+                continue
+        yield token, value
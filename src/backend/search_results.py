@@ -0,0 +1,35 @@
+"""
+Search results of the index engines, with the part of the whoosh.searching.Hit and ResultsPage interfaces used by indexer.Index.
+"""
+
+
+class Hit(dict):
+    """
+    Stored fields of a matching document, its score and the subtree tokens it matched.
+    """
+    def __init__(self, fields, score, matched_tokens):
+        super().__init__(fields)
+        self.score = score
+        self.matched_tokens = matched_tokens
+
+    def fields(self):
+        return dict(self)
+
+    def matched_terms(self):
+        return [("content", token.encode()) for token in self.matched_tokens]
+
+
+class ResultsPage:
+    """
+    One page of hits and the total amount of matching documents, which is estimated by whoosh_index.WhooshSearcher if there are more pages.
+    """
+    def __init__(self, hits, total, pagenum):
+        self.hits = hits
+        self.total = total
+        self.pagenum = pagenum
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
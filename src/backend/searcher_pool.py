@@ -0,0 +1,90 @@
+"""
+Pool of open searchers shared by the threads of a web app process.
+"""
+import contextlib
+import threading
+import time
+
+
+class SearcherPool:
+    """
+    Keep up to max_size idle searchers of an index_backend.IndexBackend open between searches, each used by one thread at a time.
+    The generation of the index is checked at most once every refresh_interval seconds.
+    When it has changed, every searcher is refreshed the next time it is taken from the pool, which reopens only the parts of the index that changed.
+    Idle searchers are suspended by the index backend, e.g. SQLite searchers end their read transaction and begin a new one at the latest commit
+    when they are taken from the pool, so they may see commits newer than the generation of the pool.
+    """
+    def __init__(self, index, max_size, refresh_interval):
+        self.index = index
+        self.max_size = max_size
+        self.refresh_interval = refresh_interval
+        # Pairs of idle searchers and the generation they were last refreshed to
+        self.idle = []
+        self.lock = threading.Lock()
+        self._generation = index.latest_generation()
+        self.checked_at = time.monotonic()
+        self.opened_count = self.reused_count = self.refreshed_count = 0
+
+    def generation(self):
+        """
+        Return the generation of the index, as of at most refresh_interval seconds ago.
+        """
+        with self.lock:
+            if time.monotonic() - self.checked_at > self.refresh_interval:
+                self._generation = self.index.latest_generation()
+                self.checked_at = time.monotonic()
+            return self._generation
+
+    def acquire(self):
+        """
+        Return a pair of a searcher and its generation, to be given back with release.
+        """
+        generation = self.generation()
+        with self.lock:
+            if self.idle:
+                searcher, searcher_generation = self.idle.pop()
+                self.reused_count += 1
+            else:
+                searcher = None
+                self.opened_count += 1
+        if searcher is None:
+            return self.index.searcher(), generation
+        self.index.resume_searcher(searcher)
+        if searcher_generation != generation and not searcher.up_to_date():
+            searcher = searcher.refresh()
+            with self.lock:
+                self.refreshed_count += 1
+        return searcher, generation
+
+    def release(self, searcher, generation):
+        self.index.suspend_searcher(searcher)
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((searcher, generation))
+                return
+        searcher.close()
+
+    @contextlib.contextmanager
+    def searcher(self):
+        """
+        Context manager for using a searcher from the pool.
+        """
+        searcher, generation = self.acquire()
+        try:
+            yield searcher
+        finally:
+            self.release(searcher, generation)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for searcher, _ in idle:
+            searcher.close()
+
+    def statistics(self):
+        with self.lock:
+            return {"idle": len(self.idle),
+                    "opened": self.opened_count,
+                    "reused": self.reused_count,
+                    "refreshed": self.refreshed_count,
+                    "generation": self._generation}
@@ -3,6 +3,53 @@ import os.path
 INDEX_DIRNAME = os.path.abspath(os.path.join("src", "backend", "index"))
 INDEX_NAME = "simple_index"
 INDEX_MAX_SIZE = int(8e9)
+# Backend of new indexes, "whoosh" or "sqlite", which needs SQLite 3.35 or newer.
+# Existing indexes are opened with the backend they were created with.
+INDEX_BACKEND = "whoosh"
+# Indexed git HEAD and files of every repo, saved in the index directory
+REPO_STATE_FILENAME = "repo_state.json"
+# Amounts of indexed repos, files, lines, bytes and subtree tokens, saved in the index directory
+CORPUS_STATISTICS_FILENAME = "corpus_statistics.json"
+# Subtree tokens skipped at index and query time, written to the index directory by stopwords.py
+STOPWORDS_FILENAME = "stopwords.json"
+# Subtrees found in at least this fraction of all documents are stopwords
+STOPWORDS_MIN_DOCUMENT_RATIO = 0.2
+
+# Read-only snapshot of the index written by housekeeping.py --freeze, searched instead of the index if set.
+# The snapshot must be written again to include documents indexed after it.
+FROZEN_INDEX_DIRNAME = None
+
+# Merge all index segments when there are more segments than this
+HOUSEKEEPING_MAX_SEGMENTS = 8
+# or when this fraction of all documents in the segments has been deleted
+HOUSEKEEPING_MAX_DELETED_RATIO = 0.2
+# Never delete unreferenced blobs stored or reused within this many seconds
+HOUSEKEEPING_BLOB_MIN_AGE = 24 * 3600
+
+# Commit a bulk index writer after this many documents
+BULK_COMMIT_DOCUMENTS = 1000
+# or after this many megabytes of source code, whichever comes first
+BULK_COMMIT_MB = 64
+# Memory limit of a whoosh writer for buffering postings, documents are tokenized by INGEST_PROCESSES
+INDEX_WRITER_LIMIT_MB = 128
+# Amount of processes for reading and tokenizing files before indexing, None for one per CPU
+INGEST_PROCESSES = None
+# Maximum amount of files being tokenized while waiting for the index writer
+INGEST_MAX_PENDING = 256
+
+# Minimum seconds between progress messages while indexing the files of a repo
+PROGRESS_INTERVAL = 1.0
+
+# Amount of repos cloned at the same time by github_extractor.py
+CLONE_CONCURRENCY = 8
+# Attempts to clone a repo before giving up, waiting CLONE_RETRY_DELAY seconds before the first retry,
+# twice as long before the next one, etc.
+CLONE_ATTEMPTS = 3
+CLONE_RETRY_DELAY = 5
+# Seconds before a git command of a clone is killed
+CLONE_TIMEOUT = 600
+# Megabytes of checkouts waiting to be indexed by ingest.py, above which no new clones are started
+INGEST_DISK_BUDGET_MB = 4096
 
 TOKENIZER_OPTIONS = {
     # Ignore variable, function, class and argument names.
@@ -13,9 +60,70 @@ TOKENIZER_OPTIONS = {
     # 4 is sufficient for matching for example a variable
     # assignment from the result of a function call but not
     # a variable assignment from a literal
-    'min_depth': 4
+    'min_depth': 4,
+    # Index every subtree as a fixed-width 64-bit hash of its structure
+    # instead of its full string dump.
+    # Changing this requires rebuilding the index.
+    'hash_tokens': True
 }
 
+# Tokenizer options that keep variable, function, class and argument names
+# and allow shallow subtrees, for matching scattered lines
+NAMES_TOKENIZER_OPTIONS = dict(TOKENIZER_OPTIONS, drop_field_names=set(), min_depth=2)
+
+# Skip files at ingest whose sets of subtree tokens are at least this similar to an indexed file,
+# e.g. vendored or copy-pasted modules, and record them as aliases of the indexed file. None to index every file.
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# Amount of MinHash hash functions and LSH bands, which must not change for an existing index.
+# With 16 bands of 8 rows, files with a similarity of 0.8 are compared with a probability of 95%.
+NEAR_DUPLICATE_NUM_PERM = 128
+NEAR_DUPLICATE_BANDS = 16
+# Files with fewer distinct subtree tokens are always indexed
+NEAR_DUPLICATE_MIN_TOKENS = 20
+
+# Named token profiles, each indexed in its own index in a subdirectory of INDEX_DIRNAME.
+# Queries are searched in all profiles in parallel, and the score of a document is the sum
+# of its scores in each profile multiplied by the weight of the profile.
+# None for a single index with TOKENIZER_OPTIONS. For example:
+# TOKEN_PROFILES = {
+#     "structure": {"tokenizer_options": TOKENIZER_OPTIONS, "weight": 1.0},
+#     "names": {"tokenizer_options": NAMES_TOKENIZER_OPTIONS, "weight": 0.5},
+# }
+# Changing this requires rebuilding the index.
+TOKEN_PROFILES = None
+# Every profile contributes this many times the documents up to the requested page to the merged ranking of the profiles
+PROFILE_CANDIDATES_FACTOR = 2
+
+# Amount of search results on one page, unless requested otherwise
+SEARCH_RESULTS_PER_PAGE = 10
+# Maximum amount of search results on one page
+MAX_SEARCH_RESULTS_PER_PAGE = 50
+# Maximum page of search results, larger pages are clamped to it as every page ranks all results up to it
+MAX_SEARCH_PAGE = 100
+
+# Maximum amount of subtree tokens searched for in one query
+QUERY_MAX_TERMS = 64
+# Subtree tokens found in more than this fraction of all documents are not searched for,
+# unless all tokens of the query are that common
+QUERY_MAX_DOCUMENT_RATIO = 0.5
+
+# Maximum amount of snippets in one /api/search request
+MAX_API_SEARCH_QUERIES = 500
+# Amount of search results per snippet in /api/search, unless requested otherwise
+API_SEARCH_RESULTS_PER_QUERY = 5
+
+# Maximum amount of idle searchers kept open by each web app process
+SEARCHER_POOL_SIZE = 8
+# Seconds between checks for new commits to the index by the web app
+SEARCHER_REFRESH_INTERVAL = 5
+
+# Maximum amount of cached search results in the web app
+RESULT_CACHE_SIZE = 1024
+# Seconds until a cached search result expires
+RESULT_CACHE_TTL = 600
+
 # Limit the search result preview blocks' height
 MAX_LINES_IN_SEARCH_RESULT_CODE_BLOCK = 10
+# Maximum amount of cached html renderings of search result code blocks
+HIGHLIGHT_CACHE_SIZE = 4096
 
@@ -0,0 +1,364 @@
+"""
+Index backend storing the postings of subtree tokens in an SQLite database in WAL mode.
+Searchers read a consistent snapshot of the database and are never blocked by a writer, and every commit is an SQLite transaction.
+
+SQLiteIndex, SQLiteWriter and SQLiteSearcher implement the backend interface of indexer.Index, see index_backend.
+Adding documents needs SQLite 3.35 or newer for INSERT ... RETURNING, which is checked when an index is opened.
+"""
+import array
+import collections
+import itertools
+import json
+import math
+import os
+import sqlite3
+from whoosh.index import LockError
+import index_backend
+import search_results
+
+
+FILENAME_FORMAT = "{}.sqlite"
+# BM25F parameters, the defaults of whoosh.scoring.BM25F
+B = 0.75
+K1 = 1.2
+# Seconds to wait for another writer to commit before giving up
+WRITE_LOCK_TIMEOUT = 60
+# The first version with RETURNING clauses
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+SCHEMA = """
+CREATE TABLE terms (
+    id INTEGER PRIMARY KEY,
+    token TEXT NOT NULL UNIQUE,
+    document_frequency INTEGER NOT NULL
+);
+CREATE TABLE documents (
+    id INTEGER PRIMARY KEY,
+    -- Documents crawled from the same page of the Python docs have the same url
+    url TEXT NOT NULL,
+    title TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    -- Ids of the distinct terms of the document as an array of 64-bit integers, for deleting its postings
+    terms BLOB NOT NULL
+);
+CREATE INDEX documents_url ON documents (url);
+CREATE TABLE postings (
+    term INTEGER NOT NULL,
+    document INTEGER NOT NULL,
+    frequency INTEGER NOT NULL,
+    PRIMARY KEY (term, document)
+) WITHOUT ROWID;
+CREATE TABLE statistics (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT INTO statistics VALUES ('generation', 0), ('document_count', 0), ('total_length', 0);
+"""
+
+# Pairs of term ids and inverse document frequencies of a query, given as one JSON parameter
+QUERY_TERMS = "SELECT json_extract(value, '$[0]') AS term, json_extract(value, '$[1]') AS idf FROM json_each(:terms)"
+
+SCORE_DOCUMENTS = """
+WITH query AS ({})
+SELECT postings.document,
+       SUM(query.idf * (postings.frequency * (:K1 + 1)) / (postings.frequency + :K1 * ((1 - :B) + :B * documents.length / :avgfl))) AS score
+FROM query
+JOIN postings ON postings.term = query.term
+JOIN documents ON documents.id = postings.document
+GROUP BY postings.document
+ORDER BY score DESC, postings.document
+LIMIT :limit OFFSET :offset
+""".format(QUERY_TERMS)
+
+COUNT_DOCUMENTS = """
+WITH query AS ({})
+SELECT COUNT(DISTINCT postings.document) FROM query JOIN postings ON postings.term = query.term
+""".format(QUERY_TERMS)
+
+
+def database_path(path, name):
+    return os.path.join(path, FILENAME_FORMAT.format(name))
+
+
+def exists_in(path, name):
+    return os.path.exists(database_path(path, name))
+
+
+def check_sqlite_version():
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError("the sqlite index backend needs SQLite {} or newer, Python uses SQLite {}".format(
+            ".".join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version))
+
+
+def connect(database):
+    # Transactions are started explicitly, since readers need one for a consistent snapshot too
+    return sqlite3.connect(database, timeout=WRITE_LOCK_TIMEOUT, isolation_level=None, check_same_thread=False)
+
+
+def create_in(path, name, tokenizer_options=None):
+    """
+    Create an empty index, whose documents are tokenized by indexer.Index, so tokenizer_options is not needed.
+    """
+    check_sqlite_version()
+    database = database_path(path, name)
+    connection = connect(database)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+    finally:
+        connection.close()
+    return SQLiteIndex(database)
+
+
+def open_in(path, name):
+    return SQLiteIndex(database_path(path, name))
+
+
+def read_statistics(connection):
+    return dict(connection.execute("SELECT name, value FROM statistics"))
+
+
+class SQLiteIndex(index_backend.IndexBackend):
+    """
+    An index in the SQLite database at the path database.
+    """
+    name = "sqlite"
+    schema = frozenset(("title", "url", "content", "content_hash"))
+
+    def __init__(self, database):
+        check_sqlite_version()
+        self.database = database
+
+    def writer(self, **options):
+        """
+        Return a writer holding the write lock of the database until it is committed or cancelled.
+        The whoosh writer options are ignored.
+        """
+        return SQLiteWriter(self.database)
+
+    def searcher(self):
+        return SQLiteSearcher(self.database)
+
+    def suspend_searcher(self, searcher):
+        # An open read transaction keeps checkpoints from moving the WAL past its snapshot, so the WAL would keep growing
+        searcher.end()
+
+    def resume_searcher(self, searcher):
+        searcher.begin()
+
+    def latest_generation(self):
+        connection = connect(self.database)
+        try:
+            return read_statistics(connection)["generation"]
+        finally:
+            connection.close()
+
+    def doc_count(self):
+        with self.searcher() as searcher:
+            return searcher.doc_count()
+
+    def statistics(self):
+        # Documents are deleted in place, so there is only one segment and nothing to merge
+        return {"segment_count": 1, "document_count": self.doc_count(), "deleted_count": 0}
+
+    def document_frequencies(self):
+        with self.searcher() as searcher:
+            return searcher.doc_count_all(), dict(searcher.document_frequencies())
+
+    def optimize(self):
+        """
+        Rebuild the database file without the free pages left by deleted documents.
+        """
+        connection = connect(self.database)
+        try:
+            connection.execute("VACUUM")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                raise LockError(str(e))
+            raise
+        finally:
+            connection.close()
+
+
+class SQLiteWriter:
+    """
+    Add, update and delete documents in one transaction.
+    Like a whoosh writer, it deletes and updates only the documents committed before the writer was created,
+    not the documents added by the writer itself.
+    """
+    def __init__(self, database):
+        self.connection = connect(database)
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.statistics = read_statistics(self.connection)
+        # Documents added by this writer get larger ids, even if the documents with the largest ids are deleted
+        self.last_committed_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM documents").fetchone()[0]
+        self.next_id = self.last_committed_id + 1
+
+    def add_document(self, title, url, content, content_hash):
+        """
+        Add a document with the list of its subtree tokens as content.
+        """
+        if isinstance(content, str):
+            raise TypeError("content must be a list of subtree tokens, not a string")
+        term_ids = []
+        frequencies = collections.Counter(content)
+        for token in frequencies:
+            term_ids.append(self.connection.execute(
+                "INSERT INTO terms (token, document_frequency) VALUES (?, 1) "
+                "ON CONFLICT (token) DO UPDATE SET document_frequency = document_frequency + 1 "
+                "RETURNING id", (token, )).fetchone()[0])
+        document = self.next_id
+        self.next_id += 1
+        self.connection.execute(
+            "INSERT INTO documents (id, url, title, content_hash, length, terms) VALUES (?, ?, ?, ?, ?, ?)",
+            (document, url, title, content_hash, len(content), array.array("q", term_ids).tobytes()))
+        self.connection.executemany(
+            "INSERT INTO postings (term, document, frequency) VALUES (?, ?, ?)",
+            zip(term_ids, itertools.repeat(document), frequencies.values()))
+        self.statistics["document_count"] += 1
+        self.statistics["total_length"] += len(content)
+
+    def update_document(self, title, url, content, content_hash):
+        """
+        Replace the documents with url, or add the document if there are no such documents.
+        """
+        self.delete_by_term("url", url)
+        self.add_document(title, url, content, content_hash)
+
+    def delete_by_term(self, fieldname, text):
+        """
+        Delete all committed documents with the url text.
+        """
+        if fieldname != "url":
+            raise ValueError("documents can only be deleted by url")
+        rows = self.connection.execute("SELECT id, length, terms FROM documents WHERE url = ? AND id <= ?",
+                                       (text, self.last_committed_id)).fetchall()
+        for document, length, terms in rows:
+            term_ids = array.array("q")
+            term_ids.frombytes(terms)
+            self.connection.executemany(
+                "DELETE FROM postings WHERE term = ? AND document = ?",
+                zip(term_ids, itertools.repeat(document)))
+            self.connection.executemany(
+                "UPDATE terms SET document_frequency = document_frequency - 1 WHERE id = ?",
+                ((term, ) for term in term_ids))
+            self.connection.execute("DELETE FROM documents WHERE id = ?", (document, ))
+            self.statistics["document_count"] -= 1
+            self.statistics["total_length"] -= length
+
+    def commit(self):
+        self.statistics["generation"] += 1
+        self.connection.executemany(
+            "UPDATE statistics SET value = ? WHERE name = ?",
+            ((value, name) for name, value in self.statistics.items()))
+        self.connection.execute("COMMIT")
+        self.connection.close()
+
+    def cancel(self):
+        self.connection.execute("ROLLBACK")
+        self.connection.close()
+
+
+class SQLiteSearcher:
+    """
+    Search a snapshot of the database as it was when the searcher was created, or when its read transaction was last begun.
+    """
+    def __init__(self, database):
+        self.database = database
+        self.connection = connect(database)
+        self.begin()
+
+    def begin(self):
+        # In WAL mode, a read transaction sees the database as it was at its first read
+        self.connection.execute("BEGIN")
+        self.statistics = read_statistics(self.connection)
+
+    def end(self):
+        """
+        End the read transaction, after which the searcher cannot be used until begin is called again.
+        """
+        if self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+
+    def up_to_date(self):
+        return SQLiteIndex(self.database).latest_generation() == self.statistics["generation"]
+
+    def refresh(self):
+        """
+        Move this searcher to the latest snapshot of the database and return it, like whoosh.searching.Searcher.refresh.
+        """
+        self.end()
+        self.begin()
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def doc_count(self):
+        return self.statistics["document_count"]
+
+    def doc_count_all(self):
+        return self.statistics["document_count"]
+
+    def doc_frequency(self, fieldname, token):
+        row = self.connection.execute("SELECT document_frequency FROM terms WHERE token = ?", (token, )).fetchone()
+        return row[0] if row else 0
+
+    def document_frequencies(self):
+        """
+        Yield pairs of every token in the database and its document frequency.
+        """
+        yield from self.connection.execute("SELECT token, document_frequency FROM terms WHERE document_frequency > 0")
+
+    def all_stored_fields(self):
+        for title, url, content_hash in self.connection.execute("SELECT title, url, content_hash FROM documents ORDER BY id"):
+            yield {"title": title, "url": url, "content_hash": content_hash}
+
+    def query_terms(self, tokens):
+        """
+        Return a dict of term ids to tokens and a JSON list of term ids and their idf, as whoosh.scoring.WeightingModel.idf computes it.
+        """
+        document_count = self.doc_count_all()
+        rows = self.connection.execute(
+            "SELECT id, token, document_frequency FROM terms WHERE token IN (SELECT value FROM json_each(?)) AND document_frequency > 0",
+            (json.dumps(tokens), )).fetchall()
+        terms = json.dumps([[term, math.log(document_count / (frequency + 1)) + 1] for term, _, frequency in rows])
+        return {term: token for term, token, _ in rows}, terms
+
+    def search_page(self, query, pagenum, pagelen=10, terms=False):
+        """
+        Search with a whoosh.query.Or of Terms in the content field, like whoosh.searching.Searcher.search_page.
+        Documents are scored with BM25F, using exact document lengths where whoosh uses approximate lengths.
+        Pages past the last page return the last page, like in whoosh.
+        """
+        tokens = [subquery.text for subquery in query.subqueries]
+        tokens_by_term, query_terms = self.query_terms(tokens)
+        if not tokens_by_term:
+            return search_results.ResultsPage([], 0, 1)
+        total = self.connection.execute(COUNT_DOCUMENTS, {"terms": query_terms}).fetchone()[0]
+        pagenum = min(pagenum, max(1, int(math.ceil(total / pagelen))))
+        avgfl = self.statistics["total_length"] / max(1, self.doc_count_all()) or 1
+        scores = self.connection.execute(SCORE_DOCUMENTS, {
+            "terms": query_terms, "K1": K1, "B": B, "avgfl": avgfl,
+            "limit": pagelen, "offset": (pagenum - 1) * pagelen}).fetchall()
+        documents = json.dumps([document for document, _ in scores])
+        matched_tokens = collections.defaultdict(list)
+        for document, term in self.connection.execute(
+                "SELECT document, term FROM postings "
+                "WHERE document IN (SELECT value FROM json_each(:documents)) AND term IN (SELECT term FROM ({}))".format(QUERY_TERMS),
+                {"documents": documents, "terms": query_terms}):
+            matched_tokens[document].append(tokens_by_term[term])
+        fields = {document: {"title": title, "url": url, "content_hash": content_hash}
+                  for document, title, url, content_hash in self.connection.execute(
+                      "SELECT id, title, url, content_hash FROM documents WHERE id IN (SELECT value FROM json_each(?))",
+                      (documents, ))}
+        hits = [search_results.Hit(fields[document], score, matched_tokens[document]) for document, score in scores]
+        return search_results.ResultsPage(hits, total, pagenum)
@@ -0,0 +1,150 @@
+"""
+Find stopwords, i.e. subtree tokens found in so many documents that their postings bloat the index without telling documents apart,
+from the document frequencies of the tokens in an index or in a sample corpus of Python files.
+The stopwords are saved in the index directory, after which indexer.Index skips them when indexing and searching.
+Documents indexed before keep their stopword postings until they are indexed again, but the stopwords are never searched for.
+The stopwords of an index with token profiles are found and saved separately for the index of every profile.
+
+Usage: python3 src/backend/stopwords.py [--index-path PATH] [--corpus DIR [DIR ...]] [--min-document-ratio RATIO] [--replace] [--dry-run]
+"""
+import argparse
+import ast
+import collections
+import json
+import os
+import ast_parser
+import indexer
+import profile_index
+import settings
+
+
+def index_document_frequencies(index):
+    """
+    Return the amount of documents in an indexer.Index and a dict of the document frequency of every token in it.
+    """
+    return index.index.document_frequencies()
+
+
+def iter_python_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.endswith(".py"):
+                    yield os.path.join(dirpath, filename)
+
+
+def corpus_document_frequencies(paths, tokenizer_options):
+    """
+    Return the amount of valid Python files in the files and directories at paths, a dict of the document frequency of every token in them,
+    and a dict of the path and line number of the first subtree of every token.
+    """
+    document_count = 0
+    frequencies = collections.Counter()
+    examples = {}
+    for path in iter_python_files(paths):
+        try:
+            with open(path) as f:
+                tree = ast.parse(f.read())
+        except (OSError, UnicodeDecodeError, SyntaxError, ValueError, RecursionError):
+            continue
+        document_count += 1
+        tokens = set()
+        for node, token in ast_parser.dump_with_nodes(tree, **tokenizer_options):
+            if token not in tokens:
+                tokens.add(token)
+                if token not in examples:
+                    line_range = ast_parser.node_line_range(node)
+                    examples[token] = "{}:{}".format(path, line_range[0] if line_range else 1)
+        frequencies.update(tokens)
+    return document_count, frequencies, examples
+
+
+def select_stopwords(frequencies, document_count, min_document_ratio=settings.STOPWORDS_MIN_DOCUMENT_RATIO):
+    """
+    Return the list of tokens found in at least min_document_ratio of all documents, most frequent first.
+    """
+    stopwords = [token for token, frequency in frequencies.items() if frequency >= min_document_ratio * document_count]
+    stopwords.sort(key=lambda token: (-frequencies[token], token))
+    return stopwords
+
+
+def stopword_report(stopwords, frequencies, document_count, min_document_ratio, examples=None):
+    """
+    Return a dict of the stopwords and how much of the postings of the documents they account for, to be saved with indexer.save_stopwords.
+    """
+    return {
+        "stopwords": stopwords,
+        "document_count": document_count,
+        "min_document_ratio": min_document_ratio,
+        "token_count": len(frequencies),
+        "posting_count": sum(frequencies.values()),
+        "stopword_posting_count": sum(frequencies.get(token, 0) for token in stopwords),
+        "document_frequencies": {token: frequencies.get(token, 0) for token in stopwords},
+        "examples": {token: examples[token] for token in stopwords if token in examples} if examples else {},
+    }
+
+
+def print_report(report, top=20):
+    print("{} documents, {} distinct subtree tokens and {} postings".format(
+        report["document_count"], report["token_count"], report["posting_count"]))
+    print("{} tokens found in at least {:.0%} of all documents are stopwords".format(
+        len(report["stopwords"]), report["min_document_ratio"]))
+    print("removing them removes {} postings ({:.1%})".format(
+        report["stopword_posting_count"], report["stopword_posting_count"] / max(1, report["posting_count"])))
+    for token in report["stopwords"][:top]:
+        print("{:>7.1%} {} {}".format(
+            report["document_frequencies"][token] / max(1, report["document_count"]),
+            token,
+            report["examples"].get(token, "")))
+
+
+def corpus_tokenizer_options(index):
+    """
+    Return the tokenizer options of an indexer.Index without its stopwords, so that a corpus is tokenized like the index
+    but the document frequencies of the stopwords are counted too.
+    """
+    return {key: value for key, value in index.tokenizer_options.items() if key != "drop_tokens"}
+
+
+def update_stopwords(index, corpus=None, min_document_ratio=settings.STOPWORDS_MIN_DOCUMENT_RATIO, replace=False, dry_run=False):
+    """
+    Find the stopwords of an indexer.Index from its document frequencies, or from those of the Python files and directories in corpus,
+    print the report and save the stopwords in the index directory unless dry_run is True. Return the report.
+    The previous stopwords of the index are kept unless replace is True.
+    """
+    examples = None
+    if corpus:
+        document_count, frequencies, examples = corpus_document_frequencies(corpus, corpus_tokenizer_options(index))
+    else:
+        document_count, frequencies = index_document_frequencies(index)
+    stopwords = select_stopwords(frequencies, document_count, min_document_ratio)
+    previous_stopwords = indexer.load_stopwords(index.index_path) or set()
+    if not replace:
+        # Previous stopwords are no longer indexed, so their document frequencies in the index are too low to find them again
+        stopwords.extend(sorted(previous_stopwords - set(stopwords)))
+    report = stopword_report(stopwords, frequencies, document_count, min_document_ratio, examples)
+    print_report(report)
+    if not dry_run:
+        indexer.save_stopwords(index.index_path, report)
+        print("saved {} stopwords, {} new".format(len(stopwords), len(set(stopwords) - previous_stopwords)))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find subtree tokens found in most documents and skip them in an index")
+    parser.add_argument("--index-path", default=settings.INDEX_DIRNAME)
+    parser.add_argument("--corpus", nargs="+", help="count document frequencies in these Python files and directories instead of the index")
+    parser.add_argument("--min-document-ratio", type=float, default=settings.STOPWORDS_MIN_DOCUMENT_RATIO)
+    parser.add_argument("--replace", action="store_true", help="replace the previous stopwords of the index instead of adding to them")
+    parser.add_argument("--dry-run", action="store_true", help="print the report without saving the stopwords")
+    args = parser.parse_args()
+
+    index = profile_index.open_index(args.index_path)
+    # Every profile has its own tokens and stopwords
+    for profile, subindex in profile_index.profile_indexes(index).items():
+        if profile is not None:
+            print("profile '{}'".format(profile))
+        update_stopwords(subindex, args.corpus, args.min_document_ratio, args.replace, args.dry_run)
@@ -0,0 +1,135 @@
+"""
+Index backend storing the postings of subtree tokens in a whoosh index, with one segment per commit that are merged by optimize.
+"""
+import math
+import whoosh.index
+from whoosh.collectors import TopCollector
+from whoosh.fields import Schema, TEXT, ID, STORED
+from whoosh.searching import Searcher
+import ast_parser
+import index_backend
+import search_results
+
+
+def exists_in(path, name):
+    return whoosh.index.exists_in(path, name)
+
+
+def create_in(path, name, tokenizer_options):
+    schema = Schema(
+        title=TEXT(stored=True),
+        url=ID(stored=True, unique=True),
+        # The source code is kept in a BlobStore, the index stores only its hash
+        content=TEXT(analyzer=ast_parser.ASTTokenizer(tokenizer_options)),
+        content_hash=STORED
+    )
+    return WhooshIndex(whoosh.index.create_in(path, schema, indexname=name))
+
+
+def open_in(path, name):
+    return WhooshIndex(whoosh.index.open_dir(path, name))
+
+
+class WhooshIndex(index_backend.IndexBackend):
+    """
+    A whoosh index, whose writers and searchers are used as they are.
+    """
+    name = "whoosh"
+
+    def __init__(self, index):
+        self.index = index
+        self.schema = index.schema
+
+    def writer(self, **options):
+        return self.index.writer(**options)
+
+    def searcher(self):
+        return WhooshSearcher(self.index.reader(), fromindex=self.index)
+
+    def latest_generation(self):
+        return self.index.latest_generation()
+
+    def doc_count(self):
+        return self.index.doc_count()
+
+    def statistics(self):
+        segments = self.index._segments()
+        deleted_count = sum(segment.deleted_count() for segment in segments)
+        return {"segment_count": len(segments),
+                "document_count": sum(segment.doc_count_all() for segment in segments) - deleted_count,
+                "deleted_count": deleted_count}
+
+    def document_frequencies(self):
+        with self.index.searcher() as searcher:
+            frequencies = {text.decode(): terminfo.doc_frequency()
+                           for text, terminfo in searcher.reader().iter_field("content")}
+            return searcher.doc_count_all(), frequencies
+
+    def optimize(self):
+        """
+        Merge all segments into one, which drops the deleted documents.
+        """
+        self.index.optimize()
+
+
+class TopDocumentsCollector(TopCollector):
+    """
+    A whoosh TopCollector that skips the documents that cannot score high enough as soon as it has limit documents.
+    TopCollector raises the minimum score only when a document replaces a worse one, so it scores every match when
+    the best documents come first, e.g. when many documents have equal scores.
+    """
+    def _collect(self, global_docnum, score):
+        sort_key = super()._collect(global_docnum, score)
+        if len(self.items) == self.limit:
+            # Later documents with equal scores rank below the collected ones, as they have higher document numbers
+            self.minscore = self.items[0][0]
+        return sort_key
+
+
+class WhooshSearcher(Searcher):
+    """
+    A whoosh searcher which searches for the best documents only, instead of scoring and counting every matching document.
+    """
+    def search_page(self, query, pagenum, pagelen=10, terms=False):
+        """
+        Search like whoosh.searching.Searcher.search_page, but return a search_results.ResultsPage.
+        Only the pagenum * pagelen + 1 best documents are collected, which lets whoosh skip the postings of documents scoring lower,
+        so the total is exact only if there are no more matching documents.
+        Otherwise it is estimated from the document frequencies of the query terms, and is more than pagenum * pagelen.
+        Pages past the last page return the last page, like in whoosh.
+        """
+        limit = pagenum * pagelen
+        collector = TopDocumentsCollector(limit + 1)
+        self.search_with_collector(query, collector)
+        results = collector.results()
+        found = results.scored_length()
+        if found > limit:
+            total = max(found, results.estimated_length())
+        else:
+            # The collector skips documents only when it is full, so it has seen every matching document
+            total = found
+            pagenum = min(pagenum, max(1, int(math.ceil(total / pagelen))))
+        docnums = [results.docnum(i) for i in range((pagenum - 1) * pagelen, min(found, limit))]
+        matched_tokens = self.matched_tokens([subquery.text for subquery in query.subqueries], docnums) if terms else {}
+        hits = [search_results.Hit(self.stored_fields(docnum), results.score(i), matched_tokens.get(docnum, []))
+                for i, docnum in enumerate(docnums, (pagenum - 1) * pagelen)]
+        return search_results.ResultsPage(hits, total, pagenum)
+
+    def matched_tokens(self, tokens, docnums):
+        """
+        Return a dict of each of docnums to the list of tokens in its content field.
+        """
+        reader = self.reader()
+        matched_tokens = {docnum: [] for docnum in docnums}
+        for token in tokens:
+            if ("content", token) not in reader:
+                continue
+            matcher = reader.postings("content", token)
+            for docnum in sorted(docnums):
+                if matcher.is_active() and matcher.id() < docnum:
+                    matcher.skip_to(docnum)
+                if not matcher.is_active():
+                    break
+                if matcher.id() == docnum:
+                    matched_tokens[docnum].append(token)
+        return matched_tokens
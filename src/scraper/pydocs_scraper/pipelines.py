@@ -1,5 +1,15 @@
+import os
+import sys
 from scrapy.exceptions import DropItem
 
+BACKEND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "backend")
+sys.path.append(BACKEND_PATH)
+import profile_index
+import settings
+
+# INDEX_DIRNAME of the backend settings is relative to the working directory of the web app, which is the root of the repository
+DEFAULT_INDEX_PATH = os.path.normpath(os.path.join(BACKEND_PATH, os.path.basename(settings.INDEX_DIRNAME)))
+
 class DuplicatesPipeline:
     def __init__(self):
         self.processed_urls = set()
@@ -17,3 +27,42 @@ class EmptyCodePipeline:
             raise DropItem("Section {} contains no code".format(item["title"]))
         return item
 
+
+class IndexWriterPipeline:
+    """
+    Add the code snippets of every item that passed the previous pipelines to the index at the INDEX_PATH setting as they are scraped,
+    committing in batches with an indexer.BulkWriter, or a profile_index.ProfileBulkWriter with token profiles, instead of collecting all items first.
+    All spiders crawling in the same process into the same index share one writer, since an index has only one writer at a time,
+    and the writer is committed when the last of them closes.
+    """
+    # Shared writers and the amount of open spiders using them, by index path
+    writers = {}
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get("INDEX_PATH") or DEFAULT_INDEX_PATH)
+
+    def open_spider(self, spider):
+        if self.index_path not in self.writers:
+            if not os.path.exists(self.index_path):
+                spider.logger.info("Index does not exist at '{}', creating".format(self.index_path))
+                profile_index.create_index(self.index_path)
+            index = profile_index.open_index(self.index_path)
+            self.writers[self.index_path] = [index.bulk_writer(), 0]
+        self.writers[self.index_path][1] += 1
+
+    def close_spider(self, spider):
+        writer_and_count = self.writers[self.index_path]
+        writer_and_count[1] -= 1
+        if writer_and_count[1] == 0:
+            writer = writer_and_count[0]
+            writer.commit()
+            spider.logger.info(writer.report())
+            del self.writers[self.index_path]
+
+    def process_item(self, item, spider):
+        self.writers[self.index_path][0].add_documents(item)
+        return item
@@ -67,9 +67,12 @@ ROBOTSTXT_OBEY = True
 ITEM_PIPELINES = {
     'pydocs_scraper.pipelines.EmptyCodePipeline': 100,
     'pydocs_scraper.pipelines.DuplicatesPipeline': 200,
-    # 'pydocs_scraper.spiders.doc_spider.WriterPipeline': 200
+    'pydocs_scraper.pipelines.IndexWriterPipeline': 300,
 }
 
+# Index written by IndexWriterPipeline, None for the index directory in src/backend named like INDEX_DIRNAME in the backend settings
+INDEX_PATH = None
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
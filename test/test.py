@@ -2,12 +2,1055 @@ import unittest
 import sys
 import ast
 import os.path
-sys.path.append(os.path.join(os.path.abspath("."), "backend"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "backend"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import asyncio
 import json
+import subprocess
+import collections
 import tempfile
 import random
+import re
+import html
+import io
+import contextlib
+import importlib.util
+import logging
+import types
 import indexer
 import ast_parser
+import blob_store
+import corpus_statistics
+import housekeeping
+import index_backend
+import ingest_pipeline
+import near_duplicates
+import parallel_tokenizer
+import profile_index
+import query_cache
+import query_planner
+import repo_cloner
+import repo_indexer
+import repo_walker
+import result_formatter
+import settings
+import stopwords
+import whoosh_index
+
+
+def reference_dump(node, annotate_fields=True, include_attributes=False,
+                   drop_field_names=None, drop_field_values=None,
+                   drop_node_names=None, min_depth=None, max_depth=None):
+    """
+    The original quadratic implementation of ast_parser.dump, which formats every subtree from scratch.
+    """
+    drop_field_names = drop_field_names or set()
+    drop_field_values = drop_field_values or set()
+    drop_node_names = drop_node_names or set()
+    def name(node):
+        return node.__class__.__name__
+    def _format(node, depth):
+        if max_depth is not None and depth > max_depth:
+            return name(node)
+        elif isinstance(node, ast.AST):
+            fields = [(a, _format(b, depth+1))
+                      for a, b in ast.iter_fields(node)]
+            rv = '%s(%s' % (name(node), ', '.join(
+                ('%s=%s' % field
+                 for field in fields
+                 if field[0] not in drop_field_names and
+                    field[1] not in drop_field_values)
+                if annotate_fields else
+                (b for a, b in fields)))
+            if include_attributes and node._attributes:
+                rv += fields and ', ' or ' '
+                rv += ', '.join('%s=%s' % (a, _format(getattr(node, a), depth+1))
+                                for a in node._attributes)
+            return rv + ')'
+        elif isinstance(node, list):
+            if not node:
+                return '[]'
+            return '[%s]' % ', '.join(_format(n, depth+1) for n in node)
+        return repr(node)
+    for subtree, _ in ast_parser.preorder(node):
+        if min_depth is not None and not ast_parser.has_depth_at_least(subtree, min_depth):
+            continue
+        if name(subtree) in drop_node_names:
+            continue
+        yield _format(subtree, 0)
+
+
+class TestASTDump(unittest.TestCase):
+    def test_dump_is_identical_to_reference_implementation(self):
+        with open("test/data.json") as f:
+            test_data = json.load(f)
+        string_options = dict(settings.TOKENIZER_OPTIONS)
+        string_options.pop("hash_tokens", None)
+        all_options = (
+            {},
+            string_options,
+            {"annotate_fields": False, "min_depth": 2},
+            {"include_attributes": True, "drop_node_names": {"Module", "Expr"}},
+            {"drop_field_values": {"None", "[]"}, "min_depth": 1, "max_depth": 3},
+            {"max_depth": 0},
+        )
+        for data in test_data:
+            for code in data['code_snippets']:
+                root = ast.parse(code)
+                for options in all_options:
+                    self.assertEqual(
+                        list(ast_parser.dump(root, **options)),
+                        list(reference_dump(root, **options)),
+                        "Options {}, code:\n{}".format(options, code))
+
+    def test_hash_tokens_are_fixed_width(self):
+        code = "def f(x):\n    return [y * 2 for y in x]"
+        options = dict(settings.TOKENIZER_OPTIONS, hash_tokens=True)
+        hashes = list(ast_parser.dump(ast.parse(code), **options))
+        self.assertTrue(hashes)
+        for token in hashes:
+            self.assertEqual(len(token), 16)
+            int(token, 16)
+
+    def test_hash_tokens_match_string_tokens(self):
+        """
+        Two subtrees have equal hashes if and only if they have equal string dumps.
+        """
+        with open("test/data.json") as f:
+            test_data = json.load(f)
+        string_options = dict(settings.TOKENIZER_OPTIONS, hash_tokens=False)
+        hash_options = dict(settings.TOKENIZER_OPTIONS, hash_tokens=True)
+        hash_of_string = {}
+        for data in test_data:
+            for code in data['code_snippets']:
+                root = ast.parse(code)
+                strings = list(ast_parser.dump(root, **string_options))
+                hashes = list(ast_parser.dump(root, **hash_options))
+                self.assertEqual(len(strings), len(hashes))
+                for string, hashed in zip(strings, hashes):
+                    self.assertEqual(hash_of_string.setdefault(string, hashed), hashed)
+        self.assertEqual(len(set(hash_of_string.values())), len(hash_of_string))
+
+
+class TestASTTokenizer(unittest.TestCase):
+    def test_character_offsets_point_into_source(self):
+        code = ("s = 'ääkkönen'\r\n"
+                "def f(x):\n"
+                "    return [y * 2 for y in x if y != 'ö']\n")
+        tokenizer = ast_parser.ASTTokenizer(dict(settings.TOKENIZER_OPTIONS, min_depth=2))
+        subtrees = list(ast_parser.dump_with_nodes(ast.parse(code), **tokenizer.string_dump_options))
+        tokens = [(t.text, t.startchar, t.endchar) for t in tokenizer(code, chars=True, start_char=5)]
+        self.assertEqual(len(tokens), len(subtrees))
+        for (node, subtree), (text, startchar, endchar) in zip(subtrees, tokens):
+            self.assertEqual(text, subtree)
+            if hasattr(node, "lineno"):
+                self.assertEqual(code[startchar-5:endchar-5], ast.get_source_segment(code, node))
+
+
+class TestParallelTokenizer(unittest.TestCase):
+    def test_pool_tokens_match_dump(self):
+        with open("test/data.json") as f:
+            snippets = [code for data in json.load(f) for code in data['code_snippets']][:50]
+        snippets.append("def f(:\n    pass")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = []
+            for i, code in enumerate(snippets):
+                path = os.path.join(tmpdir, "{}.py".format(i))
+                with open(path, "w") as f:
+                    f.write(code)
+                jobs.append({"path": path, "title": str(i)})
+            with parallel_tokenizer.TokenizerPool(settings.TOKENIZER_OPTIONS, processes=2, max_pending=4) as pool:
+                documents = list(pool.tokenize(jobs))
+        self.assertEqual(len(documents), len(snippets))
+        for document in documents:
+            code = snippets[int(document['title'])]
+            self.assertEqual(document['content'], code)
+            if indexer.content_is_valid_code(code):
+                self.assertEqual(document['tokens'], list(ast_parser.dump(ast.parse(code), **settings.TOKENIZER_OPTIONS)))
+            else:
+                self.assertIsNone(document['tokens'])
+
+
+class TestBlobStore(unittest.TestCase):
+    def test_identical_contents_are_stored_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = blob_store.BlobStore(tmpdir)
+            key = store.put("import six\n")
+            self.assertEqual(store.put("import six\n"), key)
+            other_key = store.put("import os\n")
+            self.assertNotEqual(other_key, key)
+            self.assertEqual(sorted(store.keys()), sorted((key, other_key)))
+            self.assertEqual(store.get(key), "import six\n")
+            store.delete(key)
+            self.assertNotIn(key, store)
+
+
+class TestHousekeeping(unittest.TestCase):
+    def test_purge_merge_and_vacuum(self):
+        documents = [{"title": "repo file{}.py".format(i),
+                      "url": "https://github.com/user/repo/blob/abc/file{}.py".format(i),
+                      "content": "def f{}(x):\n    return [x + {} for _ in x]\n".format(i, i)}
+                     for i in range(10)]
+        repo_states = {"repo": {"head": "abc", "files": {
+            "file{}.py".format(i): {"blob": "", "url": documents[i]['url']} for i in range(6)}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = os.path.join(tmpdir, "index")
+            indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index.add_many(documents)
+            self.assertEqual(housekeeping.purge_stale_documents(index, repo_states), 4)
+            with near_duplicates.NearDuplicateIndex(near_duplicates.database_path(index_path), min_tokens=0) as duplicates:
+                for document in documents[4:]:
+                    duplicates.add(document['url'], duplicates.signature(ast_parser.dump(ast.parse(document['content']), **settings.TOKENIZER_OPTIONS)))
+            self.assertEqual(housekeeping.purge_stale_near_duplicates(index_path, repo_states), 4)
+            statistics = housekeeping.index_statistics(index, index_path)
+            self.assertEqual(statistics["document_count"], 6)
+            self.assertEqual(statistics["deleted_count"], 4)
+            self.assertTrue(housekeeping.MergePolicy(max_deleted_ratio=0.3).apply(index, index_path))
+            statistics = housekeeping.index_statistics(index, index_path)
+            self.assertEqual(statistics["segment_count"], 1)
+            self.assertEqual(statistics["deleted_count"], 0)
+            self.assertEqual(housekeeping.vacuum_blobs(index), 0)
+            self.assertEqual(housekeeping.vacuum_blobs(index, min_age=-1), 4)
+            self.assertEqual(len(list(index.blob_store.keys())), 6)
+
+    def test_merge_only_when_asked_and_not_while_locked(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = os.path.join(tmpdir, "index")
+            indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            for i in range(3):
+                index.add_document({"title": "repo file.py", "url": str(i), "content": "def f(x):\n    return [x + 1 for _ in x]\n"})
+            merge_policy = housekeeping.MergePolicy(max_segments=1)
+            housekeeping.run_housekeeping(index, index_path, vacuum=True)
+            self.assertEqual(housekeeping.index_statistics(index, index_path)["segment_count"], 3)
+            # An ongoing ingest holds the write lock
+            writer = index.index.writer()
+            try:
+                self.assertFalse(housekeeping.merge_segments(index))
+                housekeeping.run_housekeeping(index, index_path, optimize=True)
+                housekeeping.run_housekeeping(index, index_path, merge_policy=merge_policy)
+            finally:
+                writer.cancel()
+            self.assertEqual(housekeeping.index_statistics(index, index_path)["segment_count"], 3)
+            housekeeping.run_housekeeping(index, index_path, merge_policy=merge_policy)
+            self.assertEqual(housekeeping.index_statistics(index, index_path)["segment_count"], 1)
+
+
+class TestQueryCache(unittest.TestCase):
+    def test_hits_misses_and_invalidation(self):
+        cache = query_cache.QueryCache(max_size=2, ttl=60)
+        keys = [frozenset(ast_parser.dump(ast.parse(code), **settings.TOKENIZER_OPTIONS))
+                for code in ("def f(x):\n    return [y for y in x]",
+                             "def g(items):\n  return [i for i in items]",
+                             "class A:\n    def f(self):\n        return self.x.y()")]
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(cache.get_or_compute(keys[0], 1, lambda: "first"), "first")
+        self.assertEqual(cache.get_or_compute(keys[1], 1, lambda: "second"), "first")
+        cache.put(keys[2], 1, "third")
+        cache.put(frozenset(), 1, "fourth")
+        self.assertIsNone(cache.get(keys[0], 1))
+        self.assertEqual(cache.get(keys[2], 1), "third")
+        self.assertIsNone(cache.get(keys[2], 2))
+        statistics = cache.statistics()
+        self.assertEqual((statistics["hits"], statistics["misses"], statistics["size"]), (2, 3, 0))
+
+
+class TestResultFormatter(unittest.TestCase):
+    def test_window_inside_multiline_string(self):
+        code = "x = 1\n\ndef f():\n    '''\n    doc\n    string\n    '''\n    return x\n" * 5
+        lines = code.splitlines()
+        for first_line in range(1, len(lines) + 1):
+            rendered = result_formatter._html_highlight(code, [first_line, first_line + 1])
+            line_numbers = [int(n) for n in re.findall(r'>\s*(\d+)\s*<', rendered.split('<td class="code">')[0])]
+            expected = list(range(first_line, min(len(lines), first_line + settings.MAX_LINES_IN_SEARCH_RESULT_CODE_BLOCK - 1) + 1))
+            self.assertEqual(line_numbers, expected)
+            code_cell = rendered.split('<td class="code">')[1]
+            self.assertEqual(html.unescape(re.sub(r'<[^>]*>', '', code_cell)).splitlines()[:len(expected)], lines[first_line - 1:expected[-1]])
+            if lines[first_line - 1].strip() in ("doc", "string"):
+                self.assertRegex(code_cell, r'<span class="s[a-z0-9]*">\s*{}'.format(lines[first_line - 1].strip()))
+
+    def test_multiline_string_spans(self):
+        code = 'a = """x\n"""\nb = "\'\'\'"  # \'\'\'\nc = \'\'\'\ny \\\'\'\'\n\'\'\'\nd = """one line"""\ne = r"""\n'
+        spans = result_formatter.multiline_string_spans(code)
+        self.assertEqual(spans, [[1, 2], [4, 6], [8, 9]])
+        self.assertEqual([result_formatter.lexing_start_line(spans, line) for line in range(1, 10)], [1, 1, 3, 4, 4, 4, 7, 8, 8])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = os.path.join(tmpdir, "index")
+            indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            content = code.replace('r"""\n', 'None\n')
+            index.add_document({"title": "repo a.py", "url": "a", "content": content})
+            # The spans are computed once at ingest time and stored with the blob
+            self.assertEqual(index.blob_store.get_string_spans(blob_store.content_hash(content)), spans[:2])
+
+
+class TestSQLiteIndex(unittest.TestCase):
+    def test_search_update_and_concurrent_reader(self):
+        with open("test/data.json") as f:
+            test_data = json.load(f)[:40]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = os.path.join(tmpdir, "index")
+            indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS, backend="sqlite")
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            self.assertEqual(index.backend, "sqlite")
+            with index.bulk_writer() as writer:
+                for data in test_data:
+                    writer.add_documents(data)
+            self.assertEqual(len(index), writer.added_count)
+            for data in test_data:
+                for code in data['code_snippets']:
+                    if not any(ast_parser.dump(ast.parse(code), **settings.TOKENIZER_OPTIONS)):
+                        continue
+                    total, snippets = index.get_similar_snippets(code, 1, 10)
+                    self.assertIn(data['url'], [snippet['url'] for snippet in snippets])
+                    self.assertEqual([s['score'] for s in snippets], sorted((s['score'] for s in snippets), reverse=True))
+            code = "for x in y:\n    print(x)\n"
+            total, snippets = index.get_similar_snippets(code, 1, 1000)
+            self.assertEqual(total, len(snippets))
+            self.assertIn("hll", index.highlight_snippet(snippets[0])['source_html_highlighted'])
+            generation = index.generation()
+            deleted_url = snippets[0]['url']
+            with index.searcher() as searcher:
+                with index.bulk_writer(update=True) as writer:
+                    writer.add_document({"title": "updated", "url": deleted_url, "content": "x = 1\n"})
+                    # Searchers are not blocked by the writer and do not see its changes
+                    self.assertEqual(index.get_similar_snippets(code, 1, 1000)[0], total)
+                # Until a new searcher is created
+                self.assertEqual(index.get_similar_snippets(code, 1, 1000, searcher)[0], total)
+            total, snippets = index.get_similar_snippets(code, 1, 1000)
+            self.assertNotIn(deleted_url, [snippet['url'] for snippet in snippets])
+            self.assertIn({"title": "updated", "url": deleted_url, "content_hash": blob_store.content_hash("x = 1\n")},
+                          list(index.iter_stored_fields()))
+            self.assertEqual(index.generation(), generation + 1)
+            self.assertEqual(housekeeping.index_statistics(index, index_path)["document_count"], len(index))
+
+    def test_backends_implement_the_same_interface(self):
+        with open("test/data.json") as f:
+            test_data = json.load(f)[:20]
+        results = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for backend in indexer.BACKENDS:
+                index_path = os.path.join(tmpdir, backend)
+                indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS, backend=backend)
+                index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+                self.assertIsInstance(index.index, index_backend.IndexBackend)
+                with index.bulk_writer(commit_every=10) as writer:
+                    for data in test_data:
+                        writer.add_documents(data)
+                    writer.delete_document(test_data[0]["url"])
+                index.index.optimize()
+                statistics = index.index.statistics()
+                self.assertEqual((statistics["segment_count"], statistics["deleted_count"]), (1, 0))
+                self.assertEqual(statistics["document_count"], len(index))
+                results.append((len(index),
+                                index.index.document_frequencies(),
+                                sorted(hit["url"] for hit in index.iter_documents())))
+        self.assertEqual(results[0], results[1])
+
+    def test_updating_a_section_keeps_all_its_snippets(self):
+        section = {"title": "updated section", "url": "https://docs.python.org/3/updated.html",
+                   "code_snippets": ["x = {}\nprint(x)\n".format(i) for i in range(3)]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for backend in indexer.BACKENDS:
+                index_path = os.path.join(tmpdir, backend)
+                indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS, backend=backend)
+                index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+                index.add_documents(dict(section, code_snippets=section["code_snippets"][:1]))
+                for _ in range(2):
+                    # The snippets added by the writer do not replace each other, only the committed ones
+                    index.update_documents(section)
+                    urls = [fields["url"] for fields in index.iter_stored_fields()]
+                    self.assertEqual(urls, [section["url"]] * 3, backend)
+                    self.assertEqual(len(index), 3, backend)
+
+
+class TestSearcherPool(unittest.TestCase):
+    def test_reuse_and_refresh(self):
+        code = "def f(x):\n    return [x + 1 for _ in x]\n"
+        for backend in ("whoosh", "sqlite"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                index_path = os.path.join(tmpdir, "index")
+                indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS, backend=backend)
+                index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+                index.add_document({"title": "repo a.py", "url": "a", "content": code})
+                index.use_searcher_pool(max_size=1, refresh_interval=3600)
+                for _ in range(3):
+                    self.assertEqual(index.get_similar_snippets(code)[0], 1)
+                index.add_document({"title": "repo b.py", "url": "b", "content": code})
+                if backend == "whoosh":
+                    # New commits are not seen until the refresh interval has passed
+                    self.assertEqual(index.get_similar_snippets(code)[0], 1)
+                else:
+                    # Idle SQLite searchers hold no read transaction and see the latest commit on their next search
+                    self.assertFalse(index.searcher_pool.idle[0][0].connection.in_transaction)
+                    self.assertEqual(index.get_similar_snippets(code)[0], 2)
+                index.searcher_pool.refresh_interval = 0
+                self.assertEqual(index.get_similar_snippets(code)[0], 2)
+                statistics = index.searcher_pool.statistics()
+                self.assertEqual((statistics["opened"], statistics["reused"], statistics["refreshed"]),
+                                 (1, 4, 1 if backend == "whoosh" else 0))
+                self.assertEqual(statistics["generation"], index.index.latest_generation())
+                index.searcher_pool.close()
+
+
+class TestTopDocuments(unittest.TestCase):
+    def test_documents_scoring_too_low_are_skipped(self):
+        common = "for item in items:\n    print(item)\n"
+        rare = "with open(path) as f:\n    data = json.load(f)\n"
+        documents = [{"title": "rare", "url": "rare/{}".format(i), "content": common + rare} for i in range(5)]
+        documents += [{"title": "common", "url": "common/{}".format(i), "content": common} for i in range(300)]
+        documents += [{"title": "other", "url": "other/{}".format(i), "content": "x = {}\ny = x * 2\n".format(i)} for i in range(400)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = os.path.join(tmpdir, "index")
+            indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            with index.bulk_writer() as writer:
+                for document in documents:
+                    writer.add_document(document)
+            code = common + rare
+            with index.searcher() as searcher:
+                query = index.parse_query(code, searcher)
+                matching = list(searcher.docs_for_query(query))
+                ranked = [hit["url"] for hit in searcher.search(query, limit=None)]
+                collector = whoosh_index.TopDocumentsCollector(3)
+                searcher.search_with_collector(query, collector)
+            self.assertEqual(len(matching), 305)
+            # Once the best documents are collected, the documents matching only the common subtrees cannot outrank them
+            self.assertLess(collector.total, 10)
+            total, snippets = index.get_similar_snippets(code, 1, 2)
+            self.assertEqual([snippet["url"] for snippet in snippets], ranked[:2])
+            self.assertEqual(snippets[0]["matched_tokens_count"], len(query.subqueries))
+            self.assertGreater(total, 2)
+            total, snippets = index.get_similar_snippets(code, 2, 3)
+            self.assertEqual([snippet["url"] for snippet in snippets], ranked[3:6])
+            self.assertGreater(total, 6)
+            # Past the last page the total is exact
+            total, snippets = index.get_similar_snippets(code, 200, 2)
+            self.assertEqual(total, len(matching))
+            self.assertEqual(snippets, [])
+
+
+class TestProfileIndex(unittest.TestCase):
+    def test_weighted_merge_of_profiles(self):
+        profiles = {"structure": {"tokenizer_options": settings.TOKENIZER_OPTIONS, "weight": 1.0},
+                    "names": {"tokenizer_options": settings.NAMES_TOKENIZER_OPTIONS, "weight": 0.5}}
+        with open("test/data.json") as f:
+            snippets = [code for data in json.load(f) for code in data['code_snippets']][:30]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = []
+            for i, code in enumerate(snippets):
+                path = os.path.join(tmpdir, "{}.py".format(i))
+                with open(path, "w") as f:
+                    f.write(code)
+                jobs.append({"path": path, "title": "repo {}.py".format(i), "url": "https://github.com/repo/{}.py".format(i)})
+            index_path = os.path.join(tmpdir, "index")
+            profile_index.create_new_index(index_path, "TEMP_TEST_INDEX", profiles)
+            index = profile_index.ProfileIndex(index_path, "TEMP_TEST_INDEX", profiles)
+            with parallel_tokenizer.TokenizerPool(index.tokenizer_options, processes=2, tokenize=profile_index.tokenize_profiles) as pool:
+                with index.bulk_writer() as writer:
+                    for document in pool.tokenize(jobs):
+                        writer.add_tokenized(document)
+            self.assertEqual(len(index), sum(indexer.content_is_valid_code(code) for code in snippets))
+            code = "\n".join(code for code in snippets[:10] if indexer.content_is_valid_code(code))
+            total, snippets_found = index.get_similar_snippets(code, page=1, page_size=100)
+            self.assertGreater(total, 0)
+            # Every profile returns all matches with this page size, so the merged scores are exact
+            expected = collections.Counter()
+            for profile, profile_options in profiles.items():
+                for snippet in index.indexes[profile].get_similar_snippets(code, page=1, page_size=100)[1]:
+                    expected[snippet['url']] += profile_options["weight"] * snippet['score']
+            for snippet in snippets_found:
+                self.assertAlmostEqual(snippet['score'], expected[snippet['url']])
+            self.assertEqual(len(snippets_found), len(expected))
+            scores = [snippet['score'] for snippet in snippets_found]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            # Deeper pages merge more results of every profile, so only the first page of all results is comparable
+            page_total, page = index.get_similar_snippets(code, page=1, page_size=len(snippets_found))
+            self.assertEqual((page_total, page), (total, snippets_found))
+            self.assertEqual(len(index.get_similar_snippets(code, page=2, page_size=1)[1]), 1)
+            highlighted = index.highlight_snippet(snippets_found[0])
+            self.assertIn("hll", highlighted['source_html_highlighted'])
+            json.dumps(highlighted)
+
+    def test_every_writer_is_exited_if_one_fails(self):
+        calls = []
+        class Writer:
+            def __init__(self, profile, fails):
+                self.profile = profile
+                self.fails = fails
+            def commit(self):
+                calls.append((self.profile, "commit"))
+                if self.fails:
+                    raise OSError("disk full")
+            def __exit__(self, exc_type, exc_value, traceback):
+                calls.append((self.profile, "exit", exc_type))
+                if self.fails and exc_type is None:
+                    raise OSError("disk full")
+        writer = profile_index.ProfileBulkWriter({"structure": Writer("structure", True), "names": Writer("names", False)})
+        with self.assertRaises(OSError):
+            writer.commit()
+        # The writer that is not committed yet is cancelled
+        self.assertEqual(calls, [("structure", "commit"), ("structure", "exit", OSError), ("names", "exit", OSError)])
+        del calls[:]
+        with self.assertRaises(OSError):
+            with writer:
+                pass
+        self.assertEqual(calls, [("structure", "exit", None), ("names", "exit", OSError)])
+
+    def test_scripts_open_every_profile(self):
+        profiles = {"structure": {"tokenizer_options": settings.TOKENIZER_OPTIONS, "weight": 1.0},
+                    "names": {"tokenizer_options": settings.NAMES_TOKENIZER_OPTIONS, "weight": 0.5}}
+        with open("test/data.json") as f:
+            test_data = json.load(f)[:10]
+        token_profiles = settings.TOKEN_PROFILES
+        settings.TOKEN_PROFILES = profiles
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                index_path = os.path.join(tmpdir, "index")
+                profile_index.create_index(index_path, "TEMP_TEST_INDEX")
+                index = profile_index.open_index(index_path, "TEMP_TEST_INDEX")
+                self.assertIsInstance(index, profile_index.ProfileIndex)
+                with index.bulk_writer() as writer:
+                    for data in test_data:
+                        writer.add_documents(data)
+                frozen_path = os.path.join(tmpdir, "frozen")
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    housekeeping.run_housekeeping(index, index_path, optimize=True, freeze_path=frozen_path)
+                for profile in profiles:
+                    self.assertIn("profile '{}': merged all segments".format(profile), output.getvalue())
+                self.assertEqual(sorted(os.listdir(frozen_path)), sorted(profiles))
+                code = test_data[0]["code_snippets"][0]
+                frozen = profile_index.open_index(index_path, "TEMP_TEST_INDEX", frozen_path)
+                self.assertEqual(frozen.get_similar_snippets(code)[0], index.get_similar_snippets(code)[0])
+                index.use_searcher_pool()
+                index.get_similar_snippets(code)
+                statistics = index.searcher_pool.statistics()
+                self.assertEqual(sorted(statistics), sorted(profiles))
+                self.assertEqual([pool["opened"] for pool in statistics.values()], [1, 1])
+                index.searcher_pool.close()
+        finally:
+            settings.TOKEN_PROFILES = token_profiles
+
+
+class TestStopwords(unittest.TestCase):
+    def test_corpus_and_index_frequencies_and_skipped_stopwords(self):
+        with open("test/data.json") as f:
+            snippets = [code for data in json.load(f) for code in data['code_snippets'] if indexer.content_is_valid_code(code)][:100]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corpus_path = os.path.join(tmpdir, "corpus")
+            os.mkdir(corpus_path)
+            for i, code in enumerate(snippets):
+                with open(os.path.join(corpus_path, "{}.py".format(i)), "w") as f:
+                    f.write(code)
+            index_path = os.path.join(tmpdir, "index")
+            indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            index.add_many({"title": str(i), "url": str(i), "content": code} for i, code in enumerate(snippets))
+            document_count, frequencies = stopwords.index_document_frequencies(index)
+            self.assertEqual((document_count, frequencies), stopwords.corpus_document_frequencies([corpus_path], settings.TOKENIZER_OPTIONS)[:2])
+            found = stopwords.select_stopwords(frequencies, document_count, min_document_ratio=0.02)
+            self.assertTrue(found)
+            report = stopwords.stopword_report(found, frequencies, document_count, 0.02)
+            self.assertEqual(report["stopword_posting_count"], sum(frequencies[token] for token in found))
+            indexer.save_stopwords(index_path, report)
+            index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+            code = next(code for code in snippets if set(found) & set(ast_parser.dump(ast.parse(code), **settings.TOKENIZER_OPTIONS)))
+            self.assertFalse(set(found) & index.query_key(code))
+            with index.searcher() as searcher:
+                self.assertFalse(set(found) & set(term.text for term in index.parse_query(code, searcher).subqueries))
+            index.add_document({"title": "new", "url": "new", "content": code})
+            # Only the tokens of the new document that are not stopwords are indexed
+            expected = collections.Counter(frequencies)
+            expected.update(set(ast_parser.dump(ast.parse(code), **settings.TOKENIZER_OPTIONS)) - set(found))
+            self.assertEqual(stopwords.index_document_frequencies(index)[1], dict(expected))
+
+    def test_corpus_is_tokenized_like_every_profile(self):
+        profiles = {"structure": {"tokenizer_options": settings.TOKENIZER_OPTIONS, "weight": 1.0},
+                    "names": {"tokenizer_options": settings.NAMES_TOKENIZER_OPTIONS, "weight": 0.5}}
+        with open("test/data.json") as f:
+            snippets = [code for data in json.load(f) for code in data['code_snippets'] if indexer.content_is_valid_code(code)][:50]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corpus_path = os.path.join(tmpdir, "corpus")
+            os.mkdir(corpus_path)
+            for i, code in enumerate(snippets):
+                with open(os.path.join(corpus_path, "{}.py".format(i)), "w") as f:
+                    f.write(code)
+            index_path = os.path.join(tmpdir, "index")
+            profile_index.create_new_index(index_path, "TEMP_TEST_INDEX", profiles)
+            index = profile_index.ProfileIndex(index_path, "TEMP_TEST_INDEX", profiles)
+            index.add_many({"title": str(i), "url": str(i), "content": code} for i, code in enumerate(snippets))
+            reports = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                for profile, subindex in profile_index.profile_indexes(index).items():
+                    reports[profile] = stopwords.update_stopwords(subindex, [corpus_path], min_document_ratio=0.05)
+            for profile, subindex in index.indexes.items():
+                document_count, frequencies = stopwords.index_document_frequencies(subindex)
+                self.assertEqual(reports[profile]["document_count"], document_count)
+                self.assertTrue(reports[profile]["stopwords"])
+                self.assertEqual(reports[profile]["document_frequencies"],
+                                 {token: frequencies[token] for token in reports[profile]["stopwords"]})
+                self.assertEqual(indexer.load_stopwords(subindex.index_path), set(reports[profile]["stopwords"]))
+            self.assertNotEqual(reports["structure"]["stopwords"], reports["names"]["stopwords"])
+            # Stopwords of the index are counted in the corpus again, instead of being dropped by the tokenizer
+            index = profile_index.ProfileIndex(index_path, "TEMP_TEST_INDEX", profiles)
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = stopwords.update_stopwords(index.indexes["names"], [corpus_path], min_document_ratio=0.05, replace=True, dry_run=True)
+            self.assertEqual(report["stopwords"], reports["names"]["stopwords"])
+
+
+class TestNearDuplicates(unittest.TestCase):
+    def test_copies_are_found_and_aliased(self):
+        with open("test/data.json") as f:
+            snippets = [code for data in json.load(f) for code in data['code_snippets'] if indexer.content_is_valid_code(code)]
+        original = "\n".join(snippets[:20])
+        tokens = ast_parser.dump(ast.parse(original), **settings.TOKENIZER_OPTIONS)
+        # Renaming variables does not change any token and dropping a snippet changes few of them
+        copy = "\n".join(snippets[:19]).replace("self", "this")
+        unrelated = "\n".join(snippets[40:60])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = near_duplicates.database_path(tmpdir)
+            with near_duplicates.NearDuplicateIndex(path, threshold=0.8) as duplicates:
+                signature = duplicates.signature(list(tokens))
+                duplicates.add("original", signature)
+                self.assertEqual(duplicates.find("original", signature), (None, 0.0))
+                copy_signature = duplicates.signature(list(ast_parser.dump(ast.parse(copy), **settings.TOKENIZER_OPTIONS)))
+                canonical_url, similarity = duplicates.find("copy", copy_signature)
+                self.assertEqual(canonical_url, "original")
+                self.assertGreaterEqual(similarity, 0.8)
+                duplicates.add_alias("copy", canonical_url, similarity)
+                unrelated_signature = duplicates.signature(list(ast_parser.dump(ast.parse(unrelated), **settings.TOKENIZER_OPTIONS)))
+                self.assertEqual(duplicates.find("unrelated", unrelated_signature), (None, 0.0))
+                self.assertIsNone(duplicates.signature(["{:016x}".format(i) for i in range(5)]))
+            with near_duplicates.NearDuplicateIndex(path) as duplicates:
+                self.assertEqual(duplicates.aliases("original"), ["copy"])
+                self.assertEqual(duplicates.statistics(), {"signatures": 1, "aliases": 1, "canonical_documents": 1})
+                duplicates.delete("original")
+                self.assertEqual(duplicates.find("copy", copy_signature), (None, 0.0))
+
+    def test_aliases_of_deleted_files_are_indexed_again(self):
+        with open("test/data.json") as f:
+            snippets = [code for data in json.load(f) for code in data['code_snippets'] if indexer.content_is_valid_code(code)]
+        original = "\n".join(snippets[:20])
+        copy = original.replace("self", "this")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repos = []
+            for name in ("one", "two"):
+                os.mkdir(os.path.join(tmpdir, name))
+                repos.append({"name": name, "html_url": "https://github.com/test/" + name})
+            with open(os.path.join(tmpdir, "one", "a.py"), "w") as f:
+                f.write(original)
+            with contextlib.redirect_stdout(io.StringIO()):
+                indexing = repo_indexer.RepoIndexer(os.path.join(tmpdir, "index"))
+                indexing.index_repo(repos[0], os.path.join(tmpdir, "one"))
+                for name, filename in (("one", "c.py"), ("two", "b.py")):
+                    with open(os.path.join(tmpdir, name, filename), "w") as f:
+                        f.write(copy)
+                for repo in repos:
+                    indexing.index_repo(repo, os.path.join(tmpdir, repo["name"]))
+                self.assertEqual(indexing.repo_states["one"]["files"]["c.py"]["url"], None)
+                self.assertEqual(indexing.repo_states["two"]["files"]["b.py"]["url"], None)
+                os.remove(os.path.join(tmpdir, "one", "a.py"))
+                indexing.index_repo(repos[0], os.path.join(tmpdir, "one"))
+                # The alias in the same repo is indexed right away, the alias in the other repo when that repo is indexed again
+                canonical_url = indexing.repo_states["one"]["files"]["c.py"]["url"]
+                self.assertIsNotNone(canonical_url)
+                self.assertEqual(indexing.repo_states["two"], dict(indexing.repo_states["two"], head=None, files={}))
+                indexing.index_repo(repos[1], os.path.join(tmpdir, "two"))
+                self.assertEqual(indexing.near_duplicate_index.aliases(canonical_url), [indexing.repo_states["two"]["files"]["b.py"]["alias_url"]])
+                indexing.close()
+            self.assertEqual([fields["url"] for fields in indexing.index.iter_stored_fields()], [canonical_url])
+
+    def test_estimated_similarity_is_close_to_jaccard(self):
+        tokens = ["{:016x}".format(i * 7919) for i in range(1000)]
+        for overlap in (200, 500, 900):
+            a, b = tokens[:overlap + 50], tokens[50:]
+            jaccard = overlap / 1000
+            estimate = near_duplicates.similarity(near_duplicates.minhash(a, 256, True), near_duplicates.minhash(b, 256, True))
+            self.assertAlmostEqual(estimate, jaccard, delta=0.1)
+
+
+def run_git(*args):
+    return subprocess.run(("git", ) + args, stdout=subprocess.PIPE, check=True).stdout.decode()
+
+
+def make_bare_repos(tmpdir, count):
+    """
+    Create count local bare repositories standing in for GitHub, which allow partial clones, and return repo dicts like in repo_data.json.
+    """
+    repos = []
+    for i in range(count):
+        work_path = os.path.join(tmpdir, "work{}".format(i))
+        os.makedirs(os.path.join(work_path, "pkg"))
+        with open(os.path.join(work_path, "pkg", "module.py"), "w") as f:
+            f.write("x = {}\n".format(i))
+        with open(os.path.join(work_path, "data.bin"), "wb") as f:
+            f.write(os.urandom(10000))
+        os.symlink("/etc/passwd", os.path.join(work_path, "link.py"))
+        run_git("-C", work_path, "init", "--quiet")
+        run_git("-C", work_path, "add", ".")
+        run_git("-C", work_path, "-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "--quiet", "-m", "init")
+        bare_path = os.path.join(tmpdir, "repo{}.git".format(i))
+        run_git("clone", "--quiet", "--bare", work_path, bare_path)
+        run_git("-C", bare_path, "config", "uploadpack.allowFilter", "true")
+        repos.append({"name": "repo{}".format(i), "clone_url": "file://" + bare_path, "html_url": "https://github.com/test/repo{}".format(i)})
+    return repos
+
+
+class TestRepoCloner(unittest.TestCase):
+    def test_concurrent_python_only_clones(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repos = make_bare_repos(tmpdir, 3)
+            repos.append({"name": "missing", "clone_url": "file://" + os.path.join(tmpdir, "missing.git")})
+            destination = os.path.join(tmpdir, "cloned")
+            os.mkdir(destination)
+            results = repo_cloner.clone_repos(repos, destination, concurrency=2, attempts=2, retry_delay=0)
+            self.assertEqual([(result["name"], result["ok"], result["attempts"]) for result in results],
+                             [("repo0", True, 1), ("repo1", True, 1), ("repo2", True, 1), ("missing", False, 2)])
+            self.assertFalse(os.path.exists(os.path.join(destination, "missing")))
+            for i in range(3):
+                clone_path = os.path.join(destination, "repo{}".format(i))
+                files = sorted(os.path.relpath(os.path.join(dirpath, filename), clone_path)
+                               for dirpath, dirnames, filenames in os.walk(clone_path)
+                               if ".git" not in os.path.relpath(dirpath, clone_path).split(os.sep)
+                               for filename in filenames)
+                self.assertEqual(files, ["link.py", os.path.join("pkg", "module.py")])
+                self.assertFalse(os.path.islink(os.path.join(clone_path, "link.py")))
+                # The blob of data.bin was never fetched
+                missing = run_git("-C", clone_path, "rev-list", "--objects", "--missing=print", "HEAD").split()
+                self.assertIn("?" + run_git("-C", os.path.join(tmpdir, "work{}".format(i)), "rev-parse", "HEAD:data.bin").strip(), missing)
+            # Existing clones are not cloned again
+            self.assertEqual(repo_cloner.clone_repos(repos[:1], destination), [])
+
+
+class TestIngestPipeline(unittest.TestCase):
+    def test_checkouts_are_indexed_and_deleted_within_budget(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repos = make_bare_repos(tmpdir, 4)
+            destination = os.path.join(tmpdir, "cloned")
+            os.mkdir(destination)
+            indexed = []
+            checkouts = []
+
+            def index_repo(repo, path):
+                self.assertEqual(sorted(os.listdir(os.path.join(path, "pkg"))), ["module.py"])
+                checkouts.append(len(os.listdir(destination)))
+                indexed.append(repo["name"])
+
+            # With a budget of one byte, the next clone starts only after the previous checkout has been indexed and deleted
+            statistics = ingest_pipeline.run_pipeline(repos, destination, index_repo, max_bytes=1, concurrency=1)
+            self.assertEqual(sorted(indexed), [repo["name"] for repo in repos])
+            self.assertEqual((statistics["indexed"], statistics["failed"], statistics["stopped"]), (4, 0, False))
+            self.assertEqual(max(checkouts), 1)
+            self.assertEqual(os.listdir(destination), [])
+
+            def stop_after_first(repo, path):
+                if indexed:
+                    raise ingest_pipeline.StopPipeline("stop")
+                indexed.append(repo["name"])
+
+            indexed = []
+            statistics = ingest_pipeline.run_pipeline(repos, destination, stop_after_first, concurrency=4)
+            self.assertEqual((statistics["indexed"], statistics["stopped"]), (1, True))
+            self.assertEqual(os.listdir(destination), [])
+
+    def test_unexpected_clone_errors_fail_the_repo(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repos = make_bare_repos(tmpdir, 3)
+            destination = os.path.join(tmpdir, "cloned")
+            os.mkdir(destination)
+            indexed = []
+            clone_with_retries = repo_cloner.clone_with_retries
+
+            async def clone_or_fail(name, url, path, semaphore, **options):
+                if name == "repo1":
+                    os.mkdir(path)
+                    raise OSError("no more processes")
+                return await clone_with_retries(name, url, path, semaphore, **options)
+
+            repo_cloner.clone_with_retries = clone_or_fail
+            try:
+                # The pipeline would wait forever for the result of the failed clone
+                statistics = asyncio.run(asyncio.wait_for(ingest_pipeline.run_pipeline_async(
+                    repos, destination, lambda repo, path: indexed.append(repo["name"]), concurrency=2), 60))
+            finally:
+                repo_cloner.clone_with_retries = clone_with_retries
+            self.assertEqual((statistics["indexed"], statistics["failed"]), (2, 1))
+            self.assertEqual(sorted(indexed), ["repo0", "repo2"])
+            self.assertEqual(os.listdir(destination), [])
+
+
+    def test_index_errors_fail_the_repo(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repos = make_bare_repos(tmpdir, 3)
+            destination = os.path.join(tmpdir, "cloned")
+            os.mkdir(destination)
+            indexed = []
+
+            def index_or_fail(repo, path):
+                if repo["name"] == "repo1":
+                    raise ValueError("cannot index")
+                indexed.append(repo["name"])
+
+            statistics = ingest_pipeline.run_pipeline(repos, destination, index_or_fail, concurrency=2)
+            self.assertEqual((statistics["indexed"], statistics["failed"], statistics["index_failed"]), (2, 0, 1))
+            self.assertEqual(sorted(indexed), ["repo0", "repo2"])
+            self.assertEqual(os.listdir(destination), [])
+
+    def test_existing_checkouts_are_kept_unless_indexed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repos = make_bare_repos(tmpdir, 3)
+            destination = os.path.join(tmpdir, "cloned")
+            existing_path = os.path.join(destination, "repo1")
+            os.makedirs(existing_path)
+
+            def stop(repo, path):
+                raise ingest_pipeline.StopPipeline("the index is full")
+
+            statistics = ingest_pipeline.run_pipeline(repos, destination, stop, concurrency=3)
+            self.assertTrue(statistics["stopped"])
+            # Only the checkouts cloned by the stopped run are deleted
+            self.assertEqual(os.listdir(destination), ["repo1"])
+            statistics = ingest_pipeline.run_pipeline(repos, destination, lambda repo, path: None, concurrency=3)
+            self.assertEqual(statistics["indexed"], 3)
+            self.assertEqual(os.listdir(destination), [])
+
+
+class TestCorpusStatistics(unittest.TestCase):
+    def test_code_line_count(self):
+        content = "# comment\n\nimport os\n    \ndef f(x):\n    # comment\n    return x  # comment\n"
+        self.assertEqual(corpus_statistics.code_line_count(content), 3)
+
+    def test_save_repo_states(self):
+        content = "def f(x):\n    return x\n"
+        file_statistics = corpus_statistics.file_statistics(content, ["a", "b", "c"])
+        self.assertEqual(file_statistics, {"line_count": 2, "byte_count": len(content), "token_count": 3})
+        repo_states = {
+            "repo": {"head": "abc", "files": {
+                "a.py": dict(file_statistics, blob="", url="https://github.com/user/repo/blob/abc/a.py"),
+                "b.py": dict(file_statistics, blob="", url=None, alias_url="https://github.com/user/repo/blob/abc/a.py"),
+                # Indexed before the statistics were saved
+                "c.py": {"blob": "", "url": "https://github.com/user/repo/blob/abc/c.py"}}},
+            "forgotten": {"head": None, "files": {}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertIsNone(corpus_statistics.load(tmpdir))
+            indexer.save_repo_states(tmpdir, repo_states)
+            self.assertEqual(indexer.load_repo_states(tmpdir), repo_states)
+            self.assertEqual(corpus_statistics.load(tmpdir),
+                             {"repo_count": 1, "file_count": 2, "line_count": 2, "byte_count": len(content), "token_count": 3})
+
+
+class TestRepoWalker(unittest.TestCase):
+    def test_iter_repo_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repo_path = os.path.join(tmpdir, "repo")
+            os.makedirs(os.path.join(repo_path, "package", "sub"))
+            files = {"setup.py": "import setuptools\n",
+                     "package/__init__.py": "",
+                     "package/sub/module.py": "def f(x):\n    return x\n",
+                     "README.md": "# repo\n"}
+            for path, content in files.items():
+                with open(os.path.join(repo_path, path), "w") as f:
+                    f.write(content)
+            os.symlink("module.py", os.path.join(repo_path, "package", "sub", "link.py"))
+            blob_url = "https://github.com/user/repo/blob/HEAD"
+            expected = sorted(path for path in files if path.endswith(".py"))
+
+            listed = list(repo_walker.iter_repo_files(repo_path, blob_url))
+            self.assertIsNone(repo_walker.git_root_path(repo_path))
+            self.assertEqual(sorted(f["relpath"] for f in listed), expected)
+
+            run_git("-C", repo_path, "init", "--quiet")
+            run_git("-C", repo_path, "add", ".")
+            git_root = repo_walker.git_root_path(os.path.join(repo_path, "package"))
+            self.assertEqual(os.path.realpath(git_root), os.path.realpath(repo_path))
+            git_listed = list(repo_walker.iter_repo_files(repo_path, blob_url, git_root))
+            self.assertEqual(sorted(f["relpath"] for f in git_listed), expected)
+            # The hashes of the directory listing are git blob hashes
+            self.assertEqual(sorted((f["relpath"], f["blob"], f["size"]) for f in listed),
+                             sorted((f["relpath"], f["blob"], f["size"]) for f in git_listed))
+            self.assertEqual(repo_walker.files_hash(listed), repo_walker.files_hash(git_listed))
+            module = next(f for f in git_listed if f["relpath"] == "package/sub/module.py")
+            self.assertEqual(module["url"], blob_url + "/package/sub/module.py")
+            self.assertEqual(module["size"], len(files["package/sub/module.py"]))
+
+            # Paths of a subdirectory are still relative to the git root
+            subdirectory_listed = list(repo_walker.iter_repo_files(os.path.join(repo_path, "package"), blob_url, git_root))
+            self.assertEqual(sorted(f["relpath"] for f in subdirectory_listed), ["package/__init__.py", "package/sub/module.py"])
+
+
+class TestRepoIndexer(unittest.TestCase):
+    def test_diff_file_blobs(self):
+        indexed_files = {"same.py": {"blob": "1"}, "changed.py": {"blob": "2"}, "deleted.py": {"blob": "3"}}
+        blobs = {"same.py": "1", "changed.py": "4", "new.py": "5"}
+        changed, deleted = repo_indexer.diff_file_blobs(indexed_files, blobs)
+        self.assertEqual((sorted(changed), deleted), (["changed.py", "new.py"], ["deleted.py"]))
+
+    def test_only_changed_files_are_indexed_again(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            work_path = os.path.join(tmpdir, "work")
+            os.mkdir(work_path)
+            contents = {"a.py": "def a(x):\n    return x + 1\n",
+                        "b.py": "class B:\n    pass\n",
+                        "c.py": "for i in range(3):\n    print(i)\n"}
+            for filename, content in contents.items():
+                with open(os.path.join(work_path, filename), "w") as f:
+                    f.write(content)
+
+            def commit(message):
+                run_git("-C", work_path, "add", "--all")
+                run_git("-C", work_path, "-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "--quiet", "-m", message)
+                return run_git("-C", work_path, "rev-parse", "HEAD").strip()
+
+            run_git("-C", work_path, "init", "--quiet")
+            first_head = commit("init")
+            repo = {"name": "repo", "html_url": "https://github.com/test/repo"}
+            index_path = os.path.join(tmpdir, "index")
+
+            def url(head, filename):
+                return "https://github.com/test/repo/blob/{}/{}".format(head, filename)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                indexing = repo_indexer.RepoIndexer(index_path)
+                indexing.index_repo(repo, work_path)
+                self.assertEqual(sorted(fields["url"] for fields in indexing.index.iter_stored_fields()),
+                                 [url(first_head, filename) for filename in sorted(contents)])
+                # An unchanged HEAD is not indexed again
+                generation = indexing.index.generation()
+                indexing.index_repo(repo, work_path)
+                self.assertEqual(indexing.index.generation(), generation)
+
+                with open(os.path.join(work_path, "a.py"), "w") as f:
+                    f.write("def a(x):\n    return x * 2\n")
+                os.remove(os.path.join(work_path, "b.py"))
+                second_head = commit("change a, delete b")
+                indexing.index_repo(repo, work_path)
+                indexing.close()
+            index = indexer.Index(index_path, settings.INDEX_NAME, settings.TOKENIZER_OPTIONS)
+            # The unchanged file keeps the document and url of the first commit
+            self.assertEqual(sorted(fields["url"] for fields in index.iter_stored_fields()),
+                             sorted([url(second_head, "a.py"), url(first_head, "c.py")]))
+            repo_state = indexer.load_repo_states(index_path)["repo"]
+            self.assertEqual(repo_state["head"], second_head)
+            self.assertEqual(sorted(repo_state["files"]), ["a.py", "c.py"])
+            self.assertEqual(repo_state["files"]["a.py"]["url"], url(second_head, "a.py"))
+            self.assertEqual(repo_state["files"]["a.py"]["blob"], run_git("-C", work_path, "rev-parse", "HEAD:a.py").strip())
+            self.assertEqual(repo_state["files"]["c.py"]["url"], url(first_head, "c.py"))
+
+
+class TestWebApp(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open("test/data.json") as f:
+            test_data = json.load(f)[:20]
+        cls.index_dir = tempfile.TemporaryDirectory()
+        index_path = os.path.join(cls.index_dir.name, "index")
+        indexer.create_new_index(index_path, settings.INDEX_NAME, settings.TOKENIZER_OPTIONS)
+        with indexer.Index(index_path, settings.INDEX_NAME, settings.TOKENIZER_OPTIONS).bulk_writer() as writer:
+            for data in test_data:
+                writer.add_documents(data)
+        cls.index_dirname = settings.INDEX_DIRNAME
+        settings.INDEX_DIRNAME = index_path
+        # The web app opens the index at INDEX_DIRNAME when it is imported
+        import main
+        cls.main = main
+        cls.client = main.flask_app.test_client()
+        cls.code = "\n".join(code for data in test_data for code in data['code_snippets'] if indexer.content_is_valid_code(code))
+
+    def test_pages_past_the_last_page_show_the_last_page(self):
+        code = self.code
+        response = self.client.get("/parse", query_string={"spaghetti": code, "page_size": 2, "hasJavascript": 1})
+        first_page = json.loads(response.get_data(as_text=True))
+        self.assertGreater(first_page["total_results"], 2)
+        self.assertTrue(first_page["has_next_page"])
+        # The total of the first page is estimated, the total of the pages past the end is exact
+        last_page = -(-first_page["total_results"] // 2)
+        response = self.client.get("/parse", query_string={"spaghetti": code, "page_size": 2, "page": last_page + 5, "hasJavascript": 1})
+        past_end = json.loads(response.get_data(as_text=True))
+        self.assertLessEqual(past_end["total_results"], first_page["total_results"])
+        self.assertEqual(past_end["page"], -(-past_end["total_results"] // 2))
+        self.assertTrue(past_end["similar"])
+        self.assertFalse(past_end["has_next_page"])
+
+    def test_huge_pages_are_clamped_before_searching(self):
+        get_similar_snippets = self.main.index.get_similar_snippets
+        pages = []
+        def record_page(code, page=1, *args):
+            pages.append(page)
+            return get_similar_snippets(code, page, *args)
+        self.main.index.get_similar_snippets = record_page
+        try:
+            self.client.get("/parse", query_string={"spaghetti": "x = 1\n", "page": 10 ** 9, "hasJavascript": 1})
+            self.client.post("/api/search", json={"queries": [{"code": "x = 1\n", "page": 10 ** 9}]}).get_data()
+        finally:
+            del self.main.index.get_similar_snippets
+        self.assertTrue(pages)
+        self.assertLessEqual(max(pages), settings.MAX_SEARCH_PAGE)
+
+    def test_api_search_streams_one_line_per_query(self):
+        queries = [self.code,
+                   {"id": "highlighted", "code": self.code, "limit": 2, "highlight": True},
+                   "def f(:\n",
+                   {"code": 1},
+                   "x = " + "-" * 1000 + "1\n",
+                   "x = " + "-" * 10000 + "1\n"]
+        response = self.client.post("/api/search", json={"queries": queries, "limit": 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line["id"] for line in lines], [0, "highlighted", 2, 3, 4, 5])
+        self.assertEqual(len(lines[0]["results"]), 3)
+        self.assertNotIn("source_html_highlighted", lines[0]["results"][0])
+        self.assertEqual(len(lines[1]["results"]), 2)
+        self.assertIn("hll", lines[1]["results"][0]["source_html_highlighted"])
+        self.assertEqual(lines[1]["total_results"], lines[0]["total_results"])
+        for line in lines[2:]:
+            self.assertIn("error", line)
+            self.assertNotIn("results", line)
+        self.assertEqual(lines[4]["error"], "code is nested too deeply")
+        self.assertEqual(self.client.post("/api/search", json={"code": self.code}).status_code, 400)
+
+    def test_highlight_without_matched_lines(self):
+        total, snippets = self.main.index.get_similar_snippets(self.code)
+        snippet = dict(snippets[0], is_python_docs=False)
+        highlighted = self.main.index.highlight_snippet_lines(snippet, set())
+        self.assertEqual(highlighted['url'], snippet['url'])
+        self.assertNotIn("hll", highlighted['source_html_highlighted'])
+
+    @classmethod
+    def tearDownClass(cls):
+        settings.INDEX_DIRNAME = cls.index_dirname
+        cls.index_dir.cleanup()
+
+
+@unittest.skipUnless(importlib.util.find_spec("scrapy"), "scrapy is not installed")
+class TestIndexWriterPipeline(unittest.TestCase):
+    def test_spiders_share_one_writer(self):
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "scraper"))
+        from pydocs_scraper import pipelines
+        with open("test/data.json") as f:
+            test_data = json.load(f)[:10]
+        default = pipelines.IndexWriterPipeline.from_crawler(types.SimpleNamespace(settings={"INDEX_PATH": None}))
+        self.assertEqual(default.index_path, os.path.join(os.path.dirname(os.path.abspath(indexer.__file__)), "index"))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = os.path.join(tmpdir, "index")
+            crawler = types.SimpleNamespace(settings={"INDEX_PATH": index_path})
+            spiders = [types.SimpleNamespace(name=name, logger=logging.getLogger(name)) for name in ("tutorial", "library")]
+            pipelines_by_spider = [pipelines.IndexWriterPipeline.from_crawler(crawler) for _ in spiders]
+            for pipeline, spider in zip(pipelines_by_spider, spiders):
+                pipeline.open_spider(spider)
+            for i, data in enumerate(test_data):
+                self.assertIs(pipelines_by_spider[i % 2].process_item(data, spiders[i % 2]), data)
+            pipelines_by_spider[0].close_spider(spiders[0])
+            # The shared writer is committed when the last spider closes
+            self.assertEqual(len(profile_index.open_index(index_path)), 0)
+            pipelines_by_spider[1].close_spider(spiders[1])
+            self.assertEqual(pipelines.IndexWriterPipeline.writers, {})
+            index = profile_index.open_index(index_path)
+            expected_count = sum(indexer.content_is_valid_code(code) for data in test_data for code in data["code_snippets"])
+            self.assertEqual(len(index), expected_count)
+            self.assertEqual(set(fields["url"] for fields in index.iter_stored_fields()), set(data["url"] for data in test_data))
 
 
 @unittest.skip("Not implemented")
@@ -27,15 +1070,21 @@ class TestIndexWriteAndQuery(unittest.TestCase):
             cls.test_data = json.load(f)
         cls.index_dir = tempfile.TemporaryDirectory()
         index_path = os.path.join(cls.index_dir.name, "index")
-        cls.index = indexer.Index(index_path, "TEMP_TEST_INDEX")
-        for d in cls.test_data:
-            cls.index.add_document(d)
+        indexer.create_new_index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+        cls.index = indexer.Index(index_path, "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS)
+        with cls.index.bulk_writer(commit_every=100) as writer:
+            for d in cls.test_data:
+                writer.add_documents(d)
+        cls.bulk_writer = writer
         print("Index ready", file=sys.stderr)
 
     def test_query_with_a_document_from_the_index(self):
         for i in range(100):
             data = random.choice(self.test_data)
             for code in data['code_snippets']:
+                if not any(ast_parser.dump(ast.parse(code), **settings.TOKENIZER_OPTIONS)):
+                    # Snippets without subtrees tall enough to be indexed cannot be found
+                    continue
                 found = False
                 for result in self.index.get_documents(code):
                     if result['title'] == data['title']:
@@ -43,6 +1092,74 @@ class TestIndexWriteAndQuery(unittest.TestCase):
                         break
                 self.assertTrue(found, "Pass {}: Did not find result in index even though searched with document that was added into the index\n\nTried to search for:\n{}".format(i+1, code))
 
+    def test_highlighted_lines_match_reparsed_line_ranges(self):
+        queries = [code for data in self.test_data[:20] for code in data['code_snippets']]
+        with self.index.index.searcher() as searcher:
+            hits = [hit for code in queries for hit in searcher.search(self.index.parse_query(code), terms=True)]
+            self.assertTrue(hits)
+            for hit in hits:
+                matched_tokens = set(term.decode() for field, term in hit.matched_terms())
+                html, precomputed_lines = self.index.highlight_matches(hit, matched_tokens)
+                reparsed_hit = {'content': self.index.document_content(hit)}
+                self.assertEqual(self.index.highlight_matches(reparsed_hit, matched_tokens), (html, precomputed_lines))
+                self.assertTrue(precomputed_lines)
+
+    def test_similar_snippets_are_paginated(self):
+        code = "for x in y:\n    print(x)\n"
+        total, all_snippets = self.index.get_similar_snippets(code, page=1, page_size=1000)
+        self.assertGreater(total, 3)
+        paged_urls = []
+        for page in range(1, total // 3 + 2):
+            page_total, snippets = self.index.get_similar_snippets(code, page=page, page_size=3)
+            self.assertEqual(page_total, total)
+            paged_urls.extend(snippet['url'] for snippet in snippets)
+        self.assertEqual(paged_urls, [snippet['url'] for snippet in all_snippets])
+        highlighted = self.index.highlight_snippet(all_snippets[0])
+        self.assertIn("hll", highlighted['source_html_highlighted'])
+        self.assertNotIn("document", highlighted)
+        json.dumps(highlighted)
+
+    def test_shared_searcher_returns_same_snippets(self):
+        queries = [code for data in self.test_data[:10] for code in data['code_snippets']]
+        with self.index.searcher() as searcher:
+            shared = [self.index.get_similar_snippets(code, 1, 5, searcher) for code in queries]
+        self.assertEqual(shared, [self.index.get_similar_snippets(code, 1, 5) for code in queries])
+
+    def test_query_planner_keeps_rare_tall_subtrees(self):
+        code = "\n".join(code for data in self.test_data[:50] for code in data['code_snippets'])
+        planner = query_planner.QueryPlanner(settings.TOKENIZER_OPTIONS, max_terms=20, max_document_ratio=0.1)
+        with self.index.searcher() as searcher:
+            plan = planner.plan(code, searcher)
+            self.assertEqual(len(plan), 20)
+            self.assertEqual(plan, sorted(plan, key=lambda pair: -pair[1]))
+            for token, _ in plan:
+                self.assertGreater(searcher.doc_frequency("content", token), 0)
+                self.assertLessEqual(searcher.doc_frequency("content", token), 0.1 * searcher.doc_count_all())
+            self.assertLessEqual(len(self.index.parse_query(code, searcher).subqueries), settings.QUERY_MAX_TERMS)
+
+    def test_frozen_index_ranks_like_whoosh(self):
+        frozen_path = os.path.join(self.index_dir.name, "frozen")
+        self.index.freeze(frozen_path)
+        frozen = indexer.Index(os.path.join(self.index_dir.name, "index"), "TEMP_TEST_INDEX", settings.TOKENIZER_OPTIONS, frozen_path=frozen_path)
+        self.assertEqual(frozen.generation(), self.index.generation())
+        # The stored fields are memory-mapped too and decoded only for the hits on a page
+        self.assertNotIsInstance(frozen.frozen.documents, list)
+        self.assertEqual([frozen.frozen.stored_fields(i) for i in range(frozen.frozen.doc_count())], list(self.index.iter_stored_fields()))
+        for data in self.test_data[:20]:
+            for code in data['code_snippets']:
+                for page in (1, 2):
+                    total, snippets = self.index.get_similar_snippets(code, page, 5)
+                    frozen_total, frozen_snippets = frozen.get_similar_snippets(code, page, 5)
+                    self.assertEqual(frozen_total, total)
+                    self.assertEqual([s['url'] for s in frozen_snippets], [s['url'] for s in snippets])
+                    for snippet, frozen_snippet in zip(snippets, frozen_snippets):
+                        self.assertAlmostEqual(frozen_snippet.pop('score'), snippet.pop('score'))
+                        self.assertEqual(frozen_snippet, snippet)
+
+    def test_bulk_writer_commits_in_batches(self):
+        self.assertEqual(len(self.index), self.bulk_writer.added_count)
+        self.assertEqual(self.bulk_writer.commit_count, -(-self.bulk_writer.added_count // 100))
+
     @classmethod
     def tearDownClass(cls):
         cls.index_dir.cleanup()